@@ -0,0 +1,83 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import time
+
+import torch
+from torch.nn import functional as F
+
+from xinference.model.llm.pytorch.compression import (
+    CLinear,
+    DecompressedWeightCache,
+    decompress,
+    default_compression_config,
+)
+
+
+def _decompress_per_forward(layer: CLinear, x: torch.Tensor) -> torch.Tensor:
+    # The behavior before the int8 matmul, decompress on every forward.
+    weight = decompress(layer.weight, default_compression_config)
+    return F.linear(x, weight)
+
+
+def bench(fn, x: torch.Tensor, repeat: int) -> float:
+    fn(x)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(x)
+    return (time.perf_counter() - start) / repeat
+
+
+@torch.inference_mode()
+def main(args: argparse.Namespace):
+    torch.manual_seed(0)
+    weight = torch.randn(args.out_features, args.in_features) * 0.02
+    dense = torch.nn.Linear(args.in_features, args.out_features, bias=False)
+    dense.weight.data = weight
+    layer = CLinear(weight, None, "cpu")
+    cached = CLinear(
+        weight, None, "cpu", cache=DecompressedWeightCache(weight.numel() * 4)
+    )
+    for batch in args.batch_sizes:
+        x = torch.randn(batch, args.in_features)
+        expected = dense(x)
+        print(f"batch {batch}:")
+        for name, fn in [
+            ("fp32 linear", dense),
+            ("decompress per forward", lambda x: _decompress_per_forward(layer, x)),
+            ("int8 matmul", layer),
+            ("cached decompressed weight", cached),
+        ]:
+            seconds = bench(fn, x, args.repeat)
+            error = ((fn(x) - expected).norm() / expected.norm()).item()
+            print(f"  {name:<28} {seconds * 1e3:10.2f} ms  rel. error {error:.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the linear layers of the 8-bit compressed models on CPU."
+    )
+    parser.add_argument("--in-features", type=int, default=4096)
+    parser.add_argument("--out-features", type=int, default=4096)
+    parser.add_argument(
+        "--batch-sizes",
+        type=int,
+        nargs="+",
+        default=[1, 16, 128],
+        help="Numbers of tokens per forward, 1 for a decode step.",
+    )
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,91 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import asyncio
+import json
+import time
+
+import sse_starlette.sse
+
+from xinference.core.utils import sse_frame
+
+
+def make_chunk(index: int):
+    return {
+        "id": "chat-cmpl-5b0e4ae8-0d3c-11ef-9a8e-0242ac110002",
+        "model": "qwen-chat",
+        "object": "chat.completion.chunk",
+        "created": 1715000000,
+        "choices": [
+            {
+                "index": 0,
+                "delta": {"content": f"token{index} "},
+                "finish_reason": None,
+            }
+        ],
+    }
+
+
+def _old_sync(chunk):
+    return sse_starlette.sse.ensure_bytes(dict(data=json.dumps(chunk)), None)
+
+
+async def _old_async(chunk):
+    v = await asyncio.to_thread(json.dumps, chunk)
+    return await asyncio.to_thread(sse_starlette.sse.ensure_bytes, dict(data=v), None)
+
+
+async def _new_async(chunk):
+    return sse_frame(chunk)
+
+
+def bench_sync(fn, chunks) -> float:
+    start = time.perf_counter()
+    for chunk in chunks:
+        fn(chunk)
+    return (time.perf_counter() - start) / len(chunks)
+
+
+async def bench_async(fn, chunks) -> float:
+    start = time.perf_counter()
+    for chunk in chunks:
+        await fn(chunk)
+    return (time.perf_counter() - start) / len(chunks)
+
+
+def main(args: argparse.Namespace):
+    chunks = [make_chunk(i) for i in range(args.num_tokens)]
+    results = [
+        ("sync, json.dumps + ensure_bytes", bench_sync(_old_sync, chunks)),
+        ("sync, sse_frame", bench_sync(sse_frame, chunks)),
+        (
+            "async, 2 thread hops per token",
+            asyncio.run(bench_async(_old_async, chunks)),
+        ),
+        ("async, sse_frame", asyncio.run(bench_async(_new_async, chunks))),
+    ]
+    for name, per_token in results:
+        print(f"{name:<36} {per_token * 1e6:10.2f} us/token")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the per-token serialization overhead of streaming."
+    )
+    parser.add_argument(
+        "--num-tokens", type=int, default=10000, help="Number of chunks to serialize."
+    )
+    args = parser.parse_args()
+    main(args)
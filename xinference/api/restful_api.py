@@ -22,7 +22,7 @@ import pprint
 import sys
 import time
 import warnings
-from typing import Any, List, Optional, Union
+from typing import Any, List, Optional, Set, Union
 
 import gradio as gr
 import xoscar as xo
@@ -47,6 +47,7 @@ from PIL import Image
 from sse_starlette.sse import EventSourceResponse
 from starlette.responses import JSONResponse as StarletteJSONResponse
 from starlette.responses import RedirectResponse
+from typing_extensions import Literal
 from uvicorn import Config, Server
 from xoscar.utils import get_next_port
 
@@ -89,6 +90,11 @@ class CreateCompletionRequest(CreateCompletion):
 class CreateEmbeddingRequest(BaseModel):
     model: str
     input: Union[str, List[str]] = Field(description="The input to embed.")
+    encoding_format: Literal["float", "base64", "base64_float16"] = Field(
+        default="float",
+        description="The format of the embeddings, `base64` is the base64 encoded "
+        "float32 little-endian vector, `base64_float16` is the float16 one.",
+    )
     user: Optional[str] = None
 
     class Config:
@@ -149,6 +155,7 @@ class RESTfulAPI:
         self._port = port
         self._supervisor_ref = None
         self._event_collector_ref = None
+        self._destroy_tasks: Set[asyncio.Task] = set()
         self._auth_service = AuthService(auth_config_file)
         self._router = APIRouter()
         self._app = FastAPI()
@@ -161,6 +168,24 @@ class RESTfulAPI:
         if "Rate limit reached" in str(e):
             raise HTTPException(status_code=429, detail=str(e))
 
+    def _destroy_generator(self, iterator):
+        """
+        Destroy the remote generator of a disconnected stream in a new task,
+        so that the model stops generating at once instead of when the iterator
+        is garbage collected. The task of the stream itself is being cancelled.
+        """
+        if iterator is None or not hasattr(iterator, "destroy"):
+            return
+
+        def _done(t: asyncio.Task):
+            self._destroy_tasks.discard(t)
+            if not t.cancelled() and t.exception() is not None:
+                logger.warning("Failed to destroy the generator: %s", t.exception())
+
+        task = asyncio.create_task(iterator.destroy())
+        self._destroy_tasks.add(task)
+        task.add_done_callback(_done)
+
     async def _get_supervisor_ref(self) -> xo.ActorRefType[SupervisorActor]:
         if self._supervisor_ref is None:
             self._supervisor_ref = await xo.actor_ref(
@@ -837,8 +862,6 @@ class RESTfulAPI:
         exclude = {
             "prompt",
             "model",
-            "n",
-            "best_of",
             "logit_bias",
             "logit_bias_type",
             "user",
@@ -876,6 +899,10 @@ class RESTfulAPI:
                         self.handle_request_limit_error(re)
                     async for item in iterator:
                         yield item
+                except asyncio.CancelledError:
+                    logger.info("Client disconnected, abort the completion stream.")
+                    self._destroy_generator(iterator)
+                    raise
                 except Exception as ex:
                     logger.exception("Completion stream got an error: %s", ex)
                     await self._report_error_event(model_uid, str(ex))
@@ -909,7 +936,9 @@ class RESTfulAPI:
             raise HTTPException(status_code=500, detail=str(e))
 
         try:
-            embedding = await model.create_embedding(body.input)
+            embedding = await model.create_embedding(
+                body.input, encoding_format=body.encoding_format
+            )
             return Response(embedding, media_type="application/json")
         except RuntimeError as re:
             logger.error(re, exc_info=True)
@@ -1128,7 +1157,6 @@ class RESTfulAPI:
         exclude = {
             "prompt",
             "model",
-            "n",
             "messages",
             "logit_bias",
             "logit_bias_type",
@@ -1256,6 +1284,12 @@ class RESTfulAPI:
                         self.handle_request_limit_error(re)
                     async for item in iterator:
                         yield item
+                except asyncio.CancelledError:
+                    logger.info(
+                        "Client disconnected, abort the chat completion stream."
+                    )
+                    self._destroy_generator(iterator)
+                    raise
                 except Exception as ex:
                     logger.exception("Chat completion stream got an error: %s", ex)
                     await self._report_error_event(model_uid, str(ex))
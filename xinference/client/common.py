@@ -12,8 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
 import json
-from typing import Any, Iterator
+from typing import TYPE_CHECKING, Any, Dict, Iterator, cast
+
+from ..constants import EMBEDDING_BASE64_DTYPES
+
+if TYPE_CHECKING:
+    from ..types import Embedding
 
 
 def streaming_response_iterator(
@@ -48,3 +54,33 @@ def streaming_response_iterator(
             if error is not None:
                 raise Exception(str(error))
             yield data
+
+
+def decode_embedding(response: Dict[str, Any], encoding_format: str) -> "Embedding":
+    """
+    Decode the base64 embeddings in the response to numpy arrays in place.
+
+    Parameters
+    ----------
+    response: Dict
+        The Embedding response.
+    encoding_format: str
+        The encoding format of the request, the float embeddings are kept as they are.
+
+    Returns
+    -------
+    Embedding
+        The Embedding with the vectors of numpy arrays, float32 for ``base64``
+        and float16 for ``base64_float16``.
+    """
+    dtype = EMBEDDING_BASE64_DTYPES.get(encoding_format)
+    if dtype is None:
+        return cast("Embedding", response)
+
+    import numpy as np
+
+    for data in response["data"]:
+        data["embedding"] = np.frombuffer(
+            base64.b64decode(data["embedding"]), dtype=dtype
+        )
+    return cast("Embedding", response)
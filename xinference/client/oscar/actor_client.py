@@ -22,6 +22,7 @@ import xoscar as xo
 from ...core.model import ModelActor
 from ...core.supervisor import SupervisorActor
 from ...isolation import Isolation
+from ..common import decode_embedding
 from ..restful.restful_client import Client
 
 if TYPE_CHECKING:
@@ -34,6 +35,7 @@ if TYPE_CHECKING:
         ChatglmCppGenerateConfig,
         Completion,
         CompletionChunk,
+        Embedding,
         ImageList,
         LlamaCppGenerateConfig,
         PytorchGenerateConfig,
@@ -111,7 +113,9 @@ class ClientIteratorWrapper(AsyncIterator):
 
 
 class EmbeddingModelHandle(ModelHandle):
-    def create_embedding(self, input: Union[str, List[str]]) -> bytes:
+    def create_embedding(
+        self, input: Union[str, List[str]], encoding_format: str = "float"
+    ) -> "Embedding":
         """
         Creates an embedding vector representing the input text.
 
@@ -120,16 +124,21 @@ class EmbeddingModelHandle(ModelHandle):
         input: Union[str, List[str]]
             Input text to embed, encoded as a string or array of tokens.
             To embed multiple inputs in a single request, pass an array of strings or array of token arrays.
+        encoding_format: str
+            The format to transfer the embeddings, "float", "base64" or "base64_float16".
+            The base64 embeddings are decoded to numpy arrays of float32 or float16.
 
         Returns
         -------
-        bytes
-            A json bytes of Embedding. The resulted Embedding vector that can be easily consumed by
+        Embedding
+            The resulted Embedding vector that can be easily consumed by
             machine learning models and algorithms.
         """
 
-        coro = self._model_ref.create_embedding(input)
-        return orjson.loads(self._isolation.call(coro))
+        coro = self._model_ref.create_embedding(input, encoding_format=encoding_format)
+        return decode_embedding(
+            orjson.loads(self._isolation.call(coro)), encoding_format
+        )
 
 
 class RerankModelHandle(ModelHandle):
@@ -479,6 +488,10 @@ class ActorClient:
         request_limits: Optional[int]
             The number of request limits for this model， default is None.
             ``request_limits=None`` means no limits for this model.
+            The requests over the limits wait in a queue of ``request_queue_size``
+            (default 0) for at most ``request_queue_timeout`` seconds, chat and
+            generate requests are served before embedding and rerank requests.
+            ``adaptive_request_limits=True`` tunes the limits by the observed latency.
         **kwargs:
             Any other parameters been specified.
 
@@ -18,7 +18,7 @@ from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Union
 
 import requests
 
-from ..common import streaming_response_iterator
+from ..common import decode_embedding, streaming_response_iterator
 
 if TYPE_CHECKING:
     from ...types import (
@@ -80,7 +80,9 @@ class RESTfulModelHandle:
 
 
 class RESTfulEmbeddingModelHandle(RESTfulModelHandle):
-    def create_embedding(self, input: Union[str, List[str]]) -> "Embedding":
+    def create_embedding(
+        self, input: Union[str, List[str]], encoding_format: str = "float"
+    ) -> "Embedding":
         """
         Create an Embedding from user input via RESTful APIs.
 
@@ -89,6 +91,10 @@ class RESTfulEmbeddingModelHandle(RESTfulModelHandle):
         input: Union[str, List[str]]
             Input text to embed, encoded as a string or array of tokens.
             To embed multiple inputs in a single request, pass an array of strings or array of token arrays.
+        encoding_format: str
+            The format to transfer the embeddings, "float", "base64" or "base64_float16".
+            The base64 embeddings are much smaller and faster to transfer,
+            they are decoded to numpy arrays of float32 or float16.
 
         Returns
         -------
@@ -102,7 +108,11 @@ class RESTfulEmbeddingModelHandle(RESTfulModelHandle):
 
         """
         url = f"{self._base_url}/v1/embeddings"
-        request_body = {"model": self._model_uid, "input": input}
+        request_body = {
+            "model": self._model_uid,
+            "input": input,
+            "encoding_format": encoding_format,
+        }
         response = requests.post(url, json=request_body, headers=self.auth_headers)
         if response.status_code != 200:
             raise RuntimeError(
@@ -110,7 +120,7 @@ class RESTfulEmbeddingModelHandle(RESTfulModelHandle):
             )
 
         response_data = response.json()
-        return response_data
+        return decode_embedding(response_data, encoding_format)
 
 
 class RESTfulRerankModelHandle(RESTfulModelHandle):
@@ -805,6 +815,10 @@ class Client:
         request_limits: Optional[int]
             The number of request limits for this model， default is None.
             ``request_limits=None`` means no limits for this model.
+            The requests over the limits wait in a queue of ``request_queue_size``
+            (default 0) for at most ``request_queue_timeout`` seconds, chat and
+            generate requests are served before embedding and rerank requests.
+            ``adaptive_request_limits=True`` tunes the limits by the observed latency.
         **kwargs:
             Any other parameters been specified.
 
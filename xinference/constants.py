@@ -64,3 +64,7 @@ XINFERENCE_DISABLE_HEALTH_CHECK = bool(
     int(os.environ.get(XINFERENCE_ENV_DISABLE_HEALTH_CHECK, 0))
 )
 XINFERENCE_DISABLE_VLLM = bool(int(os.environ.get(XINFERENCE_ENV_DISABLE_VLLM, 0)))
+
+# The base64 encoding formats of embeddings and the little-endian dtype of the
+# encoded vector.
+EMBEDDING_BASE64_DTYPES = {"base64": "<f4", "base64_float16": "<f2"}
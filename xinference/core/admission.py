@@ -0,0 +1,157 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+from enum import IntEnum
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RequestPriority(IntEnum):
+    """The lower value is served first."""
+
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+class AdmissionController:
+    """
+    Control how many requests are served by a model at the same time.
+
+    The requests over the limit wait in a bounded priority queue instead of being
+    rejected right away. A request is rejected if the queue is full or it waits
+    longer than `queue_timeout` seconds.
+
+    If `adaptive` is True, the limit is tuned by AIMD in `[1, limit]`: for each
+    window of `limit` finished requests, the limit is decreased multiplicatively
+    if the average latency of the window exceeds `latency_tolerance` times the
+    lowest window average observed, otherwise it is increased by one.
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        max_queue_size: int = 0,
+        queue_timeout: Optional[float] = None,
+        adaptive: bool = False,
+        latency_tolerance: float = 2.0,
+        decrease_factor: float = 0.75,
+    ):
+        if limit < 0:
+            raise ValueError("The request limit must be greater or equal than 0.")
+        if max_queue_size < 0:
+            raise ValueError("The request queue size must be greater or equal than 0.")
+        if queue_timeout is not None and queue_timeout <= 0:
+            raise ValueError("The request queue timeout must be greater than 0.")
+        self._max_limit = limit
+        self._limit = limit
+        self._max_queue_size = max_queue_size
+        self._queue_timeout = queue_timeout
+        self._adaptive = adaptive
+        self._latency_tolerance = latency_tolerance
+        self._decrease_factor = decrease_factor
+
+        self._serve_count = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._num_waiters = 0
+        self._counter = itertools.count()
+
+        # AIMD states.
+        self._window_latencies: List[float] = []
+        self._min_window_latency = math.inf
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def serve_count(self) -> int:
+        return self._serve_count
+
+    @property
+    def queue_size(self) -> int:
+        return self._num_waiters
+
+    async def acquire(self, priority: int = RequestPriority.INTERACTIVE):
+        if self._serve_count < self._limit and self._num_waiters == 0:
+            self._serve_count += 1
+            return
+        if self._num_waiters >= self._max_queue_size:
+            raise RuntimeError(
+                f"Rate limit reached for the model. Request limit {self._limit}, "
+                f"queue size {self._max_queue_size}"
+            )
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), fut))
+        self._num_waiters += 1
+        try:
+            await asyncio.wait_for(fut, self._queue_timeout)
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                # The slot was handed over right before the cancellation.
+                self.release()
+            else:
+                # The entry in the heap is skipped lazily.
+                fut.cancel()
+                self._num_waiters -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                raise RuntimeError(
+                    f"Rate limit reached for the model. The request is timed out after "
+                    f"waiting in the queue for {self._queue_timeout} s"
+                ) from None
+            raise
+
+    def release(self, latency: Optional[float] = None):
+        self._serve_count -= 1
+        if self._adaptive and latency is not None:
+            self._update_limit(latency)
+        self._wakeup()
+
+    def _wakeup(self):
+        while self._waiters and self._serve_count < self._limit:
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            # Hand over the slot to the waiter.
+            self._serve_count += 1
+            self._num_waiters -= 1
+            fut.set_result(None)
+
+    def _update_limit(self, latency: float):
+        self._window_latencies.append(latency)
+        if len(self._window_latencies) < max(self._limit, 1):
+            return
+        avg_latency = sum(self._window_latencies) / len(self._window_latencies)
+        self._window_latencies = []
+        self._min_window_latency = min(self._min_window_latency, avg_latency)
+        if avg_latency > self._latency_tolerance * self._min_window_latency:
+            limit = max(1, int(self._limit * self._decrease_factor))
+        else:
+            limit = min(self._max_limit, self._limit + 1)
+        if limit != self._limit:
+            logger.debug(
+                "Adjust the request limit from %d to %d, window latency: %.3f s, "
+                "min window latency: %.3f s",
+                self._limit,
+                limit,
+                avg_latency,
+                self._min_window_latency,
+            )
+            self._limit = limit
@@ -0,0 +1,95 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RequestBatcher:
+    """
+    Collect the concurrent requests into batches.
+
+    A batch is flushed `wait_ms` milliseconds after its first request arrives,
+    or as soon as the sizes of its requests reach `max_batch_size`. A request is
+    never split, so a request larger than `max_batch_size` is run alone.
+
+    `fn` receives the items of a batch and returns their results in order.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[List[Any]], Awaitable[List[Any]]],
+        wait_ms: float,
+        max_batch_size: int,
+    ):
+        if wait_ms < 0:
+            raise ValueError("The batch wait time must be greater or equal than 0.")
+        if max_batch_size <= 0:
+            raise ValueError("The max batch size must be greater than 0.")
+        self._fn = fn
+        self._wait = wait_ms / 1000
+        self._max_batch_size = max_batch_size
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._pending_size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, item: Any, size: int = 1) -> Any:
+        loop = asyncio.get_running_loop()
+        if self._pending and self._pending_size + size > self._max_batch_size:
+            self._flush()
+        fut = loop.create_future()
+        self._pending.append((item, fut))
+        self._pending_size += size
+        if self._pending_size >= self._max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._wait, self._flush)
+        return await fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # Skip the requests cancelled while waiting.
+        batch = [(item, fut) for item, fut in self._pending if not fut.done()]
+        self._pending = []
+        self._pending_size = 0
+        if not batch:
+            return
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]):
+        logger.debug("Run a batch of %d requests.", len(batch))
+        try:
+            results = await self._fn([item for item, _ in batch])
+        except BaseException as e:
+            for _, fut in batch:
+                if fut.done():
+                    continue
+                if isinstance(e, Exception):
+                    fut.set_exception(e)
+                else:
+                    fut.cancel()
+            if not isinstance(e, Exception):
+                raise
+            return
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
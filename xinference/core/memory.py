@@ -0,0 +1,198 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gc
+import logging
+import threading
+from typing import Optional, Tuple
+
+import psutil
+import torch
+
+from ..device_utils import empty_cache, get_available_device
+
+logger = logging.getLogger(__name__)
+
+# Do not bother releasing less unused device memory, or RSS growth, than this.
+MIN_UNUSED_DEVICE_MEMORY = 256 * 1024**2
+
+
+class _ProcessMemory:
+    """
+    The peak RSS of the process, for the devices without a caching allocator,
+    e.g. CPU. On Linux, the peak is reset by `/proc/self/clear_refs` and read
+    from the `VmHWM` of `/proc/self/status`, elsewhere it is the larger RSS at
+    the reset and at the read.
+    """
+
+    def __init__(self):
+        self._process = psutil.Process()
+        self._rss_at_reset = 0
+        self._resettable = True
+
+    def rss(self) -> int:
+        return self._process.memory_info().rss
+
+    def reset_peak_memory_stats(self):
+        if self._resettable:
+            try:
+                with open("/proc/self/clear_refs", "w") as f:
+                    f.write("5")
+            except OSError:
+                self._resettable = False
+        self._rss_at_reset = self.rss()
+
+    def max_memory_allocated(self) -> int:
+        peak = max(self._rss_at_reset, self.rss())
+        if self._resettable:
+            try:
+                with open("/proc/self/status") as f:
+                    for line in f:
+                        if line.startswith("VmHWM:"):
+                            peak = max(peak, int(line.split()[1]) * 1024)
+                            break
+            except OSError:
+                pass
+        return peak
+
+
+def _device_module(device: str):
+    # The caching allocators with the `torch.cuda` memory stats API.
+    if device == "cuda":
+        return torch.cuda
+    if device == "xpu":
+        return torch.xpu
+    return None
+
+
+class MemoryManager:
+    """
+    Release the memory of a model actor when it is worth it, rather than after
+    every request.
+
+    A full garbage collection plus emptying the cache of the device allocator
+    takes milliseconds, while the cached blocks would be reused by the next
+    request anyway. The memory is released once the device allocator holds more
+    unused memory than `fragmentation_threshold` of what it reserved, the RSS
+    of the process exceeds `max_rss` bytes, or every `release_interval`
+    requests if it is positive. Without a device allocator, e.g. on CPU, the
+    memory is released once the RSS grows by more than `fragmentation_threshold`
+    since the last release.
+
+    The peak memory of a request is the peak since the start of the oldest
+    running request, it includes the memory of the concurrent requests. It is
+    the peak RSS of the process without a device allocator.
+    """
+
+    def __init__(
+        self,
+        release_interval: int = 0,
+        fragmentation_threshold: float = 0.5,
+        max_rss: Optional[int] = None,
+    ):
+        if release_interval < 0:
+            raise ValueError("The `release_interval` must be greater or equal than 0.")
+        if not 0 < fragmentation_threshold <= 1:
+            raise ValueError("The `fragmentation_threshold` must be in (0, 1].")
+        self._release_interval = release_interval
+        self._fragmentation_threshold = fragmentation_threshold
+        self._max_rss = max_rss
+        self._device = _device_module(get_available_device())
+        self._process = psutil.Process() if max_rss is not None else None
+        self._process_memory = _ProcessMemory() if self._device is None else None
+        # The RSS after the last release, measured at the first request.
+        self._base_rss: Optional[int] = None
+        self._lock = threading.Lock()
+        self._num_running = 0
+        # The number of requests finished since the last release.
+        self._num_finished = 0
+
+    def _memory_stats(self):
+        return self._device if self._device is not None else self._process_memory
+
+    def request_started(self):
+        with self._lock:
+            stats = self._memory_stats()
+            if self._num_running == 0 and stats is not None:
+                stats.reset_peak_memory_stats()
+            if self._base_rss is None and self._process_memory is not None:
+                self._base_rss = self._process_memory.rss()
+            self._num_running += 1
+
+    def request_cancelled(self):
+        """The request started has not run, e.g. it only created a generator."""
+        with self._lock:
+            self._num_running -= 1
+
+    def request_finished(self) -> Optional[int]:
+        """
+        Return the peak memory in bytes while the request was running, or None
+        if it is not tracked. Release the memory if the policy says so.
+        """
+        peak, reason = self.request_finished_deferred()
+        if reason is not None:
+            self.release_by(reason)
+        return peak
+
+    def request_finished_deferred(self) -> Tuple[Optional[int], Optional[str]]:
+        """
+        Like `request_finished`, but return the reason to release the memory,
+        if any, for the caller to call `release_by` off the event loop.
+        """
+        with self._lock:
+            self._num_running -= 1
+            self._num_finished += 1
+            stats = self._memory_stats()
+            peak = stats.max_memory_allocated() if stats is not None else None
+            reason = self._release_reason()
+            if reason is not None:
+                self._num_finished = 0
+        return peak, reason
+
+    def release_by(self, reason: str):
+        logger.debug("Release the memory, %s.", reason)
+        self.release()
+        if self._process_memory is not None:
+            self._base_rss = self._process_memory.rss()
+
+    def _release_reason(self) -> Optional[str]:
+        if self._release_interval and self._num_finished >= self._release_interval:
+            return f"{self._num_finished} requests finished"
+        if self._device is not None:
+            reserved = self._device.memory_reserved()
+            unused = reserved - self._device.memory_allocated()
+            if (
+                unused >= MIN_UNUSED_DEVICE_MEMORY
+                and unused > self._fragmentation_threshold * reserved
+            ):
+                return f"{unused} of {reserved} reserved bytes are unused"
+        if self._process_memory is not None and self._base_rss is not None:
+            rss = self._process_memory.rss()
+            growth = rss - self._base_rss
+            if (
+                growth >= MIN_UNUSED_DEVICE_MEMORY
+                and growth > self._fragmentation_threshold * self._base_rss
+            ):
+                return f"the RSS grows from {self._base_rss} to {rss} bytes"
+        if self._process is not None:
+            rss = self._process.memory_info().rss
+            assert self._max_rss is not None
+            if rss > self._max_rss:
+                return f"the RSS {rss} exceeds {self._max_rss} bytes"
+        return None
+
+    @staticmethod
+    def release():
+        gc.collect()
+        empty_cache()
@@ -15,7 +15,7 @@
 import asyncio
 
 import uvicorn
-from aioprometheus import Counter, Gauge
+from aioprometheus import Counter, Gauge, Histogram
 from aioprometheus.asgi.starlette import metrics
 from fastapi import FastAPI
 from fastapi.responses import RedirectResponse
@@ -37,6 +37,47 @@ input_tokens_total_counter = Counter(
 output_tokens_total_counter = Counter(
     "xinference:output_tokens_total_counter", "Total number of output tokens."
 )
+aborted_requests_total_counter = Counter(
+    "xinference:aborted_requests_total_counter",
+    "Total number of streaming requests aborted before the end, "
+    "e.g. the client disconnected.",
+)
+# Admission control
+request_queue_size = Gauge(
+    "xinference:request_queue_size", "Number of requests waiting in the queue."
+)
+request_queue_time_ms = Histogram(
+    "xinference:request_queue_time_ms",
+    "Time spent in the request queue in ms.",
+    buckets=[1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 30000, 60000],
+)
+request_stage_latency_ms = Histogram(
+    "xinference:request_stage_latency_ms",
+    "Time spent in each stage of a request in ms, labeled by the stage.",
+    buckets=[0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 30000, 60000],
+)
+request_peak_memory_mb = Histogram(
+    "xinference:request_peak_memory_mb",
+    "Peak device memory allocated, or peak RSS on CPU, while a request is running in MiB.",
+    buckets=[64, 256, 1024, 4096, 8192, 16384, 32768, 65536, 131072],
+)
+spec_decoding_acceptance_rate = Gauge(
+    "xinference:spec_decoding_acceptance_rate",
+    "Rolling acceptance rate of the draft tokens of speculative decoding.",
+)
+spec_decoding_tokens_per_forward = Gauge(
+    "xinference:spec_decoding_tokens_per_forward",
+    "Rolling number of tokens generated per forward of the target model "
+    "in speculative decoding.",
+)
+spec_decoding_draft_length = Gauge(
+    "xinference:spec_decoding_draft_length",
+    "Number of draft tokens per round of speculative decoding.",
+)
+request_concurrency_limit = Gauge(
+    "xinference:request_concurrency_limit",
+    "Number of requests allowed to be served concurrently.",
+)
 
 
 def record_metrics(name, op, kwargs):
@@ -13,25 +13,28 @@
 # limitations under the License.
 
 import asyncio
+import contextvars
 import functools
 import inspect
-import json
 import os
+import threading
 import time
 import types
 import weakref
 from typing import (
     TYPE_CHECKING,
+    Any,
     AsyncGenerator,
+    Awaitable,
     Callable,
     Dict,
     Iterator,
     List,
     Optional,
+    Set,
     Union,
 )
 
-import sse_starlette.sse
 import xoscar as xo
 
 if TYPE_CHECKING:
@@ -44,8 +47,11 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-from ..device_utils import empty_cache
-from .utils import json_dumps, log_async
+from ..types import RequestTimings
+from .admission import AdmissionController, RequestPriority
+from .batching import RequestBatcher
+from .memory import MemoryManager
+from .utils import json_dumps, log_async, sse_frame
 
 try:
     from torch.cuda import OutOfMemoryError
@@ -57,33 +63,117 @@ except ImportError:
     OutOfMemoryError = _OutOfMemoryError
 
 
-def request_limit(fn):
+# The time the current request waited in the admission queue.
+_request_queue_time_ms: contextvars.ContextVar[float] = contextvars.ContextVar(
+    "request_queue_time_ms", default=0.0
+)
+
+
+def _with_compute_time(fn: Callable) -> Callable:
+    """
+    Report the compute time of a model method returning a dict in its
+    `timings`, as the batched embedding and rerank requests do.
+    """
+
+    @functools.wraps(fn)
+    def _wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        ret = fn(*args, **kwargs)
+        ret["timings"] = RequestTimings(compute_ms=(time.perf_counter() - start) * 1000)
+        return ret
+
+    return _wrapper
+
+
+class _AdmissionSlot:
+    """
+    The slot of a request admitted by `AdmissionController`, released once on
+    the event loop when the request finishes. The slot of a stream is held
+    until its generator is exhausted, closed or collected, so the latency fed
+    to the controller covers the whole generation.
+    """
+
+    def __init__(
+        self, actor: "ModelActor", controller: AdmissionController, admit_time: float
+    ):
+        self._actor = actor
+        self._controller = controller
+        self._admit_time = admit_time
+        self._loop = asyncio.get_running_loop()
+        self._lock = threading.Lock()
+        self._released = False
+        # Whether a generator holds the slot after the method returns.
+        self.deferred = False
+
+    def release(self):
+        # Called by the generators in the threads, or on garbage collection.
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        latency = time.time() - self._admit_time
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._release(latency)
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._release, latency)
+
+    def _release(self, latency: float):
+        self._controller.release(latency)
+        self._actor._record_admission_gauges()
+        logger.debug(
+            f"Request finished in {latency:.3f} s, "
+            f"current serve request count: {self._controller.serve_count} "
+            f"for the model {self._actor.model_uid()}"
+        )
+
+
+# The admission slot of the current request, taken over by its generator.
+_request_admission_slot: contextvars.ContextVar[
+    Optional[_AdmissionSlot]
+] = contextvars.ContextVar("request_admission_slot", default=None)
+
+
+def request_limit(fn=None, *, priority: int = RequestPriority.INTERACTIVE):
     """
     Used by ModelActor.
     As a decorator, added to a ModelActor method to control
     how many requests are accessing that method at the same time.
+    The requests over the limit wait in the admission queue by `priority`,
+    see `AdmissionController`.
     """
+    if fn is None:
+        return functools.partial(request_limit, priority=priority)
 
     async def wrapped_func(self, *args, **kwargs):
+        controller: Optional[AdmissionController] = self._admission_controller
+        if controller is None:
+            return await fn(self, *args, **kwargs)
+
         logger.debug(
-            f"Request {fn.__name__}, current serve request count: {self._serve_count}, request limit: {self._request_limits} for the model {self.model_uid()}"
+            f"Request {fn.__name__}, "
+            f"current serve request count: {controller.serve_count}, "
+            f"request limit: {controller.limit}, "
+            f"queue size: {controller.queue_size} for the model {self.model_uid()}"
         )
-        if self._request_limits is not None:
-            if 1 + self._serve_count <= self._request_limits:
-                self._serve_count += 1
-            else:
-                raise RuntimeError(
-                    f"Rate limit reached for the model. Request limit {self._request_limits} for the model: {self.model_uid()}"
-                )
+        start_time = time.time()
+        await controller.acquire(priority)
+        admit_time = time.time()
+        queue_time = (admit_time - start_time) * 1000
+        _request_queue_time_ms.set(queue_time)
+        self._record_admission_metrics(queue_time)
+        slot = _AdmissionSlot(self, controller, admit_time)
+        token = _request_admission_slot.set(slot)
         try:
-            ret = await fn(self, *args, **kwargs)
+            return await fn(self, *args, **kwargs)
         finally:
-            if self._request_limits is not None:
-                self._serve_count -= 1
-            logger.debug(
-                f"After request {fn.__name__}, current serve request count: {self._serve_count} for the model {self.model_uid()}"
-            )
-        return ret
+            _request_admission_slot.reset(token)
+            # The stream releases the slot when it finishes.
+            if not slot.deferred:
+                slot.release()
 
     return wrapped_func
 
@@ -124,13 +214,14 @@ class ModelActor(xo.StatelessActor):
         from ..model.llm.pytorch.core import PytorchModel as LLMPytorchModel
         from ..model.llm.vllm.core import VLLMModel as LLMVLLMModel
 
+        if isinstance(self._model, LLMPytorchModel):
+            # The scheduler is started for every format, e.g. gptq and awq.
+            self._model.stop_batch_scheduler()
         if (
             isinstance(self._model, (LLMPytorchModel, LLMVLLMModel))
             and self._model.model_spec.model_format == "pytorch"
         ) or isinstance(self._model, EmbeddingModel):
             try:
-                import gc
-
                 import torch  # noqa: F401
             except ImportError:
                 error_message = "Failed to import module 'torch'"
@@ -141,8 +232,7 @@ class ModelActor(xo.StatelessActor):
                 raise ImportError(f"{error_message}\n\n{''.join(installation_guide)}")
 
             del self._model
-            gc.collect()
-            empty_cache()
+            await asyncio.to_thread(MemoryManager.release)
 
     def __init__(
         self,
@@ -150,8 +240,18 @@ class ModelActor(xo.StatelessActor):
         model: "LLM",
         model_description: Optional["ModelDescription"] = None,
         request_limits: Optional[int] = None,
+        request_queue_size: int = 0,
+        request_queue_timeout: Optional[float] = None,
+        adaptive_request_limits: bool = False,
+        batch_wait_ms: Optional[float] = None,
+        max_batch_size: int = 32,
+        return_timings: bool = False,
+        memory_release_interval: int = 0,
+        memory_fragmentation_threshold: float = 0.5,
+        max_rss: Optional[int] = None,
     ):
         super().__init__()
+        from ..model.embedding.core import EmbeddingModel
         from ..model.llm.pytorch.core import PytorchModel
         from ..model.llm.pytorch.spec_model import SpeculativeModel
         from ..model.llm.vllm.core import VLLMModel
@@ -161,7 +261,16 @@ class ModelActor(xo.StatelessActor):
         self._model_description = (
             model_description.to_dict() if model_description else {}
         )
-        self._request_limits = request_limits
+        self._admission_controller = (
+            AdmissionController(
+                request_limits,
+                max_queue_size=request_queue_size,
+                queue_timeout=request_queue_timeout,
+                adaptive=adaptive_request_limits,
+            )
+            if request_limits is not None
+            else None
+        )
 
         self._generators: Dict[str, Union[Iterator, AsyncGenerator]] = {}
         self._current_generator = lambda: None
@@ -171,7 +280,6 @@ class ModelActor(xo.StatelessActor):
             else asyncio.locks.Lock()
         )
         self._worker_ref = None
-        self._serve_count = 0
         self._metrics_labels = {
             "type": self._model_description.get("model_type", "unknown"),
             "model": self.model_uid(),
@@ -180,6 +288,24 @@ class ModelActor(xo.StatelessActor):
             "quantization": self._model_description.get("quantization", "none"),
         }
         self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._metrics_tasks: Set[asyncio.Task] = set()
+        # Return the latency breakdown in the `timings` field of the responses.
+        self._return_timings = return_timings
+        # Batch the concurrent embedding and rerank requests if `batch_wait_ms` is set.
+        self._embedding_batcher = self._create_batcher(
+            "create_embedding_batch", batch_wait_ms, max_batch_size
+        )
+        self._rerank_batcher = self._create_batcher(
+            "rerank_batch", batch_wait_ms, max_batch_size
+        )
+        # Release the memory of the PyTorch models by the policy, see `MemoryManager`.
+        self._memory_manager = (
+            MemoryManager(
+                memory_release_interval, memory_fragmentation_threshold, max_rss
+            )
+            if isinstance(self._model, (PytorchModel, EmbeddingModel))
+            else None
+        )
 
     async def __post_create__(self):
         self._loop = asyncio.get_running_loop()
@@ -221,6 +347,198 @@ class ModelActor(xo.StatelessActor):
             )
         await asyncio.gather(*coros)
 
+    def _record_admission_metrics(self, queue_time: float):
+        self._record_metrics_in_background(
+            self.record_metrics(
+                "request_queue_time_ms",
+                "observe",
+                {"labels": self._metrics_labels, "value": queue_time},
+            )
+        )
+        self._record_admission_gauges()
+
+    def _record_admission_gauges(self):
+        controller = self._admission_controller
+        assert controller is not None
+        coros = [
+            self.record_metrics(
+                "request_queue_size",
+                "set",
+                {"labels": self._metrics_labels, "value": controller.queue_size},
+            ),
+            self.record_metrics(
+                "request_concurrency_limit",
+                "set",
+                {"labels": self._metrics_labels, "value": controller.limit},
+            ),
+        ]
+        # Do not hold the request for the metrics.
+        self._record_metrics_in_background(asyncio.gather(*coros))
+
+    def _record_metrics_in_background(self, coro: Awaitable):
+        async def _record():
+            try:
+                await coro
+            except Exception:
+                logger.warning(
+                    "Failed to record metrics of the model %s",
+                    self.model_uid(),
+                    exc_info=True,
+                )
+
+        task = asyncio.create_task(_record())
+        self._metrics_tasks.add(task)
+        task.add_done_callback(self._metrics_tasks.discard)
+
+    async def _record_timings_metrics(self, timings: Dict[str, float]):
+        coros = []
+        for key, value in timings.items():
+            labels = {**self._metrics_labels, "stage": key[: -len("_ms")]}
+            coros.append(
+                self.record_metrics(
+                    "request_stage_latency_ms",
+                    "observe",
+                    {"labels": labels, "value": value},
+                )
+            )
+        await asyncio.gather(*coros)
+
+    def _merge_timings(
+        self, timings: Dict[str, float], response: Dict, serialize_time: float
+    ):
+        """
+        Merge the timings reported by the model into `timings`, and keep them
+        in the response only if `return_timings` is set.
+        """
+        model_timings = response.pop("timings", None)
+        if model_timings is None:
+            return
+        queue_time = timings["queue_ms"] + model_timings.get("queue_ms", 0.0)
+        timings.update(model_timings)
+        timings["queue_ms"] = queue_time
+        if self._return_timings:
+            response["timings"] = {**timings, "serialize_ms": serialize_time * 1000}
+
+    def _create_batcher(
+        self, method: str, batch_wait_ms: Optional[float], max_batch_size: int
+    ) -> Optional[RequestBatcher]:
+        if batch_wait_ms is None or not hasattr(self._model, method):
+            return None
+        return RequestBatcher(
+            functools.partial(self._call_batch, getattr(self._model, method)),
+            batch_wait_ms,
+            max_batch_size,
+        )
+
+    @oom_check
+    async def _call_batch(self, fn: Callable, items: List) -> List:
+        """
+        Run a batch of `(args, submit_time)` items, the results carry the time
+        each item waited for the batch to run and the compute time of the batch.
+        """
+
+        def _run():
+            start = time.perf_counter()
+            results = fn([args for args, _ in items])
+            return results, start, time.perf_counter()
+
+        if self._memory_manager is not None:
+            self._memory_manager.request_started()
+        try:
+            if self._lock is None:
+                results, start, end = await asyncio.to_thread(_run)
+            else:
+                async with self._lock:
+                    results, start, end = await asyncio.to_thread(_run)
+            for (_, submit_time), result in zip(items, results):
+                result["timings"] = RequestTimings(
+                    queue_ms=(start - submit_time) * 1000,
+                    compute_ms=(end - start) * 1000,
+                )
+            return results
+        finally:
+            peak_memory = await self._finish_request_async()
+            self._record_metrics_in_background(
+                self._record_finished_request_metrics(peak_memory)
+            )
+
+    def _finish_request(self) -> Optional[int]:
+        """
+        Return the peak memory of the request, if it is tracked. On the event
+        loop, e.g. a stream collected there, the memory is released in a
+        thread instead of blocking the loop.
+        """
+        if self._memory_manager is None:
+            return None
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if not on_loop:
+            return self._memory_manager.request_finished()
+        peak, reason = self._memory_manager.request_finished_deferred()
+        if reason is not None:
+            task = asyncio.create_task(
+                asyncio.to_thread(self._memory_manager.release_by, reason)
+            )
+            self._metrics_tasks.add(task)
+            task.add_done_callback(self._metrics_tasks.discard)
+        return peak
+
+    async def _finish_request_async(self) -> Optional[int]:
+        if self._memory_manager is None:
+            return None
+        # The memory may be released, which takes a while.
+        return await asyncio.to_thread(self._memory_manager.request_finished)
+
+    async def _record_finished_request_metrics(self, peak_memory: Optional[int]):
+        coros = []
+        if peak_memory is not None:
+            coros.append(
+                self.record_metrics(
+                    "request_peak_memory_mb",
+                    "observe",
+                    {"labels": self._metrics_labels, "value": peak_memory / 1024**2},
+                )
+            )
+        # The rolling stats of the speculative decoding models.
+        stats = getattr(self._model, "spec_decoding_stats", None) or {}
+        for key, name in [
+            ("acceptance_rate", "spec_decoding_acceptance_rate"),
+            ("tokens_per_forward", "spec_decoding_tokens_per_forward"),
+            ("gamma", "spec_decoding_draft_length"),
+        ]:
+            if key in stats:
+                coros.append(
+                    self.record_metrics(
+                        name,
+                        "set",
+                        {"labels": self._metrics_labels, "value": stats[key]},
+                    )
+                )
+        await asyncio.gather(*coros)
+
+    async def _record_aborted_metrics(self):
+        await self.record_metrics(
+            "aborted_requests_total_counter",
+            "add",
+            {"labels": self._metrics_labels, "value": 1},
+        )
+
+    async def __xoscar_destroy_generator__(self, generator_uid: str):
+        # The generator is destroyed early if the client disconnects,
+        # close it to stop the generation instead of waiting for the GC.
+        gen = self._generators.get(generator_uid)
+        await super().__xoscar_destroy_generator__(generator_uid)
+        if inspect.isgenerator(gen) and not gen.gi_running:
+            # Closing runs the cleanup of the request, e.g. a memory release.
+            await asyncio.to_thread(gen.close)
+        elif inspect.isasyncgen(gen) and not gen.ag_running:
+            await gen.aclose()
+        # Otherwise, the generator is running a step in another task or thread,
+        # and it is closed as soon as the step finishes and the last reference
+        # to it is dropped.
+
     async def _get_worker_ref(self) -> xo.ActorRefType["WorkerActor"]:
         from .worker import WorkerActor
 
@@ -238,6 +556,16 @@ class ModelActor(xo.StatelessActor):
     def load(self):
         self._model.load()
 
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        The stats measured by the model at load time, e.g. those of the CPU
+        mode, the worker reads them once the model is loaded.
+        """
+        stats: Dict[str, Any] = {}
+        for name in ["cpu_mode_stats", "compile_stats"]:
+            stats.update(getattr(self._model, name, None) or {})
+        return stats
+
     def model_uid(self):
         return (
             self._model.model_uid
@@ -249,23 +577,47 @@ class ModelActor(xo.StatelessActor):
             )
         )
 
-    def _to_json_generator(self, gen: types.GeneratorType):
+    def _to_json_generator(
+        self,
+        gen: types.GeneratorType,
+        queue_time: float = 0.0,
+        slot: Optional[_AdmissionSlot] = None,
+    ):
         start_time = time.time()
         time_to_first_token = None
         final_usage = None
+        aborted = False
+        timings = {"queue_ms": queue_time}
+        serialize_time = 0.0
+        if self._memory_manager is not None:
+            self._memory_manager.request_started()
         try:
             for v in gen:
                 if time_to_first_token is None:
                     time_to_first_token = (time.time() - start_time) * 1000
                 final_usage = v.pop("usage", None)
-                v = dict(data=json.dumps(v))
-                yield sse_starlette.sse.ensure_bytes(v, None)
+                self._merge_timings(timings, v, serialize_time)
+                serialize_start = time.perf_counter()
+                frame = sse_frame(v)
+                serialize_time += time.perf_counter() - serialize_start
+                yield frame
+        except GeneratorExit:
+            # The stream is closed before the end, e.g. the client disconnected.
+            aborted = True
+            raise
         except OutOfMemoryError:
             logger.exception(
                 "Model actor is out of memory, model id: %s", self.model_uid()
             )
             os._exit(1)
         finally:
+            # Stop the generation right away rather than on garbage collection.
+            gen.close()
+            if slot is not None:
+                slot.release()
+            if self._loop is not None and aborted:
+                coro = self._record_aborted_metrics()
+                asyncio.run_coroutine_threadsafe(coro, loop=self._loop)
             if self._loop is not None and time_to_first_token is not None:
                 coro = self.record_metrics(
                     "time_to_first_token",
@@ -280,26 +632,58 @@ class ModelActor(xo.StatelessActor):
                     prompt_tokens=final_usage["prompt_tokens"],
                 )
                 asyncio.run_coroutine_threadsafe(coro, loop=self._loop)
+            if self._loop is not None:
+                timings["serialize_ms"] = serialize_time * 1000
+                coro = self._record_timings_metrics(timings)
+                asyncio.run_coroutine_threadsafe(coro, loop=self._loop)
+            peak_memory = self._finish_request()
+            if self._loop is not None:
+                coro = self._record_finished_request_metrics(peak_memory)
+                asyncio.run_coroutine_threadsafe(coro, loop=self._loop)
 
-    async def _to_json_async_gen(self, gen: types.AsyncGeneratorType):
+    async def _to_json_async_gen(
+        self,
+        gen: types.AsyncGeneratorType,
+        queue_time: float = 0.0,
+        slot: Optional[_AdmissionSlot] = None,
+    ):
         start_time = time.time()
         time_to_first_token = None
         final_usage = None
+        aborted = False
+        timings = {"queue_ms": queue_time}
+        serialize_time = 0.0
+        if self._memory_manager is not None:
+            self._memory_manager.request_started()
         try:
             async for v in gen:
                 if time_to_first_token is None:
                     time_to_first_token = (time.time() - start_time) * 1000
                 final_usage = v.pop("usage", None)
-                v = await asyncio.to_thread(json.dumps, v)
-                v = dict(data=v)  # noqa: F821
-                yield await asyncio.to_thread(sse_starlette.sse.ensure_bytes, v, None)
+                self._merge_timings(timings, v, serialize_time)
+                # Serializing a chunk takes a few microseconds, much less than
+                # a hop to the thread pool.
+                serialize_start = time.perf_counter()
+                frame = sse_frame(v)
+                serialize_time += time.perf_counter() - serialize_start
+                yield frame
+        except (GeneratorExit, asyncio.CancelledError):
+            # The stream is closed before the end, e.g. the client disconnected.
+            aborted = True
+            raise
         except OutOfMemoryError:
             logger.exception(
                 "Model actor is out of memory, model id: %s", self.model_uid()
             )
             os._exit(1)
         finally:
+            # Stop the generation right away rather than on garbage collection.
+            await gen.aclose()
+            if slot is not None:
+                slot.release()
             coros = []
+            if aborted:
+                coros.append(self._record_aborted_metrics())
             if time_to_first_token is not None:
                 coros.append(
                     self.record_metrics(
@@ -316,34 +700,80 @@ class ModelActor(xo.StatelessActor):
                         prompt_tokens=final_usage["prompt_tokens"],
                     )
                 )
+            timings["serialize_ms"] = serialize_time * 1000
+            coros.append(self._record_timings_metrics(timings))
+            peak_memory = await self._finish_request_async()
+            coros.append(self._record_finished_request_metrics(peak_memory))
             await asyncio.gather(*coros)
 
+    @staticmethod
+    def _hold_admission_slot(gen, slot: Optional[_AdmissionSlot]):
+        """
+        Hold the admission slot until the stream finishes. A generator which is
+        destroyed before its first step never runs its `finally`, so the slot
+        is also released when the generator is collected.
+        """
+        if slot is not None:
+            slot.deferred = True
+            weakref.finalize(gen, slot.release)
+
     @oom_check
     async def _call_wrapper(self, fn: Callable, *args, **kwargs):
-        if self._lock is None:
-            if inspect.iscoroutinefunction(fn):
-                ret = await fn(*args, **kwargs)
-            else:
-                ret = await asyncio.to_thread(fn, *args, **kwargs)
-        else:
-            async with self._lock:
+        if self._memory_manager is not None:
+            self._memory_manager.request_started()
+        try:
+            if self._lock is None:
                 if inspect.iscoroutinefunction(fn):
                     ret = await fn(*args, **kwargs)
                 else:
                     ret = await asyncio.to_thread(fn, *args, **kwargs)
-
-        if self._lock is not None and self._current_generator():
-            raise Exception("Parallel generation is not supported by ggml.")
-
+            else:
+                async with self._lock:
+                    if inspect.iscoroutinefunction(fn):
+                        ret = await fn(*args, **kwargs)
+                    else:
+                        ret = await asyncio.to_thread(fn, *args, **kwargs)
+
+            if self._lock is not None and self._current_generator():
+                raise Exception("Parallel generation is not supported by ggml.")
+        except BaseException:
+            await self._finish_request_async()
+            raise
+
+        queue_time = _request_queue_time_ms.get()
+        if (
+            inspect.isgenerator(ret) or inspect.isasyncgen(ret)
+        ) and self._memory_manager is not None:
+            # The generator runs the request, it is tracked from its first step.
+            self._memory_manager.request_cancelled()
+        slot = _request_admission_slot.get()
         if inspect.isgenerator(ret):
-            gen = self._to_json_generator(ret)
+            gen = self._to_json_generator(ret, queue_time, slot)
             self._current_generator = weakref.ref(gen)
+            self._hold_admission_slot(gen, slot)
             return gen
         if inspect.isasyncgen(ret):
-            gen = self._to_json_async_gen(ret)
+            gen = self._to_json_async_gen(ret, queue_time, slot)
             self._current_generator = weakref.ref(gen)
+            self._hold_admission_slot(gen, slot)
             return gen
-        return await asyncio.to_thread(json_dumps, ret)
+        peak_memory = await self._finish_request_async()
+        self._record_metrics_in_background(
+            self._record_finished_request_metrics(peak_memory)
+        )
+        if not isinstance(ret, dict):
+            return await asyncio.to_thread(json_dumps, ret)
+        return await self._serialize_response(ret, queue_time)
+
+    async def _serialize_response(self, ret: Dict, queue_time: float) -> bytes:
+        timings = {"queue_ms": queue_time}
+        self._merge_timings(timings, ret, 0.0)
+        serialize_start = time.perf_counter()
+        data = await asyncio.to_thread(json_dumps, ret)
+        timings["serialize_ms"] = (time.perf_counter() - serialize_start) * 1000
+        # Do not hold the response for the metrics.
+        self._record_metrics_in_background(self._record_timings_metrics(timings))
+        return data
 
     @log_async(logger=logger)
     @request_limit
@@ -391,11 +821,29 @@ class ModelActor(xo.StatelessActor):
                 )
 
     @log_async(logger=logger)
-    @request_limit
+    @request_limit(priority=RequestPriority.BATCH)
     async def create_embedding(self, input: Union[str, List[str]], *args, **kwargs):
+        if (
+            self._embedding_batcher is not None
+            and not args
+            and set(kwargs) <= {"encoding_format"}
+        ):
+            from ..model.embedding.core import check_encoding_format
+
+            encoding_format = kwargs.get("encoding_format", "float")
+            # Check it before batching, otherwise the whole batch fails.
+            check_encoding_format(encoding_format)
+            size = 1 if isinstance(input, str) else len(input)
+            ret = await self._embedding_batcher.submit(
+                ((input, encoding_format), time.perf_counter()), size
+            )
+            return await self._serialize_response(ret, _request_queue_time_ms.get())
         if hasattr(self._model, "create_embedding"):
             return await self._call_wrapper(
-                self._model.create_embedding, input, *args, **kwargs
+                _with_compute_time(self._model.create_embedding),
+                input,
+                *args,
+                **kwargs,
             )
 
         raise AttributeError(
@@ -403,7 +851,7 @@ class ModelActor(xo.StatelessActor):
         )
 
     @log_async(logger=logger)
-    @request_limit
+    @request_limit(priority=RequestPriority.BATCH)
     async def rerank(
         self,
         documents: List[str],
@@ -414,9 +862,23 @@ class ModelActor(xo.StatelessActor):
         *args,
         **kwargs,
     ):
+        if (
+            self._rerank_batcher is not None
+            and max_chunks_per_doc is None
+            and not args
+            and not kwargs
+        ):
+            ret = await self._rerank_batcher.submit(
+                (
+                    (documents, query, top_n, max_chunks_per_doc, return_documents),
+                    time.perf_counter(),
+                ),
+                len(documents),
+            )
+            return await self._serialize_response(ret, _request_queue_time_ms.get())
         if hasattr(self._model, "rerank"):
             return await self._call_wrapper(
-                self._model.rerank,
+                _with_compute_time(self._model.rerank),
                 documents,
                 query,
                 top_n,
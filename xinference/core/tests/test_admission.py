@@ -0,0 +1,92 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from ..admission import AdmissionController, RequestPriority
+
+
+@pytest.mark.asyncio
+async def test_admission_queue():
+    controller = AdmissionController(1, max_queue_size=2, queue_timeout=0.5)
+    await controller.acquire()
+
+    served = []
+
+    async def _request(priority, name):
+        await controller.acquire(priority)
+        served.append(name)
+        await asyncio.sleep(0.01)
+        controller.release()
+
+    batch = asyncio.create_task(_request(RequestPriority.BATCH, "batch"))
+    await asyncio.sleep(0)
+    chat = asyncio.create_task(_request(RequestPriority.INTERACTIVE, "chat"))
+    await asyncio.sleep(0)
+    assert controller.queue_size == 2
+
+    # The queue is full.
+    with pytest.raises(RuntimeError, match="Rate limit reached"):
+        await controller.acquire()
+
+    controller.release()
+    await asyncio.gather(batch, chat)
+    assert served == ["chat", "batch"]
+    assert controller.serve_count == 0
+    assert controller.queue_size == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_timeout_and_cancel():
+    controller = AdmissionController(1, max_queue_size=1, queue_timeout=0.1)
+    await controller.acquire()
+    with pytest.raises(RuntimeError, match="timed out"):
+        await controller.acquire()
+    assert controller.queue_size == 0
+
+    task = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert controller.queue_size == 0
+
+    controller.release()
+    assert controller.serve_count == 0
+
+    # Immediate rejection without a queue.
+    controller = AdmissionController(0)
+    with pytest.raises(RuntimeError, match="Rate limit reached"):
+        await controller.acquire()
+
+
+@pytest.mark.asyncio
+async def test_admission_adaptive_limit():
+    controller = AdmissionController(8, adaptive=True)
+
+    async def _window(latency):
+        n = controller.limit
+        for _ in range(n):
+            await controller.acquire()
+        for _ in range(n):
+            controller.release(latency)
+
+    await _window(1.0)
+    assert controller.limit == 8
+    await _window(5.0)
+    assert controller.limit == 6
+    await _window(1.0)
+    assert controller.limit == 7
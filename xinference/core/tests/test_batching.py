@@ -0,0 +1,60 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from ..batching import RequestBatcher
+
+
+@pytest.mark.asyncio
+async def test_request_batcher():
+    batches = []
+
+    async def _fn(items):
+        batches.append(items)
+        if "error" in items:
+            raise ValueError("bad item")
+        return [item.upper() for item in items]
+
+    batcher = RequestBatcher(_fn, wait_ms=10, max_batch_size=4)
+    results = await asyncio.gather(*[batcher.submit(s) for s in "abc"])
+    assert results == ["A", "B", "C"]
+    assert batches == [["a", "b", "c"]]
+
+    # Flushed by the batch size, a request is never split.
+    batches.clear()
+    results = await asyncio.gather(
+        batcher.submit("ab", 2),
+        batcher.submit("cd", 2),
+        batcher.submit("efghi", 5),
+        batcher.submit("j"),
+    )
+    assert results == ["AB", "CD", "EFGHI", "J"]
+    assert batches == [["ab", "cd"], ["efghi"], ["j"]]
+
+    # An error fails the whole batch.
+    results = await asyncio.gather(
+        batcher.submit("error"), batcher.submit("k"), return_exceptions=True
+    )
+    assert all(isinstance(r, ValueError) for r in results)
+
+    # The cancelled requests are skipped.
+    batches.clear()
+    task = asyncio.create_task(batcher.submit("l"))
+    await asyncio.sleep(0)
+    task.cancel()
+    assert await batcher.submit("m") == "M"
+    assert batches == [["m"]]
@@ -0,0 +1,140 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from ..memory import MIN_UNUSED_DEVICE_MEMORY, MemoryManager
+
+
+class _FakeDevice:
+    def __init__(self):
+        self.allocated = 0
+        self.reserved = 0
+        self.peak = 0
+        self.num_resets = 0
+
+    def memory_allocated(self):
+        return self.allocated
+
+    def memory_reserved(self):
+        return self.reserved
+
+    def max_memory_allocated(self):
+        return self.peak
+
+    def reset_peak_memory_stats(self):
+        self.num_resets += 1
+        self.peak = self.allocated
+
+
+class _FakeProcessMemory(_FakeDevice):
+    def rss(self):
+        return self.allocated
+
+
+@pytest.fixture
+def releases(monkeypatch):
+    releases = []
+    monkeypatch.setattr(
+        MemoryManager, "release", staticmethod(lambda: releases.append(1))
+    )
+    return releases
+
+
+def test_memory_manager(releases):
+    manager = MemoryManager(release_interval=3)
+    device = manager._device = _FakeDevice()
+
+    manager.request_started()
+    device.peak = 100
+    manager.request_started()
+    manager.request_cancelled()
+    assert manager.request_finished() == 100
+    assert not releases
+
+    # The peak stats are reset only when no request is running.
+    manager.request_started()
+    manager.request_started()
+    assert device.num_resets == 2
+    assert manager.request_finished() == 0
+    assert manager.request_finished() == 0
+    assert len(releases) == 1
+
+    # Released if the allocator holds too much unused memory.
+    device.reserved = 4 * MIN_UNUSED_DEVICE_MEMORY
+    device.allocated = 3 * MIN_UNUSED_DEVICE_MEMORY
+    manager.request_started()
+    manager.request_finished()
+    assert len(releases) == 1
+    device.allocated = MIN_UNUSED_DEVICE_MEMORY
+    manager.request_started()
+    manager.request_finished()
+    assert len(releases) == 2
+
+
+def test_memory_manager_cpu(releases):
+    manager = MemoryManager()
+    manager._device = None
+    memory = manager._process_memory = _FakeProcessMemory()
+    memory.allocated = 4 * MIN_UNUSED_DEVICE_MEMORY
+
+    # The peak RSS is reported without a device allocator.
+    manager.request_started()
+    memory.peak = 5 * MIN_UNUSED_DEVICE_MEMORY
+    assert manager.request_finished() == 5 * MIN_UNUSED_DEVICE_MEMORY
+    assert not releases
+
+    # Released once the RSS grows by more than half since the last release.
+    manager.request_started()
+    memory.allocated = 7 * MIN_UNUSED_DEVICE_MEMORY
+    manager.request_finished()
+    assert len(releases) == 1
+    manager.request_started()
+    manager.request_finished()
+    assert len(releases) == 1
+
+    # The release is left to the caller.
+    memory.allocated = 11 * MIN_UNUSED_DEVICE_MEMORY
+    manager.request_started()
+    _, reason = manager.request_finished_deferred()
+    assert reason is not None and len(releases) == 1
+    manager.release_by(reason)
+    assert len(releases) == 2
+
+
+def test_process_memory():
+    from ..memory import _ProcessMemory
+
+    memory = _ProcessMemory()
+    memory.reset_peak_memory_stats()
+    data = bytearray(64 * 1024**2)
+    assert memory.max_memory_allocated() >= memory.rss() > 0
+    del data
+
+
+def test_memory_manager_max_rss(releases):
+    manager = MemoryManager(max_rss=1)
+    manager.request_started()
+    manager.request_finished()
+    assert len(releases) == 1
+
+    manager = MemoryManager(max_rss=1 << 60)
+    manager.request_started()
+    manager.request_finished()
+    assert not releases[1:]
+
+    with pytest.raises(ValueError):
+        MemoryManager(release_interval=-1)
+    with pytest.raises(ValueError):
+        MemoryManager(fragmentation_threshold=0)
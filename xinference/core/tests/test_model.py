@@ -0,0 +1,215 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import gc
+import json
+import threading
+
+import pytest
+import pytest_asyncio
+import xoscar as xo
+from xoscar import create_actor_pool
+
+from ..model import ModelActor
+
+_MAX_TOKENS = 1000
+_generated_tokens = 0
+_generator_closed = threading.Event()
+
+
+class MockStreamModel:
+    model_uid = "mock-stream"
+
+    def generate(self, prompt: str, generate_config=None):
+        def _gen():
+            global _generated_tokens
+
+            try:
+                for i in range(_MAX_TOKENS):
+                    _generated_tokens += 1
+                    yield {"id": prompt, "choices": [{"index": 0, "text": str(i)}]}
+            finally:
+                _generator_closed.set()
+
+        return _gen()
+
+
+@pytest_asyncio.fixture
+async def setup_pool():
+    pool = await create_actor_pool(
+        f"test://127.0.0.1:{xo.utils.get_next_port()}", n_process=0
+    )
+    async with pool:
+        yield pool
+
+
+@pytest.mark.asyncio
+async def test_model_actor_abort_stream(setup_pool):
+    pool = setup_pool
+    model_ref = await xo.create_actor(
+        ModelActor,
+        address=pool.external_address,
+        uid=MockStreamModel.model_uid,
+        worker_address=pool.external_address,
+        model=MockStreamModel(),
+    )
+
+    gen = await model_ref.generate("hello", {"stream": True})
+    num_chunks = 0
+    async for _ in gen:
+        num_chunks += 1
+        if num_chunks == 3:
+            break
+    # The client disconnects.
+    await gen.destroy()
+
+    assert await asyncio.to_thread(_generator_closed.wait, 5)
+    assert _generated_tokens < _MAX_TOKENS
+
+
+class MockTimingsModel:
+    model_uid = "mock-timings"
+
+    def generate(self, prompt: str, generate_config=None):
+        chunk = {"id": prompt, "choices": [{"index": 0, "text": "a"}]}
+        timings = {"tokenize_ms": 1.0, "prefill_ms": 2.0, "decode_ms": 3.0}
+        if generate_config and generate_config.get("stream"):
+
+            def _gen():
+                yield dict(chunk)
+                yield dict(chunk, timings=timings)
+
+            return _gen()
+        return dict(chunk, timings=timings)
+
+
+@pytest.mark.asyncio
+async def test_model_actor_return_timings(setup_pool):
+    pool = setup_pool
+    model_ref = await xo.create_actor(
+        ModelActor,
+        address=pool.external_address,
+        uid=MockTimingsModel.model_uid,
+        worker_address=pool.external_address,
+        model=MockTimingsModel(),
+        request_limits=1,
+        return_timings=True,
+    )
+
+    ret = json.loads(await model_ref.generate("hello"))
+    assert ret["timings"]["prefill_ms"] == 2.0
+    assert ret["timings"]["queue_ms"] >= 0
+
+    gen = await model_ref.generate("hello", {"stream": True})
+    chunks = [json.loads(frame[len(b"data: ") :]) async for frame in gen]
+    assert "timings" not in chunks[0]
+    assert set(chunks[-1]["timings"]) == {
+        "queue_ms",
+        "tokenize_ms",
+        "prefill_ms",
+        "decode_ms",
+        "serialize_ms",
+    }
+
+
+class MockEmbeddingModel:
+    model_uid = "mock-embedding"
+
+    def create_embedding(self, input, encoding_format="float"):
+        return self.create_embedding_batch([(input, encoding_format)])[0]
+
+    def create_embedding_batch(self, requests):
+        return [{"object": "list", "data": [], "model": inp} for inp, _ in requests]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("batch_wait_ms", [None, 10])
+async def test_model_actor_embedding_timings(setup_pool, batch_wait_ms):
+    pool = setup_pool
+    model_ref = await xo.create_actor(
+        ModelActor,
+        address=pool.external_address,
+        uid=MockEmbeddingModel.model_uid,
+        worker_address=pool.external_address,
+        model=MockEmbeddingModel(),
+        batch_wait_ms=batch_wait_ms,
+        return_timings=True,
+    )
+
+    results = await asyncio.gather(
+        *[model_ref.create_embedding(text) for text in ["a", "b"]]
+    )
+    for text, ret in zip(["a", "b"], map(json.loads, results)):
+        assert ret["model"] == text
+        assert set(ret["timings"]) == {"queue_ms", "compute_ms", "serialize_ms"}
+        assert ret["timings"]["queue_ms"] >= 0
+
+
+class MockShortStreamModel:
+    model_uid = "mock-short-stream"
+
+    def generate(self, prompt: str, generate_config=None):
+        def _gen():
+            for i in range(3):
+                yield {"id": prompt, "choices": [{"index": 0, "text": str(i)}]}
+
+        return _gen()
+
+
+async def _wait_released(model_ref, timeout: float = 5):
+    # The stream releases its slot on the event loop after its last step.
+    for _ in range(int(timeout / 0.01)):
+        try:
+            return await model_ref.generate("probe", {"stream": True})
+        except Exception as e:
+            if "Rate limit" not in str(e):
+                raise
+            await asyncio.sleep(0.01)
+    raise AssertionError("The admission slot is not released.")
+
+
+@pytest.mark.asyncio
+async def test_model_actor_stream_holds_admission_slot(setup_pool):
+    pool = setup_pool
+    model_ref = await xo.create_actor(
+        ModelActor,
+        address=pool.external_address,
+        uid=MockShortStreamModel.model_uid,
+        worker_address=pool.external_address,
+        model=MockShortStreamModel(),
+        request_limits=1,
+    )
+
+    gen = await model_ref.generate("hello", {"stream": True})
+    await gen.__anext__()
+    # The running stream holds the only slot.
+    with pytest.raises(Exception, match="Rate limit"):
+        await asyncio.wait_for(model_ref.generate("hello", {"stream": True}), 5)
+    async for _ in gen:
+        pass
+    await gen.destroy()
+
+    # Released once exhausted.
+    gen = await _wait_released(model_ref)
+    with pytest.raises(Exception, match="Rate limit"):
+        await asyncio.wait_for(model_ref.generate("hello", {"stream": True}), 5)
+    # Released if destroyed before its first step.
+    await gen.destroy()
+    gen = await _wait_released(model_ref)
+    await gen.destroy()
+    # Collect the iterator wrappers which destroy their generators on GC,
+    # before the pool is closed.
+    del gen
+    gc.collect()
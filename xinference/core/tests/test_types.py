@@ -18,10 +18,12 @@ from ...types import (
     CreateChatCompletion,
     CreateChatCompletionCTransformers,
     CreateChatCompletionLlamaCpp,
+    CreateChatCompletionSpeculative,
     CreateChatCompletionTorch,
     CreateCompletion,
     CreateCompletionCTransformers,
     CreateCompletionLlamaCpp,
+    CreateCompletionSpeculative,
     CreateCompletionTorch,
     _CreateCompletionOpenAIFallback,
 )
@@ -66,9 +68,15 @@ def test_create_completion_types():
         CreateCompletion(model="abc", prompt="def", not_exist="jdk")
 
     CreateCompletion(model="abc", prompt="def")
+    # The options of speculative decoding.
+    assert CreateCompletion(model="abc", prompt="def", gamma=3).gamma == 3
+    with pytest.raises(ValidationError):
+        CreateCompletion(model="abc", prompt="def", gamma=0)
+    assert CreateCompletion(model="abc", prompt="def", num_branches=2).num_branches == 2
 
     types = [
         CreateCompletionTorch,
+        CreateCompletionSpeculative,
         CreateCompletionLlamaCpp,
         CreateCompletionCTransformers,
     ]
@@ -95,6 +103,7 @@ def test_create_chat_completion_types():
 
     types = [
         CreateChatCompletionTorch,
+        CreateChatCompletionSpeculative,
         CreateChatCompletionLlamaCpp,
         CreateChatCompletionCTransformers,
     ]
@@ -111,3 +120,4 @@ def test_create_chat_completion_types():
     assert CreateChatCompletionCTransformers is CreateCompletionCTransformers
     assert CreateChatCompletionLlamaCpp is CreateCompletionLlamaCpp
     assert CreateChatCompletionTorch is CreateCompletionTorch
+    assert CreateChatCompletionSpeculative is CreateCompletionSpeculative
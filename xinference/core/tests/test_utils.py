@@ -12,10 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+
+import sse_starlette.sse
+
 from ..utils import (
     build_replica_model_uid,
     iter_replica_model_uid,
     parse_replica_model_uid,
+    sse_frame,
 )
 
 
@@ -29,3 +34,17 @@ def test_replica_model_uid():
         all_gen_ids.append(replica_model_uid)
     assert len(all_gen_ids) == 5
     assert len(set(all_gen_ids)) == 5
+
+
+def test_sse_frame():
+    chunk = {
+        "id": "cmpl-1",
+        "object": "text_completion",
+        "choices": [{"index": 0, "text": "你好\n", "finish_reason": None}],
+    }
+    frame = sse_frame(chunk)
+    expected = sse_starlette.sse.ensure_bytes(dict(data=json.dumps(chunk)), None)
+    assert frame.startswith(b"data: ")
+    assert frame.endswith(b"\r\n\r\n")
+    assert frame.count(b"\n") == expected.count(b"\n")
+    assert json.loads(frame[len(b"data: ") :]) == chunk
@@ -122,6 +122,15 @@ def json_dumps(o):
     return orjson.dumps(o, default=_default)
 
 
+def sse_frame(o) -> bytes:
+    """
+    Serialize `o` to a server-sent event of its JSON, framed the same as
+    `sse_starlette.sse.ensure_bytes(dict(data=json.dumps(o)), None)`.
+    The JSON has no line breaks, so it fits in a single `data` field.
+    """
+    return b"data: " + json_dumps(o) + b"\r\n\r\n"
+
+
 def purge_dir(d):
     if not os.path.exists(d) or not os.path.isdir(d):
         return
@@ -72,6 +72,8 @@ class WorkerActor(xo.StatelessActor):
         # internal states.
         self._model_uid_to_model: Dict[str, xo.ActorRefType["ModelActor"]] = {}
         self._model_uid_to_model_spec: Dict[str, ModelDescription] = {}
+        # The stats measured by the models at load time, e.g. the CPU mode.
+        self._model_uid_to_model_stats: Dict[str, Dict[str, Any]] = {}
         self._gpu_to_model_uid: Dict[int, str] = {}
         self._gpu_to_embedding_model_uids: Dict[int, Set[str]] = defaultdict(set)
         self._model_uid_to_addr: Dict[str, str] = {}
@@ -436,6 +438,7 @@ class WorkerActor(xo.StatelessActor):
                 model_description=model_description,
             )
             await model_ref.load()
+            model_stats = await model_ref.get_stats()
         except:
             logger.error(f"Failed to load model {model_uid}", exc_info=True)
             self.release_devices(model_uid=model_uid)
@@ -444,6 +447,7 @@ class WorkerActor(xo.StatelessActor):
 
         self._model_uid_to_model[model_uid] = model_ref
         self._model_uid_to_model_spec[model_uid] = model_description
+        self._model_uid_to_model_stats[model_uid] = model_stats
         for dev in devices:
             self._gpu_to_model_uid[int(dev)] = model_uid
         self._model_uid_to_addr[model_uid] = subpool_address
@@ -492,6 +496,15 @@ class WorkerActor(xo.StatelessActor):
         model_type: str = "LLM",
         n_gpu: Optional[Union[int, str]] = "auto",
         request_limits: Optional[int] = None,
+        request_queue_size: int = 0,
+        request_queue_timeout: Optional[float] = None,
+        adaptive_request_limits: bool = False,
+        batch_wait_ms: Optional[float] = None,
+        max_batch_size: int = 32,
+        return_timings: bool = False,
+        memory_release_interval: int = 0,
+        memory_fragmentation_threshold: float = 0.5,
+        max_rss: Optional[int] = None,
         **kwargs,
     ):
         event_model_uid, _, __ = parse_replica_model_uid(model_uid)
@@ -549,8 +562,18 @@ class WorkerActor(xo.StatelessActor):
                 model=model,
                 model_description=model_description,
                 request_limits=request_limits,
+                request_queue_size=request_queue_size,
+                request_queue_timeout=request_queue_timeout,
+                adaptive_request_limits=adaptive_request_limits,
+                batch_wait_ms=batch_wait_ms,
+                max_batch_size=max_batch_size,
+                return_timings=return_timings,
+                memory_release_interval=memory_release_interval,
+                memory_fragmentation_threshold=memory_fragmentation_threshold,
+                max_rss=max_rss,
             )
             await model_ref.load()
+            model_stats = await model_ref.get_stats()
         except:
             logger.error(f"Failed to load model {model_uid}", exc_info=True)
             self.release_devices(model_uid=model_uid)
@@ -559,6 +582,7 @@ class WorkerActor(xo.StatelessActor):
 
         self._model_uid_to_model[model_uid] = model_ref
         self._model_uid_to_model_spec[model_uid] = model_description
+        self._model_uid_to_model_stats[model_uid] = model_stats
         self._model_uid_to_addr[model_uid] = subpool_address
         self._model_uid_to_recover_count.setdefault(
             model_uid, MODEL_ACTOR_AUTO_RECOVER_LIMIT
@@ -607,6 +631,7 @@ class WorkerActor(xo.StatelessActor):
         finally:
             self._model_uid_to_model.pop(model_uid, None)
             self._model_uid_to_model_spec.pop(model_uid, None)
+            self._model_uid_to_model_stats.pop(model_uid, None)
             self.release_devices(model_uid)
             self._model_uid_to_addr.pop(model_uid, None)
             self._model_uid_to_recover_count.pop(model_uid, None)
@@ -636,7 +661,9 @@ class WorkerActor(xo.StatelessActor):
         model_desc = self._model_uid_to_model_spec.get(model_uid, None)
         if model_desc is None:
             raise ValueError(f"Model not found in the model list, uid: {model_uid}")
-        return model_desc.to_dict()
+        info = model_desc.to_dict()
+        info.update(self._model_uid_to_model_stats.get(model_uid, {}))
+        return info
 
     async def report_status(self):
         status = dict()
@@ -70,6 +70,34 @@ stop_field = Field(
     description="A list of tokens at which to stop generation. If None, no stop tokens are used.",
 )
 
+n_field = Field(
+    default=1,
+    ge=1,
+    description="How many completions to generate for the prompt.",
+)
+
+best_of_field = Field(
+    default=None,
+    ge=1,
+    description="Generate best_of completions and return the n ones with the highest "
+    "log probability per token. It must not be less than n, and it cannot be used "
+    "with stream unless it equals n.",
+)
+
+gamma_field = Field(
+    default=None,
+    ge=1,
+    description="The number of draft tokens per round of speculative decoding. "
+    "If None, it is adapted to the acceptance rate of the draft tokens.",
+)
+
+num_branches_field = Field(
+    default=1,
+    ge=1,
+    description="The number of branches of the token tree drafted per round of "
+    "speculative decoding, each extended to gamma tokens.",
+)
+
 stream_field = Field(
     default=False,
     description="Whether to stream the results as they are generated. Useful for chatbots.",
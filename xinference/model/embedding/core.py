@@ -12,12 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
 import logging
 from collections import defaultdict
 from typing import Dict, List, Optional, Tuple, Union, no_type_check
 
 import numpy as np
 
+from ...constants import EMBEDDING_BASE64_DTYPES
 from ...types import Embedding, EmbeddingData, EmbeddingUsage
 from ..core import CacheableModelSpec, ModelDescription
 from ..utils import get_cache_dir, is_model_cached
@@ -30,6 +32,24 @@ MODEL_NAME_TO_REVISION: Dict[str, List[str]] = defaultdict(list)
 EMBEDDING_MODEL_DESCRIPTIONS: Dict[str, List[Dict]] = defaultdict(list)
 
 
+def check_encoding_format(encoding_format: str):
+    if encoding_format != "float" and encoding_format not in EMBEDDING_BASE64_DTYPES:
+        raise ValueError(
+            f"Unsupported encoding format: {encoding_format}, "
+            f"available formats: {['float'] + list(EMBEDDING_BASE64_DTYPES)}"
+        )
+
+
+def encode_embedding(
+    data: np.ndarray, encoding_format: str = "float"
+) -> Union[List[float], str]:
+    """Encode an embedding vector as a list of floats or a base64 string."""
+    if encoding_format == "float":
+        return data.tolist()
+    dtype = EMBEDDING_BASE64_DTYPES[encoding_format]
+    return base64.b64encode(data.astype(dtype).tobytes()).decode("ascii")
+
+
 def get_embedding_model_descriptions():
     import copy
 
@@ -133,9 +153,28 @@ class EmbeddingModel:
         patch_trust_remote_code()
         self._model = SentenceTransformer(self._model_path, device=self._device)
 
-    def create_embedding(self, sentences: Union[str, List[str]], **kwargs):
+    def create_embedding(
+        self,
+        sentences: Union[str, List[str]],
+        encoding_format: str = "float",
+        **kwargs,
+    ):
+        return self.create_embedding_batch([(sentences, encoding_format)], **kwargs)[0]
+
+    def create_embedding_batch(
+        self, requests: List[Tuple[Union[str, List[str]], str]], **kwargs
+    ) -> List[Embedding]:
+        """
+        Create the embeddings of many requests in one `encode` call, each request
+        is a tuple of `(input, encoding_format)`. The sentences of all the requests
+        are sorted by length and batched together.
+        """
+        import torch
         from sentence_transformers import SentenceTransformer
 
+        for _, encoding_format in requests:
+            check_encoding_format(encoding_format)
+
         normalize_embeddings = kwargs.pop("normalize_embeddings", True)
 
         # copied from sentence-transformers, and modify it to return tokens num
@@ -197,7 +236,7 @@ class EmbeddingModel:
             model.to(device)
 
             all_embeddings = []
-            all_token_nums = 0
+            all_token_nums = []
             length_sorted_idx = np.argsort(
                 [-model._text_length(sen) for sen in sentences]
             )
@@ -215,7 +254,13 @@ class EmbeddingModel:
                 ]
                 features = model.tokenize(sentences_batch)
                 features = batch_to_device(features, device)
-                all_token_nums += sum([len(f) for f in features])
+                if "attention_mask" in features:
+                    token_nums = features["attention_mask"].sum(dim=1).tolist()
+                    all_token_nums.extend(token_nums)
+                else:
+                    all_token_nums.extend(
+                        [features["input_ids"].shape[1]] * len(sentences_batch)
+                    )
 
                 with torch.no_grad():
                     out_features = model.forward(features)
@@ -257,6 +302,9 @@ class EmbeddingModel:
             all_embeddings = [
                 all_embeddings[idx] for idx in np.argsort(length_sorted_idx)
             ]
+            all_token_nums = [
+                all_token_nums[idx] for idx in np.argsort(length_sorted_idx)
+            ]
 
             if convert_to_tensor:
                 all_embeddings = torch.stack(all_embeddings)
@@ -268,6 +316,12 @@ class EmbeddingModel:
 
             return all_embeddings, all_token_nums
 
+        sentences = []
+        for input, _ in requests:
+            if isinstance(input, str):
+                sentences.append(input)
+            else:
+                sentences.extend(input)
         all_embeddings, all_token_nums = encode(
             self._model,
             sentences,
@@ -275,22 +329,35 @@ class EmbeddingModel:
             normalize_embeddings=normalize_embeddings,
             **kwargs,
         )
-        if isinstance(sentences, str):
-            all_embeddings = [all_embeddings]
-        embedding_list = []
-        for index, data in enumerate(all_embeddings):
-            embedding_list.append(
-                EmbeddingData(index=index, object="embedding", embedding=data.tolist())
+        if all_embeddings:
+            # Convert to numpy at once, rather than a list of floats per tensor.
+            all_embeddings = torch.stack(all_embeddings).float().cpu().numpy()
+
+        results = []
+        start = 0
+        for input, encoding_format in requests:
+            end = start + (1 if isinstance(input, str) else len(input))
+            embedding_list = []
+            for index, data in enumerate(all_embeddings[start:end]):
+                embedding_list.append(
+                    EmbeddingData(
+                        index=index,
+                        object="embedding",
+                        embedding=encode_embedding(data, encoding_format),
+                    )
+                )
+            token_nums = sum(all_token_nums[start:end])
+            usage = EmbeddingUsage(prompt_tokens=token_nums, total_tokens=token_nums)
+            results.append(
+                Embedding(
+                    object="list",
+                    model=self._model_uid,
+                    data=embedding_list,
+                    usage=usage,
+                )
             )
-        usage = EmbeddingUsage(
-            prompt_tokens=all_token_nums, total_tokens=all_token_nums
-        )
-        return Embedding(
-            object="list",
-            model=self._model_uid,
-            data=embedding_list,
-            usage=usage,
-        )
+            start = end
+        return results
 
 
 def match_embedding(model_name: str) -> EmbeddingModelSpec:
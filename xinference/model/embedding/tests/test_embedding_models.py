@@ -16,8 +16,10 @@ import os
 import shutil
 import tempfile
 
+import numpy as np
 import pytest
 
+from ....client.common import decode_embedding
 from ...utils import valid_model_revision
 from ..core import EmbeddingModel, EmbeddingModelSpec, cache
 
@@ -75,6 +77,30 @@ def test_model():
         assert len(r["data"]) == 4
         for d in r["data"]:
             assert len(d["embedding"]) == 384
+
+        # many requests in one batch
+        inputs = [input_text, input_texts[:2], input_texts[2:]]
+        results = model.create_embedding_batch([(i, "float") for i in inputs])
+        assert len(results) == 3
+        for input, r in zip(inputs, results):
+            expected = model.create_embedding(input)
+            assert len(r["data"]) == len(expected["data"])
+            assert r["usage"] == expected["usage"]
+            for d, e in zip(r["data"], expected["data"]):
+                assert d["index"] == e["index"]
+                assert np.allclose(d["embedding"], e["embedding"], atol=1e-4)
+
+        # base64 encoding
+        expected = model.create_embedding(input_texts)
+        for encoding_format, atol in [("base64", 1e-6), ("base64_float16", 1e-3)]:
+            r = model.create_embedding(input_texts, encoding_format=encoding_format)
+            assert all(isinstance(d["embedding"], str) for d in r["data"])
+            r = decode_embedding(r, encoding_format)
+            for d, e in zip(r["data"], expected["data"]):
+                assert d["embedding"].shape == (384,)
+                assert np.allclose(d["embedding"], e["embedding"], atol=atol)
+        with pytest.raises(ValueError):
+            model.create_embedding(input_text, encoding_format="binary")
     finally:
         if model_path is not None:
             shutil.rmtree(model_path, ignore_errors=True)
@@ -18,7 +18,7 @@ import os
 import platform
 from abc import abstractmethod
 from collections import defaultdict
-from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Mapping, Optional, Tuple, Union
 
 from ...core.utils import parse_replica_model_uid
 from ..core import ModelDescription
@@ -98,6 +98,17 @@ class LLM(abc.ABC):
         else:
             return len(cuda_visible_devices.split(","))
 
+    def _check_single_sequence(
+        self, generate_config: Optional[Mapping[str, Any]]
+    ) -> None:
+        """For the models sampling a single sequence per request."""
+        generate_config = generate_config or {}
+        n = generate_config.get("n") or 1
+        if (generate_config.get("best_of") or n) > 1:
+            raise ValueError(
+                f"Sampling several sequences is not supported by model {self.model_uid}"
+            )
+
     @abstractmethod
     def load(self):
         raise NotImplementedError
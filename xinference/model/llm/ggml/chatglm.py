@@ -243,6 +243,7 @@ class ChatglmCppChatModel(LLM):
         chat_history: Optional[List[ChatCompletionMessage]] = None,
         generate_config: Optional[ChatglmCppGenerateConfig] = None,
     ) -> Union[ChatCompletion, Iterator[ChatCompletionChunk]]:
+        self._check_single_sequence(generate_config)
         chat_history_list = []
         if system_prompt is not None:
             chat_history_list.append({"role": "system", "content": system_prompt})
@@ -340,6 +341,7 @@ class ChatglmCppChatModel(LLM):
     ) -> Union[Completion, Iterator[CompletionChunk]]:
         logger.debug(f"Prompt for generate:\n{prompt}")
 
+        self._check_single_sequence(generate_config)
         generate_config = self._sanitize_generate_config(generate_config)
 
         params = {
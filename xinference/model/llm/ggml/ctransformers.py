@@ -232,6 +232,7 @@ class CtransformersModel(LLM):
             ):
                 yield _completion_chunk
 
+        self._check_single_sequence(generate_config_raw)
         generate_config = self._sanitize_generate_config(generate_config_raw)
 
         logger.debug(
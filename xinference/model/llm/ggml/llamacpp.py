@@ -16,6 +16,8 @@ import logging
 import os
 from typing import Iterable, Iterator, List, Optional, Union
 
+import numpy as np
+
 from ....types import (
     ChatCompletion,
     ChatCompletionChunk,
@@ -27,6 +29,7 @@ from ....types import (
     LlamaCppGenerateConfig,
     LlamaCppModelConfig,
 )
+from ...embedding.core import check_encoding_format, encode_embedding
 from ..core import LLM
 from ..llm_family import LLMFamilyV1, LLMSpecV1
 from ..utils import ChatModelMixin
@@ -220,13 +223,19 @@ class LlamaCppModel(LLM):
             _generate_config: LlamaCppGenerateConfig,
         ) -> Iterator[CompletionChunk]:
             assert self._llm is not None
-            for _completion_chunk in self._llm(prompt=_prompt, **_generate_config):
-                yield _completion_chunk
+            it = self._llm(prompt=_prompt, **_generate_config)
+            try:
+                for _completion_chunk in it:
+                    yield _completion_chunk
+            finally:
+                # Stop llama.cpp at the next token if the stream is closed early.
+                it.close()
 
         logger.debug(
             "Enter generate, prompt: %s, generate config: %s", prompt, generate_config
         )
 
+        self._check_single_sequence(generate_config)
         generate_config = self._sanitize_generate_config(generate_config)
 
         stream = generate_config.get("stream", False)
@@ -239,9 +248,17 @@ class LlamaCppModel(LLM):
         else:
             return generator_wrapper(prompt, generate_config)
 
-    def create_embedding(self, input: Union[str, List[str]]) -> Embedding:
+    def create_embedding(
+        self, input: Union[str, List[str]], encoding_format: str = "float"
+    ) -> Embedding:
         assert self._llm is not None
+        check_encoding_format(encoding_format)
         embedding = self._llm.create_embedding(input)
+        if encoding_format != "float":
+            for data in embedding["data"]:
+                data["embedding"] = encode_embedding(
+                    np.asarray(data["embedding"], dtype=np.float32), encoding_format
+                )
         return embedding
 
 
@@ -195,6 +195,10 @@ def test_model_chat(model_spec, model_family):
         "content": "chatglm_test_chat",
     }
 
+    # A single sequence is sampled per request.
+    with pytest.raises(ValueError, match="several sequences"):
+        model.chat("Hello", generate_config={"stream": True, "n": 2})
+
 
 @pytest.mark.parametrize(
     "model_spec, model_family", [(mock_model_spec, mock_model_family)]
@@ -226,3 +230,6 @@ def test_model_generate(model_spec, model_family):
 
     responses_non_stream = model.generate("Hello", generate_config={"stream": False})
     assert responses_non_stream["choices"][0]["text"] == "chatglm_test_generate"
+
+    with pytest.raises(ValueError, match="several sequences"):
+        model.generate("Hello", generate_config={"best_of": 2})
@@ -0,0 +1,766 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import inspect
+import logging
+import queue
+import sys
+import threading
+import time
+import uuid
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
+
+import torch
+from torch.nn import functional as F
+
+from ....types import (
+    CompletionChoice,
+    CompletionChunk,
+    CompletionUsage,
+    PytorchGenerateConfig,
+    RequestTimings,
+    max_tokens_field,
+)
+from .sampler import Sampler
+from .stop_matcher import StopMatcher
+from .utils import (
+    IncrementalDetokenizer,
+    KVCache,
+    get_context_length,
+    has_standard_kv_cache,
+    to_legacy_cache,
+    tokenize,
+)
+
+if TYPE_CHECKING:
+    from .prefix_cache import PrefixCache
+
+logger = logging.getLogger(__name__)
+
+# The models whose forward takes no position ids, but derives the positions of
+# the tokens from the attention mask, so the padding does not shift them.
+_MASK_POSITION_MODEL_TYPES = {"opt"}
+
+
+def _pad_kv_cache(kv_cache: KVCache, n: int) -> KVCache:
+    """Left pad the sequence dim of a `[n_batch, n_head, n_seq, n_dim]` KV cache."""
+    return tuple((F.pad(k, (0, 0, n, 0)), F.pad(v, (0, 0, n, 0))) for k, v in kv_cache)
+
+
+class _Sequence:
+    """
+    The state of one request in the running batch.
+
+    Sampling, stop handling and the streaming protocol follow `generate_stream`,
+    so that switching the batching mode does not change the results.
+    """
+
+    def __init__(
+        self,
+        model_uid: str,
+        tokenizer,
+        prompt: str,
+        input_ids: List[int],
+        generate_config: PytorchGenerateConfig,
+        index: int = 0,
+        request_id: Optional[str] = None,
+        outputs: Optional["queue.Queue"] = None,
+    ):
+        self.request_id = request_id or str(uuid.uuid1())
+        # The index of the choice, if the request samples several sequences.
+        self.index = index
+        self.model_uid = model_uid
+        self.tokenizer = tokenizer
+        self.prompt_len = len(prompt)
+        self.input_ids = input_ids
+        self.output_ids: List[int] = []
+
+        self.generate_config = generate_config
+        self.stream = generate_config.get("stream", False)
+        self.stream_interval = generate_config.get("stream_interval", 2)
+        self.max_new_tokens = int(
+            generate_config.get("max_tokens", max_tokens_field.default)
+        )
+        self.echo = bool(generate_config.get("echo", False))
+        self.stop_str = generate_config.get("stop", None)
+        # The sequences of a request share the generate config, do not modify it.
+        stop_token_ids = generate_config.get("stop_token_ids", None) or []
+        if isinstance(stop_token_ids, int):
+            stop_token_ids = [stop_token_ids]
+        self.stop_token_ids = {*stop_token_ids, tokenizer.eos_token_id}
+
+        if self.echo:
+            # The detokenizer reads the prompt as well to echo it.
+            self._echo_ids: List[int] = list(input_ids)
+            self.detokenizer = IncrementalDetokenizer(tokenizer, self._echo_ids)
+        else:
+            self.detokenizer = IncrementalDetokenizer(tokenizer, self.output_ids)
+        # The non stream request only needs the final text, unless it has to be
+        # checked for the stop words.
+        self.check_text = self.stream or bool(self.stop_str)
+        self.stop_matcher = StopMatcher(self.stop_str) if self.stop_str else None
+        # The stop words have been searched in the text before this offset.
+        self.checked_length = self.prompt_len if self.echo else 0
+        self.stop_pos: Optional[int] = None
+        self.output = ""
+        self.last_output_length = 0
+        self.finish_reason: Optional[str] = None
+        self.cancelled = False
+        # Summed up only if the sequences of the request are ranked by it.
+        self.cumulative_logprob: Optional[float] = None
+        self.start_time = time.time()
+        self.timings = RequestTimings(
+            queue_ms=0.0,
+            tokenize_ms=0.0,
+            prefill_ms=0.0,
+            decode_ms=0.0,
+            detokenize_ms=0.0,
+        )
+        self._outputs: "queue.Queue" = queue.Queue() if outputs is None else outputs
+
+    @property
+    def finished(self) -> bool:
+        return self.cancelled or self.finish_reason is not None
+
+    @property
+    def last_token(self) -> int:
+        return self.output_ids[-1]
+
+    def _detokenize(self, flush: bool = False) -> str:
+        detokenize_start = time.perf_counter()
+        self.detokenizer.step(flush)
+        self.timings["detokenize_ms"] += (time.perf_counter() - detokenize_start) * 1000
+        return self.detokenizer.text
+
+    def append_token(self, token: int, logprob: Optional[float] = None):
+        self.output_ids.append(token)
+        if self.cumulative_logprob is not None and logprob is not None:
+            self.cumulative_logprob += logprob
+        if self.echo:
+            self._echo_ids.append(token)
+        num_output_tokens = len(self.output_ids)
+        stopped = token in self.stop_token_ids
+        i = num_output_tokens - 1
+
+        if self.check_text and (
+            i % self.stream_interval == 0
+            or stopped
+            or num_output_tokens >= self.max_new_tokens
+        ):
+            output = self._detokenize()
+
+            partially_stopped = False
+            if self.stop_matcher is not None:
+                pos = self.stop_matcher.feed(output[self.checked_length :])
+                self.checked_length = len(output)
+                if pos is not None:
+                    self.stop_pos = (self.prompt_len if self.echo else 0) + pos
+                    output = output[: self.stop_pos]
+                    stopped = True
+                else:
+                    partially_stopped = self.stop_matcher.partially_stopped
+
+            self.output = output
+            # prevent yielding partial stop sequence
+            if self.stream and not partially_stopped:
+                output = output.strip("�")
+                tmp_output_length = len(output)
+                delta = output[self.last_output_length :]
+                self.last_output_length = tmp_output_length
+                self._put_chunk(delta, None)
+
+        if stopped:
+            self.finish_reason = "stop"
+        elif num_output_tokens >= self.max_new_tokens:
+            self.finish_reason = "length"
+
+        if self.finish_reason is not None:
+            if not self.stream:
+                self.output = self._detokenize(flush=True)
+                if self.stop_pos is not None:
+                    self.output = self.output[: self.stop_pos]
+            self._put_chunk("" if self.stream else self.output, self.finish_reason)
+            self._outputs.put(None)
+            elapsed_time = time.time() - self.start_time
+            logger.debug(
+                f"Request {self.request_id} finished, "
+                f"average generation speed: {num_output_tokens / elapsed_time:.2f} tokens/s."
+            )
+
+    def _put_chunk(self, text: str, finish_reason: Optional[str]):
+        completion_choice = CompletionChoice(
+            text=text, index=self.index, logprobs=None, finish_reason=finish_reason
+        )
+        completion_chunk = CompletionChunk(
+            id=self.request_id,
+            object="text_completion",
+            created=int(time.time()),
+            model=self.model_uid,
+            choices=[completion_choice],
+        )
+        if finish_reason is not None:
+            completion_chunk["timings"] = RequestTimings(**self.timings)
+        num_output_tokens = len(self.output_ids)
+        completion_usage = CompletionUsage(
+            prompt_tokens=len(self.input_ids),
+            completion_tokens=num_output_tokens,
+            total_tokens=len(self.input_ids) + num_output_tokens,
+        )
+        self._outputs.put((completion_chunk, completion_usage))
+
+    def fail(self, e: BaseException):
+        self.finish_reason = "error"
+        self._outputs.put(e)
+        self._outputs.put(None)
+
+    def cancel(self):
+        """Called by the consumer, the scheduler evicts the sequence on its next step."""
+        self.cancelled = True
+
+    def __iter__(self) -> Iterator[Tuple[CompletionChunk, CompletionUsage]]:
+        try:
+            while True:
+                item = self._outputs.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        except GeneratorExit:
+            logger.debug("Request %s is cancelled.", self.request_id)
+            self.cancel()
+            raise
+
+
+class _SequenceGroup:
+    """
+    The `best_of` sequences sampled for a request with `n` or `best_of` > 1.
+
+    They share the prefill of the prompt, are decoded in the same batch, and put
+    their chunks into one queue. A stream yields the chunks of all the choices
+    as they come, otherwise the `n` sequences with the highest log probability
+    per token are returned as the choices of a single chunk.
+    """
+
+    def __init__(self, seqs: List[_Sequence], n: int, outputs: "queue.Queue"):
+        self.seqs = seqs
+        self.n = n
+        self._outputs = outputs
+
+    def cancel(self):
+        for seq in self.seqs:
+            seq.cancel()
+
+    def _best(self) -> List[_Sequence]:
+        if len(self.seqs) == self.n:
+            return self.seqs
+
+        def _score(seq: _Sequence) -> float:
+            assert seq.cumulative_logprob is not None
+            return seq.cumulative_logprob / max(len(seq.output_ids), 1)
+
+        return sorted(self.seqs, key=_score, reverse=True)[: self.n]
+
+    def __iter__(self) -> Iterator[Tuple[CompletionChunk, CompletionUsage]]:
+        stream = self.seqs[0].stream
+        prompt_tokens = len(self.seqs[0].input_ids)
+        completion_tokens = [0] * len(self.seqs)
+        final_chunks: Dict[int, CompletionChunk] = {}
+        last_chunk: Optional[CompletionChunk] = None
+        num_finished = 0
+        try:
+            while num_finished < len(self.seqs):
+                item = self._outputs.get()
+                if item is None:
+                    num_finished += 1
+                    continue
+                if isinstance(item, BaseException):
+                    raise item
+                completion_chunk, completion_usage = item
+                choice = completion_chunk["choices"][0]
+                completion_tokens[choice["index"]] = completion_usage[
+                    "completion_tokens"
+                ]
+                completion_usage = CompletionUsage(
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=sum(completion_tokens),
+                    total_tokens=prompt_tokens + sum(completion_tokens),
+                )
+                if choice["finish_reason"] is not None:
+                    final_chunks[choice["index"]] = last_chunk = completion_chunk
+                    # The timings of the request come with its last chunk.
+                    if len(final_chunks) < len(self.seqs):
+                        completion_chunk = completion_chunk.copy()
+                        completion_chunk.pop("timings", None)
+                if stream:
+                    yield completion_chunk, completion_usage
+        except BaseException:
+            # The consumer has gone, or a sequence has failed.
+            self.cancel()
+            raise
+        if stream:
+            return
+
+        choices = []
+        for i, seq in enumerate(self._best()):
+            choice = final_chunks[seq.index]["choices"][0]
+            choices.append(
+                CompletionChoice(
+                    text=choice["text"],
+                    index=i,
+                    logprobs=None,
+                    finish_reason=choice["finish_reason"],
+                )
+            )
+        assert last_chunk is not None
+        completion_chunk = CompletionChunk(
+            id=last_chunk["id"],
+            object="text_completion",
+            created=last_chunk["created"],
+            model=last_chunk["model"],
+            choices=choices,
+        )
+        if "timings" in last_chunk:
+            completion_chunk["timings"] = last_chunk["timings"]
+        yield completion_chunk, completion_usage
+
+
+class _SteppingQueue(queue.Queue):
+    """
+    The outputs of a request generated in the thread consuming them, `get`
+    runs the steps of the scheduler until an output is available.
+    """
+
+    def __init__(self, step: Callable[[], None]):
+        super().__init__()
+        self._step = step
+
+    def get(self, block: bool = True, timeout: Optional[float] = None):
+        while self.empty():
+            self._step()
+        return super().get(block=False)
+
+
+class _Prefill:
+    """The prompt of a group of sequences being prefilled chunk by chunk."""
+
+    def __init__(self, seqs: List[_Sequence], num_cached_tokens: int, kv_cache):
+        self.seqs = seqs
+        # The number of prompt tokens in `kv_cache`.
+        self.num_tokens = num_cached_tokens
+        self.kv_cache = kv_cache
+        self.start = time.perf_counter()
+
+
+class BatchScheduler:
+    """
+    Iteration-level (continuous) batching for decoder-only models.
+
+    A background thread owns the model. Each iteration it prefills the newly
+    submitted requests, merges their KV caches into the running batch, and runs
+    a single decode step for all the running sequences. Finished sequences leave
+    the batch right away, so new requests never wait for the whole batch.
+
+    The running batch is left padded, the attention mask marks the padding, and
+    the position ids are derived from the number of real tokens of each row.
+
+    A request with `n` or `best_of` > 1 is admitted as a group of sequences,
+    the prompt is prefilled once and its KV cache is copied for each of them.
+
+    If `prefill_chunk_size` is positive, at most that many prompt tokens are
+    prefilled per iteration. A long prompt is prefilled over several
+    iterations, and the running sequences keep decoding in between.
+    """
+
+    def __init__(
+        self,
+        model_uid: str,
+        model,
+        tokenizer,
+        device: str,
+        max_num_seqs: int = 16,
+        prefix_cache: Optional["PrefixCache"] = None,
+        prefill_chunk_size: int = 0,
+    ):
+        self._model_uid = model_uid
+        self._model = model
+        self._tokenizer = tokenizer
+        self._device = device
+        self._max_num_seqs = max_num_seqs
+        self._prefix_cache = prefix_cache
+        self._prefill_chunk_size = prefill_chunk_size
+        self._context_len = get_context_length(model.config)
+        self._use_position_ids = (
+            "position_ids" in inspect.signature(model.forward).parameters
+        )
+
+        # The groups of sequences, one per request.
+        self._waiting: "queue.Queue[List[_Sequence]]" = queue.Queue()
+        # The group at the head of the queue, waiting for room in the batch.
+        self._next_group: Optional[List[_Sequence]] = None
+        self._running: List[_Sequence] = []
+        # The group being prefilled, it joins the running batch once done.
+        self._prefilling: Optional[_Prefill] = None
+        self._kv_cache: Optional[KVCache] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        # Switch to CPU by avoiding some bugs in mps backend.
+        self._sampler_device = "cpu" if device == "mps" else device
+        # The rows are the running sequences.
+        self._sampler = Sampler(self._sampler_device)
+
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def is_supported(model, device: str) -> bool:
+        """Whether the model can be batched, i.e. it accepts an attention mask
+        and the position ids of the padded rows, and uses the standard KV cache
+        layout."""
+        parameters = inspect.signature(model.forward).parameters
+        if "attention_mask" not in parameters or "past_key_values" not in parameters:
+            return False
+        if (
+            "position_ids" not in parameters
+            and getattr(model.config, "model_type", None)
+            not in _MASK_POSITION_MODEL_TYPES
+        ):
+            # The positions would follow the length of the padded KV cache.
+            return False
+        return has_standard_kv_cache(model, device)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name=f"BatchScheduler-{self._model_uid}", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(
+        self, prompt: str, generate_config: PytorchGenerateConfig
+    ) -> Iterator[Tuple[CompletionChunk, CompletionUsage]]:
+        if self._stopped.is_set():
+            raise RuntimeError("The batch scheduler has been stopped.")
+        return self._submit(prompt, generate_config, queue.Queue())
+
+    def run(
+        self, prompt: str, generate_config: PytorchGenerateConfig
+    ) -> Iterator[Tuple[CompletionChunk, CompletionUsage]]:
+        """
+        Generate a request in the calling thread, without starting the
+        scheduler thread. The steps run as the outputs are consumed.
+        """
+        return self._submit(prompt, generate_config, _SteppingQueue(self._step))
+
+    def _submit(
+        self,
+        prompt: str,
+        generate_config: PytorchGenerateConfig,
+        outputs: "queue.Queue",
+    ) -> Iterator[Tuple[CompletionChunk, CompletionUsage]]:
+        n = int(generate_config.get("n") or 1)
+        best_of = int(generate_config.get("best_of") or n)
+        if best_of < n:
+            raise ValueError("best_of must not be less than n.")
+        if generate_config.get("stream", False) and best_of > n:
+            raise ValueError("best_of cannot be used with stream unless it equals n.")
+        if best_of > self._max_num_seqs:
+            raise ValueError(
+                f"best_of and n must not exceed max_num_seqs {self._max_num_seqs}."
+            )
+
+        tokenize_start = time.perf_counter()
+        input_ids = tokenize(self._model, self._tokenizer, prompt)
+        tokenize_time = time.perf_counter() - tokenize_start
+
+        max_new_tokens = int(
+            generate_config.get("max_tokens", max_tokens_field.default)
+        )
+        max_src_len = self._context_len - max_new_tokens - 8
+        if max_src_len < 0:
+            raise ValueError("Max tokens exceeds model's max length")
+        input_ids = input_ids[-max_src_len:]
+
+        request_id = str(uuid.uuid1())
+        seqs = [
+            _Sequence(
+                self._model_uid,
+                self._tokenizer,
+                prompt,
+                input_ids,
+                generate_config,
+                index=i,
+                request_id=request_id,
+                outputs=outputs,
+            )
+            for i in range(best_of)
+        ]
+        for seq in seqs:
+            seq.timings["tokenize_ms"] = tokenize_time * 1000
+            if best_of > n:
+                seq.cumulative_logprob = 0.0
+        self._waiting.put(seqs)
+        if best_of == 1:
+            return iter(seqs[0])
+        return iter(_SequenceGroup(seqs, n, outputs))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._step()
+            except Exception as e:
+                logger.exception("Batch scheduler of model %s failed.", self._model_uid)
+                for seq in self._running:
+                    seq.fail(e)
+                self._reset()
+        if self._prefilling is not None:
+            self._running.extend(self._prefilling.seqs)
+            self._prefilling = None
+        if self._next_group is not None:
+            self._running.extend(self._next_group)
+            self._next_group = None
+        for seq in self._running:
+            seq.fail(RuntimeError("The batch scheduler has been stopped."))
+        while not self._waiting.empty():
+            for seq in self._waiting.get_nowait():
+                seq.fail(RuntimeError("The batch scheduler has been stopped."))
+        self._reset()
+
+    def _reset(self):
+        self._running = []
+        self._kv_cache = None
+        self._attention_mask = None
+        self._sampler = Sampler(self._sampler_device)
+
+    @torch.inference_mode()
+    def _step(self):
+        self._admit()
+        # Sequences may finish on prefill.
+        self._evict_finished()
+        if self._running:
+            self._decode()
+        self._evict_finished()
+
+    def _admit(self):
+        # The number of prompt tokens left to prefill in this iteration.
+        budget = self._prefill_chunk_size or sys.maxsize
+        while len(self._running) < self._max_num_seqs and budget > 0:
+            if self._prefilling is None:
+                if self._next_group is None:
+                    try:
+                        if self._running:
+                            self._next_group = self._waiting.get_nowait()
+                        else:
+                            # Nothing to decode, wait for a new request.
+                            self._next_group = self._waiting.get(timeout=0.1)
+                    except queue.Empty:
+                        return
+                seqs = [seq for seq in self._next_group if not seq.cancelled]
+                if not seqs:
+                    self._next_group = None
+                    continue
+                if len(self._running) + len(seqs) > self._max_num_seqs:
+                    # Keep the group at the head until the whole group fits.
+                    self._next_group = seqs
+                    return
+                self._next_group = None
+                self._prefilling = self._start_prefill(seqs)
+            prefilling = self._prefilling
+            try:
+                budget -= self._prefill(prefilling, budget)
+            except Exception as e:
+                self._prefilling = None
+                logger.exception(
+                    "Prefill of request %s failed.", prefilling.seqs[0].request_id
+                )
+                for seq in prefilling.seqs:
+                    seq.fail(e)
+
+    def _start_prefill(self, seqs: List[_Sequence]) -> _Prefill:
+        queue_ms = (time.time() - seqs[0].start_time) * 1000
+        for seq in seqs:
+            seq.timings["queue_ms"] = queue_ms
+        num_cached_tokens, cached_kv = (
+            self._prefix_cache.match(seqs[0].input_ids)
+            if self._prefix_cache is not None
+            else (0, None)
+        )
+        return _Prefill(seqs, num_cached_tokens, cached_kv)
+
+    def _prefill(self, prefilling: _Prefill, budget: int) -> int:
+        """
+        Prefill at most `budget` more tokens of the prompt shared by a group of
+        sequences. Once the prompt is done, fork its KV cache into the running
+        batch. Return the number of tokens prefilled.
+        """
+        seqs = prefilling.seqs
+        if all(seq.cancelled for seq in seqs):
+            self._prefilling = None
+            return 0
+        input_ids = seqs[0].input_ids
+        start = prefilling.num_tokens
+        end = min(len(input_ids), start + budget)
+        out = self._model(
+            torch.as_tensor([input_ids[start:end]], device=self._device),
+            use_cache=True,
+            past_key_values=prefilling.kv_cache,
+        )
+        prefilling.num_tokens = end
+        prefilling.kv_cache = out.past_key_values
+        if end < len(input_ids):
+            return end - start
+
+        self._prefilling = None
+        kv_cache = to_legacy_cache(out.past_key_values)
+        if self._prefix_cache is not None:
+            self._prefix_cache.insert(input_ids, kv_cache)
+        n = len(seqs)
+        rows = list(range(len(self._running), len(self._running) + n))
+        for seq in seqs:
+            self._sampler.add(input_ids, seq.generate_config)
+        logits = out.logits[:, -1, :].expand(n, -1)
+        try:
+            tokens = self._sampler.sample(logits, index=rows)
+            if n > 1:
+                kv_cache = tuple(
+                    (
+                        k.expand(n, -1, -1, -1).contiguous(),
+                        v.expand(n, -1, -1, -1).contiguous(),
+                    )
+                    for k, v in kv_cache
+                )
+            self._merge(kv_cache, len(input_ids))
+        except BaseException:
+            self._sampler.select(list(range(rows[0])))
+            raise
+        self._running.extend(seqs)
+        self._sampler.update(tokens, index=rows)
+        logprobs = self._logprobs(seqs, logits, tokens)
+        prefill_ms = (time.perf_counter() - prefilling.start) * 1000
+        for seq, token, logprob in zip(seqs, tokens, logprobs):
+            seq.timings["prefill_ms"] = prefill_ms
+            seq.append_token(token, logprob)
+        return end - start
+
+    @staticmethod
+    def _logprobs(
+        seqs: List[_Sequence], logits: torch.Tensor, tokens: List[int]
+    ) -> List[Optional[float]]:
+        """The log probabilities of the sampled tokens, if any sequence needs them."""
+        if all(seq.cumulative_logprob is None for seq in seqs):
+            return [None] * len(seqs)
+        logprobs = torch.log_softmax(logits.float(), dim=-1)
+        index = torch.as_tensor(tokens, device=logprobs.device).unsqueeze(1)
+        return logprobs.gather(1, index).squeeze(1).tolist()
+
+    def _merge(self, kv_cache: KVCache, length: int):
+        attention_mask = torch.ones(
+            (kv_cache[0][0].shape[0], length), dtype=torch.long, device=self._device
+        )
+        if self._kv_cache is None:
+            self._kv_cache = kv_cache
+            self._attention_mask = attention_mask
+            return
+
+        assert self._attention_mask is not None
+        batch_len = self._attention_mask.shape[1]
+        if batch_len < length:
+            self._kv_cache = _pad_kv_cache(self._kv_cache, length - batch_len)
+            self._attention_mask = F.pad(self._attention_mask, (length - batch_len, 0))
+        elif length < batch_len:
+            kv_cache = _pad_kv_cache(kv_cache, batch_len - length)
+            attention_mask = F.pad(attention_mask, (batch_len - length, 0))
+
+        self._kv_cache = tuple(
+            (torch.cat((k, new_k), dim=0), torch.cat((v, new_v), dim=0))
+            for (k, v), (new_k, new_v) in zip(self._kv_cache, kv_cache)
+        )
+        self._attention_mask = torch.cat((self._attention_mask, attention_mask), dim=0)
+
+    def _decode(self):
+        decode_start = time.perf_counter()
+        assert self._attention_mask is not None
+        input_ids = torch.as_tensor(
+            [[seq.last_token] for seq in self._running], device=self._device
+        )
+        attention_mask = F.pad(self._attention_mask, (0, 1), value=1)
+        kwargs = dict(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=self._kv_cache,
+            use_cache=True,
+        )
+        if self._use_position_ids:
+            # The position of the new token equals to the number of real tokens.
+            kwargs["position_ids"] = self._attention_mask.sum(dim=1, keepdim=True)
+        out = self._model(**kwargs)
+        self._kv_cache = to_legacy_cache(out.past_key_values)
+        self._attention_mask = attention_mask
+
+        logits = out.logits[:, -1, :]
+        tokens = self._sampler.sample(logits)
+        self._sampler.update(tokens)
+        logprobs = self._logprobs(self._running, logits, tokens)
+        # Each sequence waits for the whole batch step.
+        decode_time = (time.perf_counter() - decode_start) * 1000
+        for seq, token, logprob in zip(self._running, tokens, logprobs):
+            seq.timings["decode_ms"] += decode_time
+            seq.append_token(token, logprob)
+
+    def _evict_finished(self):
+        keep = [i for i, seq in enumerate(self._running) if not seq.finished]
+        if len(keep) == len(self._running):
+            return
+        if self._prefix_cache is not None:
+            self._cache_finished()
+        if not keep:
+            self._reset()
+            return
+
+        assert self._kv_cache is not None and self._attention_mask is not None
+        self._running = [self._running[i] for i in keep]
+        self._sampler.select(keep)
+        index = torch.as_tensor(keep, device=self._attention_mask.device)
+        attention_mask = self._attention_mask.index_select(0, index)
+        # Drop the columns that are padding for all the remaining sequences.
+        offset = attention_mask.shape[1] - int(attention_mask.sum(dim=1).max())
+        self._attention_mask = attention_mask[:, offset:]
+        self._kv_cache = tuple(
+            (
+                k.index_select(0, index.to(k.device))[:, :, offset:, :],
+                v.index_select(0, index.to(v.device))[:, :, offset:, :],
+            )
+            for k, v in self._kv_cache
+        )
+
+    def _cache_finished(self):
+        assert self._kv_cache is not None and self._attention_mask is not None
+        assert self._prefix_cache is not None
+        lengths = self._attention_mask.sum(dim=1).tolist()
+        batch_len = self._attention_mask.shape[1]
+        for row, seq in enumerate(self._running):
+            if not seq.finished or seq.finish_reason == "error":
+                continue
+            # The KV cache covers all the tokens but the last sampled one.
+            offset = batch_len - int(lengths[row])
+            kv_cache = tuple(
+                (k[row : row + 1, :, offset:, :], v[row : row + 1, :, offset:, :])
+                for k, v in self._kv_cache
+            )
+            token_ids = seq.input_ids + seq.output_ids[:-1]
+            self._prefix_cache.insert(token_ids, kv_cache)
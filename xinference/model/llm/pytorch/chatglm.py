@@ -112,6 +112,7 @@ class ChatglmPytorchChatModel(PytorchChatModel):
         generate_config: Optional[PytorchGenerateConfig] = None,
     ) -> Union[ChatCompletion, Iterator[ChatCompletionChunk]]:
         tools = self._handle_tools(generate_config)
+        self._check_single_sequence(generate_config)
         kwargs: Dict[str, Any] = {}
         generate_config = generate_config or {}
         temperature = generate_config.get("temperature")
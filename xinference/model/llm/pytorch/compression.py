@@ -15,7 +15,12 @@
 import dataclasses
 import gc
 import glob
+import json
+import logging
+import math
 import os
+import threading
+from typing import Any, Dict, List, Optional
 
 import torch
 import torch.nn as nn
@@ -27,6 +32,11 @@ from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
 
 from ....device_utils import empty_cache
 
+logger = logging.getLogger(__name__)
+
+# Bump it once the layout of the compressed checkpoints changes.
+COMPRESSED_CHECKPOINT_VERSION = 1
+
 
 @dataclasses.dataclass
 class CompressionConfig:
@@ -44,11 +54,94 @@ default_compression_config = CompressionConfig(
 )
 
 
-class CLinear(nn.Module):
-    """Compressed Linear Layer."""
+class DecompressedWeightCache:
+    """
+    Keep the decompressed weights of the `CLinear` layers, up to `max_memory`
+    bytes in total.
+
+    Every forward runs the layers in the same order, so an LRU cache smaller
+    than the model would evict each weight right before it is used again.
+    Instead, a weight is kept once cached, and the layers beyond the budget
+    are never cached.
+    """
+
+    def __init__(self, max_memory: int):
+        self.max_memory = max_memory
+        self.memory = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes: int) -> bool:
+        with self._lock:
+            if self.memory + nbytes > self.max_memory:
+                return False
+            self.memory += nbytes
+            return True
+
+
+# Whether `torch._int_mm` runs on a device type, probed once per device type.
+_INT_MM_SUPPORTED: Dict[str, bool] = {}
+
+
+def _int_mm_supported(device: torch.device) -> bool:
+    """
+    Probe `torch._int_mm` with a tiny matmul on the device, since the older
+    torch builds, e.g. 2.1, have it for CUDA only.
+    """
+    supported = _INT_MM_SUPPORTED.get(device.type)
+    if supported is None:
+        supported = hasattr(torch, "_int_mm")
+        if supported:
+            try:
+                a = torch.ones((32, 32), dtype=torch.int8, device=device)
+                torch._int_mm(a, a)
+            except Exception:
+                logger.info(
+                    f"The int8 matmul is not supported on {device.type}, "
+                    f"the 8-bit weights are decompressed per forward."
+                )
+                supported = False
+        _INT_MM_SUPPORTED[device.type] = supported
+    return supported
+
+
+def _supports_int8_matmul(packed_data) -> bool:
+    config = default_compression_config
+    return (
+        isinstance(packed_data, tuple)
+        and config.symmetric
+        and config.num_bits == 8
+        and config.group_dim == 1
+        and packed_data[0].device.type == "cpu"
+        and _int_mm_supported(packed_data[0].device)
+    )
+
 
-    def __init__(self, weight=None, bias=None, device=None):
+class CLinear(nn.Module):
+    """
+    Compressed Linear Layer.
+
+    On CPU, the 8-bit weights are not decompressed per forward. The input is
+    quantized to int8 per token and group as well, each group is multiplied
+    by an int8 matmul, and the group scales are applied to the int32 partial
+    outputs. The int8 weight of each group is made contiguous once at load
+    time. Quantizing the input adds noise, the outputs differ from those of
+    the decompressed weight by up to about 1% of the largest output, so the
+    int8 matmul can be turned off by `int8_matmul=False`. On the other
+    devices, or if the torch build has no int8 matmul on CPU, the weights are
+    decompressed per forward. With a `DecompressedWeightCache`, the
+    decompressed weights of the layers within its budget are kept instead.
+    """
+
+    def __init__(
+        self,
+        weight=None,
+        bias=None,
+        device=None,
+        cache: Optional[DecompressedWeightCache] = None,
+        int8_matmul: bool = True,
+    ):
         super().__init__()
+        self.weight: Any
         if weight is None:
             self.weight = None
         elif isinstance(weight, Tensor):
@@ -56,13 +149,71 @@ class CLinear(nn.Module):
         else:
             self.weight = weight
         self.bias = bias
+        self._cache = cache
+        self._decompressed: Optional[Tensor] = None
+        # The int8 weight of each group, `[n_group, group_size, out_features]`.
+        self._weight_groups: Optional[Tensor] = None
+        # The reciprocals of the group scales, `[n_group, out_features]`.
+        self._inv_scale: Optional[Tensor] = None
+        if int8_matmul and _supports_int8_matmul(self.weight):
+            self._prepare_int8_matmul()
+
+    def _prepare_int8_matmul(self):
+        data, scale, original_shape = self.weight
+        n_out, n_group, _ = data.shape
+        self._weight_groups = data.permute(1, 2, 0).contiguous()
+        # Keep the compressed weight as a view, not a second copy.
+        self.weight = (self._weight_groups.permute(2, 0, 1), scale, original_shape)
+        self._inv_scale = (1 / scale.float()).view(n_out, n_group).t().contiguous()
+
+    def _cached_weight(self) -> Optional[Tensor]:
+        if (
+            self._decompressed is None
+            and self._cache is not None
+            and isinstance(self.weight, tuple)
+        ):
+            # The scale has the dtype of the decompressed weight.
+            original_shape, scale = self.weight[-1], self.weight[-2]
+            nbytes = math.prod(original_shape) * scale.element_size()
+            if self._cache.reserve(nbytes):
+                self._decompressed = decompress(self.weight, default_compression_config)
+            # The budget is only reserved once.
+            self._cache = None
+        return self._decompressed
 
     def forward(self, input: Tensor) -> Tensor:
-        weight = decompress(self.weight, default_compression_config)
+        weight = self._cached_weight()
+        if weight is None:
+            if self._weight_groups is not None:
+                return self._int8_linear(input)
+            weight = decompress(self.weight, default_compression_config)
         if self.bias is None:
             return F.linear(input.to(weight.dtype), weight)
         return F.linear(input.to(weight.dtype), weight, self.bias.to(weight.dtype))
 
+    def _int8_linear(self, input: Tensor) -> Tensor:
+        _, scale, _ = self.weight
+        weight_groups, inv_scale = self._weight_groups, self._inv_scale
+        assert weight_groups is not None and inv_scale is not None
+        n_group, group_size, n_out = weight_groups.shape
+
+        x = input.reshape(-1, input.shape[-1]).float()
+        pad_len = n_group * group_size - x.shape[1]
+        if pad_len:
+            x = F.pad(x, (0, pad_len))
+        x = x.view(-1, n_group, group_size)
+        x_scale = x.abs().amax(dim=-1, keepdim=True).clamp_(min=1e-8) / 127
+        x_int8 = (x / x_scale).round_().to(torch.int8)
+        x_scale = x_scale.squeeze(-1)
+
+        output = torch.zeros((x.shape[0], n_out), device=x.device)
+        for g in range(n_group):
+            partial = torch._int_mm(x_int8[:, g], weight_groups[g]).float()
+            output.add_(partial.mul_(inv_scale[g]).mul_(x_scale[:, g : g + 1]))
+        if self.bias is not None:
+            output.add_(self.bias.float())
+        return output.view(*input.shape[:-1], n_out).to(scale.dtype)
+
 
 def get_compressed_list(module, prefix=""):
     compressed_list = []
@@ -80,7 +231,14 @@ def get_compressed_list(module, prefix=""):
     return compressed_list
 
 
-def apply_compressed_weight(module, compressed_state_dict, target_device, prefix=""):
+def apply_compressed_weight(
+    module,
+    compressed_state_dict,
+    target_device,
+    prefix="",
+    cache=None,
+    int8_matmul=True,
+):
     for attr_str in dir(module):
         target_attr = getattr(module, attr_str)
         if type(target_attr) == torch.nn.Linear:
@@ -91,23 +249,155 @@ def apply_compressed_weight(module, compressed_state_dict, target_device, prefix
                 module,
                 attr_str,
                 CLinear(
-                    compressed_state_dict[full_name], target_attr.bias, target_device
+                    compressed_state_dict[full_name],
+                    target_attr.bias,
+                    target_device,
+                    cache=cache,
+                    int8_matmul=int8_matmul,
                 ),
             )
     for name, child in module.named_children():
         child_prefix = f"{prefix}.{name}" if prefix else name
         apply_compressed_weight(
-            child, compressed_state_dict, target_device, child_prefix
+            child,
+            compressed_state_dict,
+            target_device,
+            child_prefix,
+            cache=cache,
+            int8_matmul=int8_matmul,
         )
 
 
+def compressed_checkpoint_path(
+    model_path: str,
+    revision: Optional[str],
+    torch_dtype: torch.dtype,
+    config: CompressionConfig = default_compression_config,
+) -> str:
+    """
+    The path of the compressed checkpoint in the model directory, keyed by
+    the model revision, the dtype and the compression config.
+    """
+    key = "-".join(
+        [
+            str(revision or "main").replace("/", "_"),
+            str(torch_dtype).replace("torch.", ""),
+            f"{config.num_bits}bit",
+            f"g{config.group_size}",
+            f"d{config.group_dim}",
+            "sym" if config.symmetric else "asym",
+        ]
+    )
+    return os.path.join(model_path, f"compressed-{key}.safetensors")
+
+
+def save_compressed_checkpoint(
+    path: str, compressed_state_dict: Dict[str, Any], linear_weights: List[str]
+):
+    """
+    Save the compressed state dict as safetensors. The quantized data and
+    the scales of a linear weight are saved as `<name>.data`, `<name>.scale`
+    and `<name>.mn` if asymmetric, the original shapes in the metadata.
+    """
+    from safetensors.torch import save_file
+
+    tensors = {}
+    shapes = {}
+    seen = set()
+    for name, value in compressed_state_dict.items():
+        if name in linear_weights:
+            shapes[name] = list(value[-1])
+            parts = zip(
+                ("data", "mn", "scale") if len(value) == 4 else ("data", "scale"),
+                value[:-1],
+            )
+            for suffix, tensor in parts:
+                tensors[f"{name}.{suffix}"] = tensor
+        else:
+            tensors[name] = value
+    for name, tensor in tensors.items():
+        tensor = tensor.detach().contiguous().cpu()
+        # Safetensors does not save the tensors sharing memory, e.g. the tied
+        # weights.
+        if tensor.data_ptr() in seen:
+            tensor = tensor.clone()
+        seen.add(tensor.data_ptr())
+        tensors[name] = tensor
+    metadata = {
+        "version": str(COMPRESSED_CHECKPOINT_VERSION),
+        "compression_config": json.dumps(
+            dataclasses.asdict(default_compression_config)
+        ),
+        "shapes": json.dumps(shapes),
+    }
+    # Write to a temporary file first, so a failed save leaves no truncated
+    # checkpoint behind.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        save_file(tensors, tmp_path, metadata=metadata)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_compressed_checkpoint(
+    path: str, device: str, linear_weights: List[str]
+) -> Optional[Dict[str, Any]]:
+    """
+    Load the compressed state dict saved by `save_compressed_checkpoint`, or
+    return None if it is missing or stale. The tensors on CPU are memory
+    mapped from the file.
+    """
+    from safetensors import safe_open
+
+    if not os.path.exists(path):
+        return None
+    with safe_open(path, framework="pt", device="cpu") as f:
+        metadata = f.metadata() or {}
+        if metadata.get("version") != str(COMPRESSED_CHECKPOINT_VERSION):
+            return None
+        shapes = json.loads(metadata["shapes"])
+        if set(shapes) != set(linear_weights):
+            return None
+        tensors = {name: f.get_tensor(name).to(device) for name in f.keys()}
+
+    compressed_state_dict: Dict[str, Any] = {}
+    for name, shape in shapes.items():
+        data = tensors.pop(f"{name}.data")
+        scale = tensors.pop(f"{name}.scale")
+        if f"{name}.mn" in tensors:
+            compressed_state_dict[name] = (
+                data,
+                tensors.pop(f"{name}.mn"),
+                scale,
+                torch.Size(shape),
+            )
+        else:
+            compressed_state_dict[name] = (data, scale, torch.Size(shape))
+    compressed_state_dict.update(tensors)
+    return compressed_state_dict
+
+
 def load_compress_model(
     model_path: str,
     device: str,
     torch_dtype: torch.dtype,
     use_fast: bool,
     revision: str = "main",
+    cache_max_memory: int = 0,
+    int8_matmul: bool = True,
 ):
+    """
+    Load the model with its linear weights compressed to 8 bits. The
+    decompressed weights are cached up to `cache_max_memory` bytes, see
+    `DecompressedWeightCache`. With `int8_matmul`, the layers on CPU multiply
+    the int8 weights directly, see `CLinear`.
+
+    The compressed state dict is saved in the model directory on the first
+    load, and the later loads map it instead of compressing the full
+    precision checkpoint again.
+    """
     from accelerate import init_empty_weights
     from accelerate.utils import set_module_tensor_to_device
 
@@ -138,31 +428,59 @@ def load_compress_model(
         model_path = snapshot_download(model_path, revision=revision)
         base_pattern = os.path.join(model_path, "pytorch_model*.bin")
 
-    files = glob.glob(base_pattern)
-
-    compressed_state_dict = {}
-
-    for filename in tqdm(files):
-        tmp_state_dict = torch.load(filename, map_location=torch.device(device))
-        for name in tmp_state_dict:
-            if name in linear_weights:
-                tensor = tmp_state_dict[name].to(device).data.to(torch_dtype)
-                compressed_state_dict[name] = compress(
-                    tensor, default_compression_config
-                )
-            else:
-                compressed_state_dict[name] = tmp_state_dict[name].to(device)
-            tmp_state_dict[name] = None
-            tensor = None
+    checkpoint_path = compressed_checkpoint_path(model_path, revision, torch_dtype)
+    try:
+        compressed_state_dict = load_compressed_checkpoint(
+            checkpoint_path, device, linear_weights
+        )
+    except Exception:
+        logger.warning(
+            f"Failed to load the compressed checkpoint {checkpoint_path}, "
+            f"compress the model again.",
+            exc_info=True,
+        )
+        compressed_state_dict = None
+
+    if compressed_state_dict is None:
+        compressed_state_dict = {}
+        files = glob.glob(base_pattern)
+        for filename in tqdm(files):
+            tmp_state_dict = torch.load(filename, map_location=torch.device(device))
+            for name in tmp_state_dict:
+                if name in linear_weights:
+                    tensor = tmp_state_dict[name].to(device).data.to(torch_dtype)
+                    compressed_state_dict[name] = compress(
+                        tensor, default_compression_config
+                    )
+                else:
+                    compressed_state_dict[name] = tmp_state_dict[name].to(device)
+                tmp_state_dict[name] = None
+                tensor = None
+            del tmp_state_dict
             gc.collect()
             empty_cache()
+        try:
+            save_compressed_checkpoint(
+                checkpoint_path, compressed_state_dict, linear_weights
+            )
+        except Exception:
+            # E.g. the model directory is read only.
+            logger.warning(
+                f"Failed to save the compressed checkpoint {checkpoint_path}.",
+                exc_info=True,
+            )
+    else:
+        logger.debug(f"Load the compressed checkpoint {checkpoint_path}.")
 
     for name in model.state_dict():
         if name not in linear_weights:
             set_module_tensor_to_device(
                 model, name, device, value=compressed_state_dict[name]
             )
-    apply_compressed_weight(model, compressed_state_dict, device)
+    cache = DecompressedWeightCache(cache_max_memory) if cache_max_memory > 0 else None
+    apply_compressed_weight(
+        model, compressed_state_dict, device, cache=cache, int8_matmul=int8_matmul
+    )
 
     model.to(device)
 
@@ -253,6 +571,7 @@ def decompress(packed_data, config):
         )
         data = data.reshape(padded_original_shape)
         indices = [slice(0, x) for x in original_shape]
-        return data[indices].contiguous()
+        return data[tuple(indices)].contiguous()
     else:
-        return data.view(original_shape)
+        # The data may be a permuted view, see `CLinear`.
+        return data.reshape(original_shape)
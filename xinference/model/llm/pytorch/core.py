@@ -15,7 +15,8 @@
 import json
 import logging
 import os
-from typing import Iterable, Iterator, List, Optional, Union
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 from ....device_utils import (
     get_device_preferred_dtype,
@@ -28,6 +29,7 @@ from ....types import (
     ChatCompletionMessage,
     Completion,
     CompletionChunk,
+    CompletionUsage,
     CreateCompletionTorch,
     Embedding,
     EmbeddingData,
@@ -35,6 +37,7 @@ from ....types import (
     PytorchGenerateConfig,
     PytorchModelConfig,
 )
+from ...embedding.core import check_encoding_format, encode_embedding
 from ...utils import select_device
 from ..core import LLM
 from ..llm_family import LLMFamilyV1, LLMSpecV1
@@ -42,6 +45,12 @@ from ..utils import ChatModelMixin
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_PREFIX_CACHE_MAX_MEMORY = 1 << 30
+
+CPU_MODES = ["fp32", "bf16", "int8"]
+BENCHMARK_PROMPT = "The quick brown fox jumps over the lazy dog."
+COMPILE_WARMUP_STEPS = 4
+
 
 class PytorchModel(LLM):
     def __init__(
@@ -58,6 +67,16 @@ class PytorchModel(LLM):
         self._pytorch_model_config: PytorchModelConfig = self._sanitize_model_config(
             pytorch_model_config
         )
+        self._batch_scheduler = None
+        self._prefix_cache = None
+        self._static_kv_cache = False
+        self._prompt_lookup_num_tokens = 0
+        self._cpu_mode_stats: Dict[str, Any] = {}
+        # The compiled model for the single token decode steps.
+        self._decode_model = None
+        self._compile_stats: Dict[str, Any] = {}
+        # Whether the model can be batched, probed on the first parallel sampling.
+        self._batching_supported: Optional[bool] = None
 
     def _sanitize_model_config(
         self, pytorch_model_config: Optional[PytorchModelConfig]
@@ -71,6 +90,21 @@ class PytorchModel(LLM):
         pytorch_model_config.setdefault("gptq_act_order", False)
         pytorch_model_config.setdefault("device", "auto")
         pytorch_model_config.setdefault("trust_remote_code", True)
+        pytorch_model_config.setdefault("batching", "none")
+        pytorch_model_config.setdefault("max_num_seqs", 16)
+        pytorch_model_config.setdefault("enable_prefix_caching", False)
+        pytorch_model_config.setdefault(
+            "prefix_cache_max_memory", DEFAULT_PREFIX_CACHE_MAX_MEMORY
+        )
+        pytorch_model_config.setdefault("static_kv_cache", False)
+        pytorch_model_config.setdefault("prefill_chunk_size", 0)
+        pytorch_model_config.setdefault("prompt_lookup_num_tokens", 0)
+        pytorch_model_config.setdefault("prompt_lookup_max_ngram_size", 3)
+        pytorch_model_config.setdefault("embedding_batch_size", 32)
+        pytorch_model_config.setdefault("compression_cache_max_memory", 0)
+        pytorch_model_config.setdefault("compression_int8_matmul", True)
+        pytorch_model_config.setdefault("cpu_mode", None)
+        pytorch_model_config.setdefault("compile", False)
         return pytorch_model_config
 
     def _sanitize_generate_config(
@@ -129,7 +163,26 @@ class PytorchModel(LLM):
 
         kwargs = {}
 
+        cpu_mode = self._pytorch_model_config.get("cpu_mode")
+        if cpu_mode is not None:
+            if cpu_mode not in CPU_MODES:
+                raise ValueError(
+                    f"CPU mode {cpu_mode} is not supported, "
+                    f"choose from {', '.join(CPU_MODES)}"
+                )
+            if self._device != "cpu":
+                raise ValueError(f"CPU mode is not supported on device {self._device}")
+            if quantization != "none":
+                raise ValueError("CPU mode is not supported with quantization")
+
         dtype = get_device_preferred_dtype(self._device)
+        if cpu_mode == "bf16":
+            if torch.ops.mkldnn._is_mkldnn_bf16_supported():
+                dtype = torch.bfloat16
+            else:
+                logger.warning(
+                    f"The CPU does not support bf16, load model {self.model_uid} in fp32."
+                )
 
         if dtype is not None:
             kwargs["torch_dtype"] = dtype
@@ -191,8 +244,15 @@ class PytorchModel(LLM):
                         torch_dtype=kwargs["torch_dtype"],
                         use_fast=self._use_fast_tokenizer,
                         revision=kwargs["revision"],
+                        cache_max_memory=self._pytorch_model_config[
+                            "compression_cache_max_memory"
+                        ],
+                        int8_matmul=self._pytorch_model_config[
+                            "compression_int8_matmul"
+                        ],
                     )
                     logger.debug(f"Model Memory: {self._model.get_memory_footprint()}")
+                    self._post_load()
                     return
 
         if num_gpus > 0 and is_hf_accelerate_supported(self._device):
@@ -203,7 +263,196 @@ class PytorchModel(LLM):
 
         if not is_device_map_auto:
             self._model.to(self._device)
+        if cpu_mode == "int8":
+            # Quantize the weights of the linear layers to int8 per output
+            # channel, and the activations on the fly at each forward.
+            torch.ao.quantization.quantize_dynamic(
+                self._model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
         logger.debug(f"Model Memory: {self._model.get_memory_footprint()}")
+        self._post_load()
+        if cpu_mode is not None:
+            self._measure_cpu_mode(cpu_mode)
+
+    def _measure_cpu_mode(self, cpu_mode: str):
+        """
+        Record the memory footprint and the decode speed of the model, so the
+        CPU modes of a model can be compared by `describe_model`.
+        """
+        from .utils import get_memory_footprint, measure_decode_speed
+
+        input_ids = self._tokenizer.encode(BENCHMARK_PROMPT)
+        try:
+            tokens_per_second = measure_decode_speed(
+                self._model, input_ids, self._device
+            )
+        except Exception:
+            logger.warning(
+                f"Failed to measure the decode speed of model {self.model_uid}.",
+                exc_info=True,
+            )
+            tokens_per_second = None
+        self._cpu_mode_stats = {
+            "cpu_mode": cpu_mode,
+            "dtype": str(self._model.dtype).replace("torch.", ""),
+            "memory_footprint": get_memory_footprint(self._model),
+            "tokens_per_second": tokens_per_second,
+        }
+        logger.info(f"Model {self.model_uid} CPU mode stats: {self._cpu_mode_stats}")
+
+    @property
+    def cpu_mode_stats(self) -> Dict[str, Any]:
+        return self._cpu_mode_stats
+
+    def _post_load(self):
+        self._init_prefix_cache()
+        self._init_static_kv_cache()
+        self._init_prompt_lookup()
+        self._init_compile()
+        self._start_batch_scheduler()
+
+    def _init_prefix_cache(self):
+        if not self._pytorch_model_config.get("enable_prefix_caching", False):
+            return
+
+        from .prefix_cache import PrefixCache
+        from .utils import has_standard_kv_cache
+
+        if not has_standard_kv_cache(self._model, self._device):
+            logger.warning(
+                f"Prefix caching is not supported by model {self.model_uid}, "
+                f"since its KV cache layout is not supported."
+            )
+            return
+        self._prefix_cache = PrefixCache(
+            max_memory=self._pytorch_model_config.get(
+                "prefix_cache_max_memory", DEFAULT_PREFIX_CACHE_MAX_MEMORY
+            )
+        )
+
+    def _init_static_kv_cache(self):
+        if not self._pytorch_model_config.get("static_kv_cache", False):
+            return
+
+        from .kv_cache import supports_static_kv_cache
+
+        if not supports_static_kv_cache(self._model, self._device):
+            logger.warning(
+                f"Static KV cache is not supported by model {self.model_uid}, "
+                f"fallback to the dynamic KV cache."
+            )
+            return
+        self._static_kv_cache = True
+
+    def _init_prompt_lookup(self):
+        num_tokens = self._pytorch_model_config.get("prompt_lookup_num_tokens", 0)
+        if num_tokens <= 0:
+            return
+
+        from .utils import has_standard_kv_cache
+
+        # The KV cache of the rejected draft tokens is sliced off.
+        if not has_standard_kv_cache(self._model, self._device):
+            logger.warning(
+                f"Prompt lookup decoding is not supported by model {self.model_uid}, "
+                f"since its KV cache layout is not supported."
+            )
+            return
+        self._prompt_lookup_num_tokens = num_tokens
+
+    def _init_compile(self):
+        if not self._pytorch_model_config.get("compile", False):
+            return
+
+        import torch
+
+        from .utils import (
+            compile_decode_step,
+            has_standard_kv_cache,
+            measure_decode_speed,
+        )
+
+        if not hasattr(torch, "compile") or not has_standard_kv_cache(
+            self._model, self._device
+        ):
+            logger.warning(
+                f"Compiling model {self.model_uid} is not supported, "
+                f"fallback to the eager mode."
+            )
+            return
+        decode_model = compile_decode_step(self._model)
+        input_ids = self._tokenizer.encode(BENCHMARK_PROMPT)
+        try:
+            # Compile at load time, the first steps also compile the graphs
+            # for the layout of the KV cache after the prefill and the decode.
+            compile_start = time.perf_counter()
+            measure_decode_speed(
+                self._model,
+                input_ids,
+                self._device,
+                num_tokens=COMPILE_WARMUP_STEPS,
+                decode_model=decode_model,
+                static_kv_cache=self._static_kv_cache,
+            )
+            compile_seconds = time.perf_counter() - compile_start
+            tokens_per_second, eager_tokens_per_second = [
+                measure_decode_speed(
+                    self._model,
+                    input_ids,
+                    self._device,
+                    decode_model=m,
+                    static_kv_cache=self._static_kv_cache,
+                )
+                for m in [decode_model, self._model]
+            ]
+        except Exception:
+            logger.warning(
+                f"Failed to compile model {self.model_uid}, fallback to the eager mode.",
+                exc_info=True,
+            )
+            return
+        self._decode_model = decode_model
+        self._compile_stats = {
+            "compile_seconds": compile_seconds,
+            "decode_step_ms": 1000 / tokens_per_second,
+            "eager_decode_step_ms": 1000 / eager_tokens_per_second,
+        }
+        logger.info(f"Model {self.model_uid} compile stats: {self._compile_stats}")
+
+    @property
+    def compile_stats(self) -> Dict[str, Any]:
+        return self._compile_stats
+
+    def _start_batch_scheduler(self):
+        batching = self._pytorch_model_config.get("batching", "none")
+        if batching == "none":
+            return
+        if batching != "continuous":
+            raise ValueError(f"Batching mode {batching} is not supported")
+
+        from .batch_scheduler import BatchScheduler
+
+        if not BatchScheduler.is_supported(self._model, self._device):
+            logger.warning(
+                f"Continuous batching is not supported by model {self.model_uid}, "
+                f"fallback to generate requests one by one."
+            )
+            return
+        self._batch_scheduler = BatchScheduler(
+            self.model_uid,
+            self._model,
+            self._tokenizer,
+            self._device,
+            max_num_seqs=self._pytorch_model_config.get("max_num_seqs", 16),
+            prefix_cache=self._prefix_cache,
+            prefill_chunk_size=self._pytorch_model_config.get("prefill_chunk_size", 0),
+        )
+        self._batch_scheduler.start()
+
+    def stop_batch_scheduler(self):
+        if self._batch_scheduler is not None:
+            self._batch_scheduler.stop()
+            self._batch_scheduler = None
 
     @classmethod
     def match(
@@ -231,21 +480,20 @@ class PytorchModel(LLM):
     def generate(
         self, prompt: str, generate_config: Optional[PytorchGenerateConfig] = None
     ) -> Union[Completion, Iterator[CompletionChunk]]:
-        from .utils import generate_stream, generate_stream_falcon
-
-        model_family_name = self.model_family.model_name.lower()
+        from .utils import generate_stream
 
         def generator_wrapper(
             prompt: str, generate_config: PytorchGenerateConfig
         ) -> Iterator[CompletionChunk]:
-            if "falcon" in model_family_name:
-                for completion_chunk, completion_usage in generate_stream_falcon(
-                    self.model_uid,
-                    self._model,
-                    self._tokenizer,
-                    prompt,
-                    self._device,
-                    generate_config,
+            if self._batch_scheduler is not None:
+                for completion_chunk, completion_usage in self._batch_scheduler.submit(
+                    prompt, generate_config
+                ):
+                    completion_chunk["usage"] = completion_usage
+                    yield completion_chunk
+            elif parallel:
+                for completion_chunk, completion_usage in self._generate_parallel(
+                    prompt, generate_config
                 ):
                     completion_chunk["usage"] = completion_usage
                     yield completion_chunk
@@ -257,6 +505,16 @@ class PytorchModel(LLM):
                     prompt,
                     self._device,
                     generate_config,
+                    prefix_cache=self._prefix_cache,
+                    static_kv_cache=self._static_kv_cache,
+                    prefill_chunk_size=self._pytorch_model_config.get(
+                        "prefill_chunk_size", 0
+                    ),
+                    prompt_lookup_num_tokens=self._prompt_lookup_num_tokens,
+                    prompt_lookup_max_ngram_size=self._pytorch_model_config.get(
+                        "prompt_lookup_max_ngram_size", 3
+                    ),
+                    decode_model=self._decode_model,
                 ):
                     completion_chunk["usage"] = completion_usage
                     yield completion_chunk
@@ -270,16 +528,19 @@ class PytorchModel(LLM):
         assert self._model is not None
         assert self._tokenizer is not None
 
+        n = generate_config.get("n") or 1
+        parallel = (generate_config.get("best_of") or n) > 1
+
         stream = generate_config.get("stream", False)
         if not stream:
-            if "falcon" in model_family_name:
-                for completion_chunk, completion_usage in generate_stream_falcon(
-                    self.model_uid,
-                    self._model,
-                    self._tokenizer,
-                    prompt,
-                    self._device,
-                    generate_config,
+            if self._batch_scheduler is not None:
+                for completion_chunk, completion_usage in self._batch_scheduler.submit(
+                    prompt, generate_config
+                ):
+                    pass
+            elif parallel:
+                for completion_chunk, completion_usage in self._generate_parallel(
+                    prompt, generate_config
                 ):
                     pass
             else:
@@ -290,6 +551,16 @@ class PytorchModel(LLM):
                     prompt,
                     self._device,
                     generate_config,
+                    prefix_cache=self._prefix_cache,
+                    static_kv_cache=self._static_kv_cache,
+                    prefill_chunk_size=self._pytorch_model_config.get(
+                        "prefill_chunk_size", 0
+                    ),
+                    prompt_lookup_num_tokens=self._prompt_lookup_num_tokens,
+                    prompt_lookup_max_ngram_size=self._pytorch_model_config.get(
+                        "prompt_lookup_max_ngram_size", 3
+                    ),
+                    decode_model=self._decode_model,
                 ):
                     pass
             completion = Completion(
@@ -300,86 +571,78 @@ class PytorchModel(LLM):
                 choices=completion_chunk["choices"],
                 usage=completion_usage,
             )
+            if "timings" in completion_chunk:
+                completion["timings"] = completion_chunk["timings"]
             return completion
         else:
             return generator_wrapper(prompt, generate_config)
 
-    def create_embedding(self, input: Union[str, List[str]]) -> Embedding:
-        try:
-            import torch
-            import torch.nn.functional as F
-        except ImportError as e:
-            raise ImportError(
-                "Could not import torch. Please install it with `pip install torch`."
-            ) from e
-
-        if isinstance(input, str):
-            inputs = [input]
-        else:
-            inputs = input
-
-        tokenizer = self._tokenizer
-        tokenizer.pad_token = tokenizer.eos_token
-        is_llama = "llama" in str(type(self._model))  # llama supports batch inference
-        is_chatglm = "chatglm" in str(type(self._model))
-        if is_llama:
-            encoding = tokenizer.batch_encode_plus(
-                inputs, padding=True, return_tensors="pt"
+    def _generate_parallel(
+        self, prompt: str, generate_config: PytorchGenerateConfig
+    ) -> Iterator[Tuple[CompletionChunk, CompletionUsage]]:
+        """
+        Sample the `best_of` sequences of a request as a batch with a shared
+        prefill, by a batch scheduler for this request only, which runs in the
+        thread of the request.
+        """
+        from .batch_scheduler import BatchScheduler
+
+        if self._batching_supported is None:
+            self._batching_supported = BatchScheduler.is_supported(
+                self._model, self._device
             )
-            input_ids = encoding["input_ids"].to(self._device)
-            attention_mask = encoding["attention_mask"].to(self._device)
-            model_output = self._model(
-                input_ids, attention_mask, output_hidden_states=True
+        if not self._batching_supported:
+            raise ValueError(
+                f"Sampling several sequences is not supported by model {self.model_uid}"
             )
-            data = model_output.hidden_states[-1]
-            mask = attention_mask.unsqueeze(-1).expand(data.size()).float()
-            masked_embeddings = data * mask
-            sum_embeddings = torch.sum(masked_embeddings, dim=1)
-            seq_length = torch.sum(mask, dim=1)
-            embedding = sum_embeddings / seq_length
-            normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-            normalized_embeddings = normalized_embeddings.tolist()
-            token_num = torch.sum(attention_mask).item()
-
-            embedding_list = []
-            for index, data in enumerate(normalized_embeddings):
-                embedding_list.append(
-                    EmbeddingData(index=index, object="embedding", embedding=data)
-                )
 
-            usage = EmbeddingUsage(prompt_tokens=token_num, total_tokens=token_num)
+        n = generate_config.get("n") or 1
+        scheduler = BatchScheduler(
+            self.model_uid,
+            self._model,
+            self._tokenizer,
+            self._device,
+            max_num_seqs=generate_config.get("best_of") or n,
+            prefix_cache=self._prefix_cache,
+            prefill_chunk_size=self._pytorch_model_config.get("prefill_chunk_size", 0),
+        )
+        yield from scheduler.run(prompt, generate_config)
 
-            ret = Embedding(
-                object="list",
-                model=self.model_uid,
-                data=embedding_list,
-                usage=usage,
-            )
+    def create_embedding(
+        self, input: Union[str, List[str]], encoding_format: str = "float"
+    ) -> Embedding:
+        from .utils import embed
 
-        else:
-            embedding = []
-            token_num = 0
-            for index, text in enumerate(inputs):
-                input_ids = tokenizer.encode(text, return_tensors="pt").to(self._device)
-                model_output = self._model(input_ids, output_hidden_states=True)
-                if is_chatglm:
-                    data = (model_output.hidden_states[-1].transpose(0, 1))[0]
-                else:
-                    data = model_output.hidden_states[-1][0]
-                data = F.normalize(torch.mean(data, dim=0), p=2, dim=0)
-                data = data.tolist()
+        check_encoding_format(encoding_format)
 
-                embedding.append(
-                    EmbeddingData(index=index, object="embedding", embedding=data)
-                )
-                token_num += len(input_ids[0])
+        if isinstance(input, str):
+            inputs = [input]
+        else:
+            inputs = input
 
-            usage = EmbeddingUsage(prompt_tokens=token_num, total_tokens=token_num)
-            ret = Embedding(
-                object="list", model=self.model_uid, data=embedding, usage=usage
+        token_ids = [self._tokenizer.encode(text) for text in inputs]
+        embeddings = embed(
+            self._model,
+            token_ids,
+            self._device,
+            batch_size=self._pytorch_model_config["embedding_batch_size"],
+        )
+        embedding_list = [
+            EmbeddingData(
+                index=index,
+                object="embedding",
+                embedding=encode_embedding(data.cpu().numpy(), encoding_format),
             )
-
-        return ret
+            for index, data in enumerate(embeddings)
+        ]
+        token_num = sum(len(ids) for ids in token_ids)
+        usage = EmbeddingUsage(prompt_tokens=token_num, total_tokens=token_num)
+        return Embedding(
+            object="list",
+            model=self.model_uid,
+            data=embedding_list,
+            usage=usage,
+        )
 
 
 class PytorchChatModel(PytorchModel, ChatModelMixin):
@@ -92,6 +92,7 @@ class Internlm2PytorchChatModel(PytorchChatModel):
         chat_history: Optional[List[ChatCompletionMessage]] = None,
         generate_config: Optional[PytorchGenerateConfig] = None,
     ) -> Union[ChatCompletion, Iterator[ChatCompletionChunk]]:
+        self._check_single_sequence(generate_config)
         kwargs: Dict[str, Any] = {}
         generate_config = generate_config or {}
         temperature = generate_config.get("temperature")
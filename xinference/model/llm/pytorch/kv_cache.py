@@ -0,0 +1,206 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+try:
+    from transformers.cache_utils import Cache
+except ImportError:  # transformers < 4.36
+    Cache = object
+
+logger = logging.getLogger(__name__)
+
+
+class StaticKVCache(Cache):
+    """
+    A KV cache preallocated for `max_length` tokens.
+
+    The buffer of a layer is allocated on its first update, since the number
+    of heads, the head size, the dtype and the device are known by then. An
+    update copies the new states into the buffer and returns views of the
+    cached tokens, so a step neither concatenates nor reallocates the cache,
+    and rolling back is just decreasing the length.
+    """
+
+    def __init__(self, max_length: int):
+        self.max_length = max_length
+        self.key_cache: List[torch.Tensor] = []
+        self.value_cache: List[torch.Tensor] = []
+        self._lengths: List[int] = []
+
+    def __len__(self):
+        return len(self.key_cache)
+
+    def __getitem__(self, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        end = self._lengths[layer_idx]
+        return (
+            self.key_cache[layer_idx][:, :, :end],
+            self.value_cache[layer_idx][:, :, :end],
+        )
+
+    def __iter__(self):
+        for layer_idx in range(len(self)):
+            yield self[layer_idx]
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if layer_idx == len(self.key_cache):
+            self.key_cache.append(self._allocate(key_states, self.max_length))
+            self.value_cache.append(self._allocate(value_states, self.max_length))
+            self._lengths.append(0)
+
+        start = self._lengths[layer_idx]
+        end = start + key_states.shape[2]
+        if end > self.key_cache[layer_idx].shape[2]:
+            # Should not happen if `max_length` covers the request, grow the
+            # buffer rather than fail the request.
+            logger.debug(
+                "Grow the KV cache of layer %d from %d to %d tokens.",
+                layer_idx,
+                self.key_cache[layer_idx].shape[2],
+                end,
+            )
+            self.key_cache[layer_idx] = self._grow(self.key_cache[layer_idx], end)
+            self.value_cache[layer_idx] = self._grow(self.value_cache[layer_idx], end)
+        self.key_cache[layer_idx][:, :, start:end] = key_states
+        self.value_cache[layer_idx][:, :, start:end] = value_states
+        self._lengths[layer_idx] = end
+        return self[layer_idx]
+
+    @staticmethod
+    def _allocate(states: torch.Tensor, length: int) -> torch.Tensor:
+        n_batch, n_head, _, n_dim = states.shape
+        return states.new_empty((n_batch, n_head, length, n_dim))
+
+    @classmethod
+    def _grow(cls, buffer: torch.Tensor, length: int) -> torch.Tensor:
+        new_buffer = cls._allocate(buffer, max(length, 2 * buffer.shape[2]))
+        new_buffer[:, :, : buffer.shape[2]] = buffer
+        return new_buffer
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        if layer_idx is None:
+            layer_idx = 0
+        if layer_idx >= len(self._lengths):
+            return 0
+        return self._lengths[layer_idx]
+
+    def get_max_length(self) -> Optional[int]:
+        # The buffers grow if needed, the cached tokens are never evicted.
+        return None
+
+    def crop(self, length: int):
+        """Keep the first `length` tokens only."""
+        self._lengths = [min(n, max(length, 0)) for n in self._lengths]
+
+    def select(self, start: int, indices: List[int]):
+        """Keep the first `start` tokens and the tokens at `start + indices`."""
+        for layer_idx, buffers in enumerate(zip(self.key_cache, self.value_cache)):
+            index = (
+                torch.as_tensor(indices, dtype=torch.long, device=buffers[0].device)
+                + start
+            )
+            for buffer in buffers:
+                # The indexing copies the tokens before they are overwritten.
+                buffer[:, :, start : start + len(indices)] = buffer[:, :, index]
+            self._lengths[layer_idx] = start + len(indices)
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor, torch.Tensor], ...]:
+        """
+        Convert to the tuple format. The cached tokens are copied, so the
+        result does not pin the buffers or change with the later updates.
+        """
+        return tuple((k.clone(), v.clone()) for k, v in self)
+
+    @classmethod
+    def from_legacy_cache(
+        cls, past_key_values: Tuple[Tuple[torch.Tensor, torch.Tensor], ...], max_length
+    ) -> "StaticKVCache":
+        cache = cls(max_length)
+        for layer_idx, (k, v) in enumerate(past_key_values):
+            cache.update(k, v, layer_idx)
+        return cache
+
+
+def rollback_kv_cache(kv_cache, n: int):
+    """Drop the last `n` tokens of the KV cache, e.g. the rejected draft tokens."""
+    if isinstance(kv_cache, StaticKVCache):
+        # Just forget the last n tokens, they are overwritten by the next update.
+        kv_cache.crop(kv_cache.get_seq_length() - n)
+        return kv_cache
+
+    ret = []
+    for k_cache, v_cache in kv_cache:
+        k_cache = k_cache[:, :, :-n, :]  # [1, n_head, n_seq - n, n_dim]
+        v_cache = v_cache[:, :, :-n, :]
+
+        assert isinstance(k_cache, torch.Tensor)
+        assert isinstance(v_cache, torch.Tensor)
+        ret.append((k_cache, v_cache))
+
+    return tuple(ret)
+
+
+def select_kv_cache(kv_cache, start: int, indices: List[int]):
+    """
+    Keep the first `start` tokens of the KV cache and the tokens at
+    `start + indices`, e.g. the accepted path of a token tree.
+    """
+    if isinstance(kv_cache, StaticKVCache):
+        kv_cache.select(start, indices)
+        return kv_cache
+
+    ret = []
+    for k_cache, v_cache in kv_cache:
+        index = (
+            torch.as_tensor(indices, dtype=torch.long, device=k_cache.device) + start
+        )
+        k_cache = torch.cat((k_cache[:, :, :start], k_cache[:, :, index]), dim=2)
+        v_cache = torch.cat((v_cache[:, :, :start], v_cache[:, :, index]), dim=2)
+        ret.append((k_cache, v_cache))
+
+    return tuple(ret)
+
+
+@torch.inference_mode()
+def supports_static_kv_cache(model, device) -> bool:
+    """
+    Whether the decoder-only model works with a `StaticKVCache`, i.e. it keeps
+    the cache passed as `past_key_values` and updates it in place, instead of
+    converting it to the tuple format.
+    """
+    if Cache is object or model.config.is_encoder_decoder:
+        return False
+    input_ids = torch.arange(4, dtype=torch.long, device=device).unsqueeze(0)
+    cache = StaticKVCache(4)
+    try:
+        model(input_ids[:, :3], use_cache=True, past_key_values=cache)
+        out = model(input_ids[:, 3:], use_cache=True, past_key_values=cache)
+        expected = model(input_ids, use_cache=False).logits[:, -1]
+    except Exception:
+        logger.debug("Failed to probe the static KV cache.", exc_info=True)
+        return False
+    return (
+        out.past_key_values is cache
+        and cache.get_seq_length() == 4
+        and torch.allclose(out.logits[:, -1], expected, rtol=1e-2, atol=1e-2)
+    )
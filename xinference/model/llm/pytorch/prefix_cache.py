@@ -0,0 +1,227 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import itertools
+import logging
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+from .utils import KVCache, to_legacy_cache
+
+logger = logging.getLogger(__name__)
+
+
+def _slice_kv_cache(kv_cache: KVCache, start: int, end: int) -> KVCache:
+    return tuple(
+        (
+            k[:, :, start:end, :].contiguous(),
+            v[:, :, start:end, :].contiguous(),
+        )
+        for k, v in kv_cache
+    )
+
+
+def _concat_kv_caches(kv_caches: List[KVCache]) -> KVCache:
+    if len(kv_caches) == 1:
+        return kv_caches[0]
+    return tuple(
+        (
+            torch.cat([kv_cache[i][0] for kv_cache in kv_caches], dim=2),
+            torch.cat([kv_cache[i][1] for kv_cache in kv_caches], dim=2),
+        )
+        for i in range(len(kv_caches[0]))
+    )
+
+
+def _kv_cache_nbytes(kv_cache: KVCache) -> int:
+    return sum(
+        k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv_cache
+    )
+
+
+def _common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class _RadixNode:
+    def __init__(
+        self,
+        token_ids: Tuple[int, ...],
+        kv_cache: Optional[KVCache],
+        parent: Optional["_RadixNode"],
+    ):
+        # The tokens on the edge from the parent, and their KV cache.
+        self.token_ids = token_ids
+        self.kv_cache = kv_cache
+        self.nbytes = _kv_cache_nbytes(kv_cache) if kv_cache is not None else 0
+        self.parent = parent
+        self.children: Dict[int, "_RadixNode"] = {}
+        self.last_access = 0
+
+
+class PrefixCache:
+    """
+    A radix tree of token ids, which keeps the KV cache of the prompts seen before.
+
+    A request looks up the longest cached prefix of its prompt and only prefills
+    the uncached suffix. Each tree node holds the KV cache of its own edge, so a
+    prefix shared by many requests, e.g. the system prompt, is stored only once.
+    The least recently used leaves are evicted once the cached KV tensors exceed
+    `max_memory` bytes.
+
+    The KV cache must be a tuple of `[1, n_head, n_seq, n_dim]` tensors per layer.
+    """
+
+    def __init__(self, max_memory: int):
+        self._max_memory = max_memory
+        self._root = _RadixNode((), None, None)
+        self._memory = 0
+        self._clock = itertools.count(1)
+        self._lock = threading.Lock()
+
+        # stats.
+        self._num_queried_tokens = 0
+        self._num_hit_tokens = 0
+
+    @property
+    def memory_usage(self) -> int:
+        return self._memory
+
+    @property
+    def hit_rate(self) -> float:
+        if self._num_queried_tokens == 0:
+            return 0.0
+        return self._num_hit_tokens / self._num_queried_tokens
+
+    def match(self, token_ids: Sequence[int]) -> Tuple[int, Optional[KVCache]]:
+        """
+        Find the longest cached prefix of `token_ids`.
+
+        The last token is never matched, since its logits are needed to sample the
+        next token.
+
+        Returns
+        -------
+        int
+            The number of matched tokens.
+        Optional[KVCache]
+            The KV cache of the matched tokens, None if nothing is matched.
+        """
+        token_ids = token_ids[:-1]
+        with self._lock:
+            access = next(self._clock)
+            node = self._root
+            pos = 0
+            kv_caches = []
+            while pos < len(token_ids):
+                child = node.children.get(token_ids[pos])
+                if child is None:
+                    break
+                assert child.kv_cache is not None
+                n = _common_prefix_length(child.token_ids, token_ids[pos:])
+                child.last_access = access
+                if n < len(child.token_ids):
+                    kv_caches.append(_slice_kv_cache(child.kv_cache, 0, n))
+                    pos += n
+                    break
+                kv_caches.append(child.kv_cache)
+                pos += n
+                node = child
+
+            self._num_queried_tokens += len(token_ids)
+            self._num_hit_tokens += pos
+            if pos == 0:
+                return 0, None
+            # Concatenate under the lock, the nodes may be split or evicted later.
+            return pos, _concat_kv_caches(kv_caches)
+
+    def insert(self, token_ids: Sequence[int], kv_cache) -> None:
+        """Cache the KV cache of `token_ids`, the tokens cached already are skipped."""
+        kv_cache = to_legacy_cache(kv_cache)
+        if not token_ids or kv_cache[0][0].shape[2] != len(token_ids):
+            logger.debug(
+                "Skip caching, the KV cache does not match the %d tokens.",
+                len(token_ids),
+            )
+            return
+        token_ids = tuple(token_ids)
+        with self._lock:
+            access = next(self._clock)
+            node = self._root
+            pos = 0
+            while pos < len(token_ids):
+                child = node.children.get(token_ids[pos])
+                if child is None:
+                    new_node = _RadixNode(
+                        token_ids[pos:],
+                        _slice_kv_cache(kv_cache, pos, len(token_ids)),
+                        node,
+                    )
+                    new_node.last_access = access
+                    node.children[token_ids[pos]] = new_node
+                    self._memory += new_node.nbytes
+                    break
+                n = _common_prefix_length(child.token_ids, token_ids[pos:])
+                if n < len(child.token_ids):
+                    child = self._split(child, n)
+                child.last_access = access
+                pos += n
+                node = child
+            self._evict()
+
+    def _split(self, node: _RadixNode, n: int) -> _RadixNode:
+        """Split the edge of `node` at `n`, and return the new node of the prefix."""
+        assert node.parent is not None and node.kv_cache is not None
+        prefix = _RadixNode(
+            node.token_ids[:n], _slice_kv_cache(node.kv_cache, 0, n), node.parent
+        )
+        prefix.last_access = node.last_access
+        node.parent.children[node.token_ids[0]] = prefix
+        kv_cache = _slice_kv_cache(node.kv_cache, n, len(node.token_ids))
+        self._memory -= node.nbytes
+        node.token_ids = node.token_ids[n:]
+        node.kv_cache = kv_cache
+        node.nbytes = _kv_cache_nbytes(kv_cache)
+        node.parent = prefix
+        prefix.children[node.token_ids[0]] = node
+        self._memory += prefix.nbytes + node.nbytes
+        return prefix
+
+    def _evict(self):
+        if self._memory <= self._max_memory:
+            return
+        leaves = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            elif node is not self._root:
+                leaves.append((node.last_access, id(node), node))
+        heapq.heapify(leaves)
+        while self._memory > self._max_memory and leaves:
+            _, _, leaf = heapq.heappop(leaves)
+            parent = leaf.parent
+            assert parent is not None
+            del parent.children[leaf.token_ids[0]]
+            self._memory -= leaf.nbytes
+            if not parent.children and parent is not self._root:
+                heapq.heappush(leaves, (parent.last_access, id(parent), parent))
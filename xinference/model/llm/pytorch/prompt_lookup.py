@@ -0,0 +1,86 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Dict, List, Tuple
+
+import torch
+
+from .sampler import Sampler
+
+
+class PromptLookup:
+    """
+    Propose the draft tokens of prompt lookup decoding, without a draft model.
+
+    The last n tokens, for n from `max_ngram_size` down to 1, are looked up in
+    the prompt and the output so far, and the tokens following their latest
+    occurrence are proposed. An index maps each n-gram to the position after
+    its latest occurrence, and is updated as the tokens are appended, so a
+    lookup does not scan the tokens.
+    """
+
+    def __init__(self, token_ids: List[int], num_tokens: int, max_ngram_size: int = 3):
+        if num_tokens < 1 or max_ngram_size < 1:
+            raise ValueError("The number of tokens and the n-gram size must be >= 1.")
+        self._token_ids = token_ids
+        self._num_tokens = num_tokens
+        self._max_ngram_size = max_ngram_size
+        self._index: Dict[Tuple[int, ...], int] = {}
+        # The number of tokens followed by another one which are indexed.
+        self._num_indexed = 0
+        self._update()
+
+    def _update(self):
+        token_ids = self._token_ids
+        for end in range(self._num_indexed + 1, len(token_ids)):
+            # The n-grams ending right before the token at `end`.
+            for n in range(1, min(self._max_ngram_size, end) + 1):
+                self._index[tuple(token_ids[end - n : end])] = end
+        self._num_indexed = max(len(token_ids) - 1, 0)
+
+    def propose(self) -> List[int]:
+        """
+        Propose the tokens following `token_ids`, which may have been appended
+        to since the last call.
+        """
+        self._update()
+        token_ids = self._token_ids
+        for n in range(min(self._max_ngram_size, len(token_ids)), 0, -1):
+            start = self._index.get(tuple(token_ids[-n:]))
+            if start is not None:
+                return token_ids[start : start + self._num_tokens]
+        return []
+
+
+def verify(sampler: Sampler, logits: torch.Tensor, candidates: List[int]) -> List[int]:
+    """
+    Verify the draft `candidates` with the `logits` of shape
+    `[len(candidates) + 1, n_vocab]`, computed by feeding the last token and
+    the candidates, and return the generated tokens.
+
+    The token of each position is sampled from the logits, and the candidate
+    is accepted if they are the same. Sampling is stopped at the first rejected
+    candidate, or after the candidates are all accepted, so one more token than
+    the accepted candidates is generated. This is speculative sampling with a
+    draft distribution concentrated on the candidate, the tokens have the same
+    distribution as generated one by one. The sampler counts the tokens.
+    """
+    tokens: List[int] = []
+    for i in range(len(candidates) + 1):
+        token = sampler.sample(logits[i : i + 1])[0]
+        sampler.update([token])
+        tokens.append(token)
+        if i == len(candidates) or token != candidates[i]:
+            break
+    return tokens
@@ -117,6 +117,7 @@ class QwenVLChatModel(PytorchChatModel):
             raise Exception(
                 f"Chat with model {self.model_family.model_name} does not support stream."
             )
+        self._check_single_sequence(generate_config)
         prompt = self._message_content_to_qwen(prompt)
         # Convert openai history to qwen vl history
         qwen_history = []
@@ -0,0 +1,189 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List, Optional, Union
+
+import torch
+from torch.nn import functional as F
+
+from ....types import PytorchGenerateConfig
+
+
+class Sampler:
+    """
+    Sample the next tokens of a batch of sequences in one vectorized pass.
+
+    Each row has its own temperature, repetition penalty, top-p and top-k,
+    which are applied in this order like the logits processors of transformers.
+    A row is greedy if its temperature or top-p is about 0.
+
+    The repetition penalty is applied to the tokens counted on the device, the
+    counts are updated with the sampled tokens, so a step does not depend on
+    the length of the sequences.
+    """
+
+    def __init__(self, device: Union[str, torch.device]):
+        self._device = torch.device(device)
+        self._temperature = torch.empty(0, device=self._device)
+        self._repetition_penalty = torch.empty(0, device=self._device)
+        self._top_p = torch.empty(0, device=self._device)
+        self._top_k = torch.empty(0, dtype=torch.long, device=self._device)
+        # [n_batch, n_vocab], allocated once a row has a repetition penalty.
+        self._counts: Optional[torch.Tensor] = None
+        # Kept on the host to skip the unused steps without a device sync.
+        self._greedy: List[bool] = []
+        self._top_p_or_k: List[bool] = []
+
+    @property
+    def batch_size(self) -> int:
+        return len(self._greedy)
+
+    @torch.inference_mode()
+    def add(self, token_ids: List[int], generate_config: PytorchGenerateConfig):
+        """Add a row for a sequence starting with `token_ids`."""
+        temperature = float(generate_config.get("temperature", 1.0))
+        repetition_penalty = float(generate_config.get("repetition_penalty", 1.0))
+        top_p = float(generate_config.get("top_p", 1.0))
+        top_k = int(generate_config.get("top_k", -1))  # -1 means disable
+
+        greedy = temperature < 1e-5 or top_p < 1e-8
+        if greedy:
+            temperature, top_p, top_k = 0.0, 1.0, -1
+        self._greedy.append(greedy)
+        self._top_p_or_k.append(top_p < 1.0 or top_k > 0)
+        self._temperature = self._append(self._temperature, temperature)
+        self._repetition_penalty = self._append(
+            self._repetition_penalty, max(repetition_penalty, 1.0)
+        )
+        self._top_p = self._append(self._top_p, min(top_p, 1.0))
+        self._top_k = self._append(self._top_k, top_k)
+
+        if repetition_penalty <= 1.0 and self._counts is None:
+            return
+        counts = torch.bincount(
+            torch.as_tensor(token_ids, dtype=torch.long, device=self._device),
+            minlength=0 if self._counts is None else self._counts.shape[1],
+        ).to(torch.int32)
+        if self._counts is None:
+            self._counts = torch.zeros(
+                (self.batch_size - 1, counts.shape[0]),
+                dtype=torch.int32,
+                device=self._device,
+            )
+        elif self._counts.shape[1] < counts.shape[0]:
+            self._counts = F.pad(
+                self._counts, (0, counts.shape[0] - self._counts.shape[1])
+            )
+        self._counts = torch.cat((self._counts, counts.unsqueeze(0)), dim=0)
+
+    def _append(self, t: torch.Tensor, value) -> torch.Tensor:
+        return torch.cat((t, torch.tensor([value], dtype=t.dtype, device=t.device)))
+
+    @torch.inference_mode()
+    def select(self, index: List[int]):
+        """Keep the rows in `index` only."""
+        self._greedy = [self._greedy[i] for i in index]
+        self._top_p_or_k = [self._top_p_or_k[i] for i in index]
+        index = torch.as_tensor(index, dtype=torch.long, device=self._device)
+        self._temperature = self._temperature.index_select(0, index)
+        self._repetition_penalty = self._repetition_penalty.index_select(0, index)
+        self._top_p = self._top_p.index_select(0, index)
+        self._top_k = self._top_k.index_select(0, index)
+        if self._counts is not None:
+            self._counts = self._counts.index_select(0, index)
+
+    @torch.inference_mode()
+    def sample(
+        self,
+        logits: torch.Tensor,
+        index: Optional[List[int]] = None,
+        exclude: Optional[List[int]] = None,
+    ) -> List[int]:
+        """
+        Sample the next tokens from the last token logits of shape
+        `[n_rows, n_vocab]`, the rows are `index` of the batch, or the whole
+        batch if it is None. The tokens in `exclude`, one per row, are never
+        sampled. The counts are not updated, see `update`.
+        """
+        logits = logits.to(self._device, torch.float32)
+        n_vocab = logits.shape[1]
+        if self._counts is not None:
+            self._counts = self._pad_counts(self._counts, n_vocab)
+
+        rows = list(range(self.batch_size)) if index is None else index
+        temperature = self._temperature
+        repetition_penalty = self._repetition_penalty
+        top_p = self._top_p
+        top_k = self._top_k
+        counts = self._counts
+        if index is not None:
+            index_t = torch.as_tensor(index, dtype=torch.long, device=self._device)
+            temperature = temperature.index_select(0, index_t)
+            repetition_penalty = repetition_penalty.index_select(0, index_t)
+            top_p = top_p.index_select(0, index_t)
+            top_k = top_k.index_select(0, index_t)
+            if counts is not None:
+                counts = counts.index_select(0, index_t)
+
+        if counts is not None:
+            penalty = repetition_penalty.unsqueeze(1)
+            penalized = torch.where(logits < 0, logits * penalty, logits / penalty)
+            logits = torch.where(counts > 0, penalized, logits)
+        if exclude is not None:
+            exclude_t = torch.as_tensor(exclude, dtype=torch.long, device=self._device)
+            logits = logits.scatter(1, exclude_t.view(-1, 1), float("-inf"))
+
+        greedy_tokens = torch.argmax(logits, dim=-1)
+        if all(self._greedy[i] for i in rows):
+            return greedy_tokens.tolist()
+
+        greedy = temperature == 0
+        logits = logits / torch.where(greedy, 1.0, temperature).unsqueeze(1)
+        if any(self._top_p_or_k[i] for i in rows):
+            sorted_logits, sorted_indices = torch.sort(logits, dim=-1, descending=True)
+            probs = sorted_logits.softmax(dim=-1)
+            # Remove the tokens once the cumulative probability before them
+            # reaches top-p, so at least one token is kept.
+            remove = (probs.cumsum(dim=-1) - probs >= top_p.unsqueeze(1)) & (
+                top_p < 1.0
+            ).unsqueeze(1)
+            ranks = torch.arange(n_vocab, device=self._device).unsqueeze(0)
+            remove |= (ranks >= top_k.unsqueeze(1)) & (top_k > 0).unsqueeze(1)
+            sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+            logits = torch.empty_like(logits).scatter_(1, sorted_indices, sorted_logits)
+
+        probs = torch.softmax(logits, dim=-1)
+        sampled_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+        return torch.where(greedy, greedy_tokens, sampled_tokens).tolist()
+
+    @torch.inference_mode()
+    def update(self, tokens: List[int], index: Optional[List[int]] = None):
+        """Count the `tokens` appended to the rows `index` of the batch."""
+        if self._counts is None:
+            return
+        self._counts = self._pad_counts(self._counts, max(tokens) + 1)
+        tokens_t = torch.as_tensor(tokens, dtype=torch.long, device=self._device)
+        tokens_t = tokens_t.view(-1, 1)
+        ones = torch.ones_like(tokens_t, dtype=torch.int32)
+        if index is None:
+            self._counts.scatter_add_(1, tokens_t, ones)
+        else:
+            index_t = torch.as_tensor(index, dtype=torch.long, device=self._device)
+            self._counts[index_t] = self._counts[index_t].scatter_add(1, tokens_t, ones)
+
+    @staticmethod
+    def _pad_counts(counts: torch.Tensor, n_vocab: int) -> torch.Tensor:
+        if counts.shape[1] < n_vocab:
+            return F.pad(counts, (0, n_vocab - counts.shape[1]))
+        return counts
@@ -11,13 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import gc
+import copy
 import logging
+import threading
 import time
 import uuid
-from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
-
-from ....device_utils import empty_cache
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 try:
     import torch
@@ -46,6 +45,9 @@ except ImportError:
 
 
 from ....types import CompletionChoice, CompletionChunk, CompletionUsage
+from .kv_cache import StaticKVCache, rollback_kv_cache, select_kv_cache
+from .stop_matcher import StopMatcher
+from .utils import IncrementalDetokenizer, tokenize
 
 logger = logging.getLogger(__name__)
 
@@ -147,36 +149,97 @@ def sample(
     return tokens[0]
 
 
-def rollback_kv_cache(
-    kv_cache: Tuple[Tuple[torch.Tensor, torch.Tensor], ...], n: int
-) -> Tuple[Tuple[torch.Tensor, torch.Tensor], ...]:
-    ret = []
-    for k_cache, v_cache in kv_cache:
-        k_cache = k_cache[:, :, :-n, :]  # [1, n_head, n_seq - n, n_dim]
-        v_cache = v_cache[:, :, :-n, :]
+def rollback_logits(logits: torch.Tensor, n: int):
+    return logits[:, :-n, :]  # [1, n_seq, n_vocab]
 
-        assert isinstance(k_cache, torch.Tensor)
-        assert isinstance(v_cache, torch.Tensor)
-        ret.append((k_cache, v_cache))
 
-    return tuple(ret)
+class DraftLengthController:
+    """
+    Choose the draft length `gamma` from the rolling acceptance rate.
 
+    If a draft token is accepted with the rate `a`, a round of `gamma` draft
+    tokens generates `(1 - a ** (gamma + 1)) / (1 - a)` tokens on average, for
+    `gamma` forwards of the draft model and one forward of the target model.
+    The gamma generating the most tokens per unit of time is chosen, the cost
+    of a draft forward relative to a target forward is measured as well.
 
-def rollback_logits(logits: torch.Tensor, n: int):
-    return logits[:, :-n, :]  # [1, n_seq, n_vocab]
+    A request updates its own copy, see `fork`, and the model remembers the
+    state of the last finished request, see `merge`.
+    """
+
+    def __init__(
+        self,
+        gamma: int = 4,
+        min_gamma: int = 1,
+        max_gamma: int = 16,
+        decay: float = 0.8,
+    ):
+        if not 1 <= min_gamma <= gamma <= max_gamma:
+            raise ValueError("The gamma must be in [min_gamma, max_gamma].")
+        self.gamma = gamma
+        self.min_gamma = min_gamma
+        self.max_gamma = max_gamma
+        self._decay = decay
+        # The exponential moving averages over the rounds.
+        self.acceptance_rate: Optional[float] = None
+        self.tokens_per_forward: Optional[float] = None
+        self._cost_ratio: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _average(self, average: Optional[float], value: float) -> float:
+        if average is None:
+            return value
+        return self._decay * average + (1 - self._decay) * value
+
+    def update(
+        self,
+        num_draft_tokens: int,
+        num_accepted_tokens: int,
+        draft_seconds: float,
+        target_seconds: float,
+    ) -> int:
+        """Update the averages with a round, and return the next gamma."""
+        self.acceptance_rate = self._average(
+            self.acceptance_rate, num_accepted_tokens / num_draft_tokens
+        )
+        # The rejected draft token is replaced by a token of the target model.
+        self.tokens_per_forward = self._average(
+            self.tokens_per_forward, num_accepted_tokens + 1
+        )
+        if target_seconds > 0:
+            self._cost_ratio = self._average(
+                self._cost_ratio, draft_seconds / num_draft_tokens / target_seconds
+            )
+        self.gamma = self._best_gamma()
+        return self.gamma
+
+    def _best_gamma(self) -> int:
+        assert self.acceptance_rate is not None
+        a = min(self.acceptance_rate, 0.99)
+        c = self._cost_ratio or 0.0
+
+        def _speed(gamma: int) -> float:
+            return (1 - a ** (gamma + 1)) / (1 - a) / (gamma * c + 1)
 
+        return max(range(self.min_gamma, self.max_gamma + 1), key=_speed)
 
-def is_partial_stop(output: str, stop_str: str):
-    """Check whether the output contains a partial stop str."""
-    for i in range(0, min(len(output), len(stop_str))):
-        if stop_str.startswith(output[-i:]):
-            return True
-    return False
+    def fork(self) -> "DraftLengthController":
+        with self._lock:
+            forked = copy.copy(self)
+        forked._lock = threading.Lock()
+        return forked
+
+    def merge(self, other: "DraftLengthController"):
+        with self._lock:
+            self.gamma = other.gamma
+            self.acceptance_rate = other.acceptance_rate
+            self.tokens_per_forward = other.tokens_per_forward
+            self._cost_ratio = other._cost_ratio
 
 
 def draft(
     input_ids: List[int],
-    kv_cache: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]],
+    kv_cache,
     logits: Optional[torch.FloatTensor],
     draft_model: "PreTrainedModel",
     gamma: int,
@@ -193,6 +256,10 @@ def draft(
         On the decode stage. It includes the prompt tokens, the token generated by the original model
         at the end of each full iteration, or the token generated by the draft model draft
         iteration.
+    kv_cache
+        The KV cache, None or an empty `StaticKVCache` on the prefill stage.
+    logits : Optional[torch.FloatTensor]
+        The logits, None on the prefill stage.
 
     Returns
     -------
@@ -200,23 +267,24 @@ def draft(
         The number of generated draft tokens.
     List[int]
         Outputs, including the draft tokens.
-    Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+    Tuple[Tuple[torch.Tensor, torch.Tensor], ...] or StaticKVCache
         KV cache.
     torch.FloatTensor
         Logits.
     """
     draft_output_ids = input_ids.copy()
 
-    if kv_cache is not None:
+    if logits is not None:
         input_ids = draft_output_ids[-2:]
 
     num_draft_tokens = 0
     while num_draft_tokens < gamma:
-        if kv_cache is None:
+        if logits is None:
             # prefill.
             draft_model_out = draft_model(
                 torch.as_tensor([input_ids], device=draft_model.device),
                 use_cache=True,
+                past_key_values=kv_cache,
             )
             logits = normalize_logits(
                 logits_processor, input_ids, draft_model_out.logits
@@ -246,6 +314,220 @@ def draft(
     return num_draft_tokens, draft_output_ids, kv_cache, logits
 
 
+def tree_attention_mask(
+    num_cached: int,
+    num_linear: int,
+    visible: torch.Tensor,
+    dtype: torch.dtype,
+    device,
+) -> torch.Tensor:
+    """
+    Build the 4D attention mask of `num_linear` tokens followed by the nodes
+    of a token tree, given `num_cached` tokens in the KV cache.
+
+    The linear tokens attend to the cached tokens and to each other causally.
+    A node attends to all the cached and linear tokens, and to the nodes of
+    the same branch according to `visible` of shape `[n_node, n_tree]`, the
+    nodes being the last `n_node` of the `n_tree` ones in the cache.
+    """
+    n_node, n_tree = visible.shape
+    n_query = num_linear + n_node
+    mask = torch.zeros(
+        (n_query, num_cached + num_linear + n_tree), dtype=dtype, device=device
+    )
+    mask[:, :num_cached] = 1
+    mask[:num_linear, num_cached : num_cached + num_linear] = torch.tril(
+        torch.ones((num_linear, num_linear), dtype=dtype, device=device)
+    )
+    mask[num_linear:, num_cached : num_cached + num_linear] = 1
+    mask[num_linear:, num_cached + num_linear :] = visible.to(
+        device=device, dtype=dtype
+    )
+    return mask[None, None]
+
+
+@torch.inference_mode()
+def supports_tree_attention(model: "PreTrainedModel", device) -> bool:
+    """
+    Whether the decoder-only model verifies a token tree correctly, i.e. it
+    takes a 4D attention mask and the position ids along with the KV cache.
+    """
+    if model.config.is_encoder_decoder:
+        return False
+    input_ids = torch.arange(5, dtype=torch.long, device=device).unsqueeze(0)
+    # The last two tokens are siblings, both following the first three.
+    mask = tree_attention_mask(
+        3, 0, torch.eye(2, dtype=torch.bool), model.dtype, device
+    )
+    try:
+        out = model(input_ids[:, :3], use_cache=True)
+        out = model(
+            input_ids[:, 3:],
+            attention_mask=mask,
+            position_ids=torch.tensor([[3, 3]], device=device),
+            use_cache=True,
+            past_key_values=out.past_key_values,
+        )
+        expected = [
+            model(input_ids[:, [0, 1, 2, i]], use_cache=False).logits[:, -1]
+            for i in (3, 4)
+        ]
+    except Exception:
+        logger.debug("Failed to probe the tree attention.", exc_info=True)
+        return False
+    return all(
+        torch.allclose(out.logits[:, i], expected[i], rtol=1e-2, atol=1e-2)
+        for i in range(2)
+    )
+
+
+class TreeSpeculation:
+    """
+    Draft a token tree of `num_branches` branches, the top tokens of the draft
+    model following the output, each extended greedily to `gamma` tokens. The
+    target model verifies all the branches in a single forward, with an
+    attention mask restricting each node to the tokens of its own branch.
+
+    The token of each position is sampled from the target model, and the path
+    goes on while it matches a child of the current node, so the tokens have
+    the same distribution as without speculation. The KV caches keep the
+    accepted path only.
+    """
+
+    def __init__(
+        self,
+        draft_model: "PreTrainedModel",
+        model: "PreTrainedModel",
+        num_branches: int,
+        logits_processor: LogitsProcessorList,
+        temperature: float,
+        top_p: float,
+        draft_kv_cache: Any = None,
+        kv_cache: Any = None,
+    ):
+        self._draft_model = draft_model
+        self._model = model
+        self._num_branches = num_branches
+        self._logits_processor = logits_processor
+        self._temperature = temperature
+        self._top_p = top_p
+        self._draft_kv_cache = draft_kv_cache
+        self._kv_cache = kv_cache
+        # The number of output tokens in the KV caches.
+        self._num_draft_cached = 0
+        self._num_cached = 0
+
+    def _visible(self, gamma: int) -> torch.Tensor:
+        # The node `i` is at the depth `i // num_branches` of the branch
+        # `i % num_branches`.
+        nodes = torch.arange(gamma * self._num_branches)
+        branch = nodes % self._num_branches
+        return (branch[:, None] == branch[None, :]) & (nodes[:, None] >= nodes)
+
+    def _draft(self, output_ids: List[int], gamma: int) -> List[int]:
+        model = self._draft_model
+        k = self._num_branches
+        out = model(
+            torch.as_tensor(
+                [output_ids[self._num_draft_cached :]], device=model.device
+            ),
+            use_cache=True,
+            past_key_values=self._draft_kv_cache,
+        )
+        # The warpers keep the order of the logits, the top tokens of the
+        # draft model are the top logits.
+        nodes = torch.topk(out.logits[0, -1], k).indices.tolist()
+        visible = self._visible(gamma)
+        num_cached = len(output_ids)
+        for depth in range(1, gamma):
+            out = model(
+                torch.as_tensor([nodes[-k:]], device=model.device),
+                attention_mask=tree_attention_mask(
+                    num_cached,
+                    0,
+                    visible[(depth - 1) * k : depth * k, : depth * k],
+                    model.dtype,
+                    model.device,
+                ),
+                position_ids=torch.full(
+                    (1, k), num_cached + depth - 1, device=model.device
+                ),
+                use_cache=True,
+                past_key_values=out.past_key_values,
+            )
+            nodes.extend(out.logits[0].argmax(dim=-1).tolist())
+        self._draft_kv_cache = out.past_key_values
+        return nodes
+
+    def _verify(self, output_ids: List[int], nodes: List[int], gamma: int):
+        model = self._model
+        k = self._num_branches
+        linear_ids = output_ids[self._num_cached :]
+        num_linear = len(linear_ids)
+        position_ids = list(range(self._num_cached, len(output_ids))) + [
+            len(output_ids) + i // k for i in range(len(nodes))
+        ]
+        out = model(
+            torch.as_tensor([linear_ids + nodes], device=model.device),
+            attention_mask=tree_attention_mask(
+                self._num_cached,
+                num_linear,
+                self._visible(gamma),
+                model.dtype,
+                model.device,
+            ),
+            position_ids=torch.as_tensor([position_ids], device=model.device),
+            use_cache=True,
+            past_key_values=self._kv_cache,
+        )
+        self._kv_cache = out.past_key_values
+
+        path: List[int] = []
+        row = num_linear - 1
+        while True:
+            normalized = normalize_logits(
+                self._logits_processor,
+                output_ids + [nodes[i] for i in path],
+                out.logits[:, row : row + 1],
+            )
+            token = sample(normalized[0, -1, :], self._temperature, self._top_p)
+            depth = len(path)
+            if depth == 0:
+                children = range(k)
+            elif depth < gamma:
+                children = range(path[-1] + k, path[-1] + k + 1)
+            else:
+                children = range(0)
+            child = next((i for i in children if nodes[i] == token), None)
+            if child is None:
+                return path, token
+            path.append(child)
+            row = num_linear + child
+
+    def step(self, output_ids: List[int], gamma: int) -> Tuple[List[int], int, float]:
+        """
+        Run a round, return the generated tokens, the number of the accepted
+        draft tokens, and the seconds spent on drafting.
+        """
+        start = time.time()
+        nodes = self._draft(output_ids, gamma)
+        draft_seconds = time.time() - start
+        path, token = self._verify(output_ids, nodes, gamma)
+
+        num_linear = len(output_ids) - self._num_cached
+        self._kv_cache = select_kv_cache(
+            self._kv_cache, self._num_cached + num_linear, path
+        )
+        self._num_cached = len(output_ids) + len(path)
+        # The nodes of the last depth have not been fed to the draft model.
+        draft_path = [i for i in path if i < (gamma - 1) * self._num_branches]
+        self._draft_kv_cache = select_kv_cache(
+            self._draft_kv_cache, len(output_ids), draft_path
+        )
+        self._num_draft_cached = len(output_ids) + len(draft_path)
+        return [nodes[i] for i in path] + [token], len(path), draft_seconds
+
+
 @torch.inference_mode()
 def speculative_generate_stream(
     model_uid: str,
@@ -254,7 +536,20 @@ def speculative_generate_stream(
     tokenizer: "PreTrainedTokenizer",
     prompt: str,
     generate_config: Dict[str, Any],
+    static_kv_cache: bool = False,
+    draft_length_controller: Optional[DraftLengthController] = None,
+    tree_attention: bool = False,
 ) -> Iterator[Tuple[CompletionChunk, CompletionUsage]]:
+    """
+    Generate with the draft model proposing `gamma` tokens per round. The
+    gamma of the request is fixed if it is set in `generate_config`, otherwise
+    it is adapted by a fork of `draft_length_controller`, which remembers the
+    final state of the request.
+
+    With `num_branches` greater than 1 in `generate_config`, a token tree is
+    drafted and verified per round, see `TreeSpeculation`. It requires both
+    models to support the tree attention, see `supports_tree_attention`.
+    """
     logger.debug(
         f"Enter speculative_generate_stream, prompt: {prompt}, generate_config: {generate_config}"
     )
@@ -265,7 +560,17 @@ def speculative_generate_stream(
             "repetition penalty is not supported by speculative decoding yet"
         )
 
-    gamma = generate_config.get("gamma", 4)
+    fixed_gamma = generate_config.get("gamma")
+    controller = (
+        draft_length_controller.fork()
+        if draft_length_controller is not None
+        else DraftLengthController()
+    )
+    gamma = fixed_gamma or controller.gamma
+    num_branches = int(generate_config.get("num_branches", 1))
+    if num_branches > 1 and not tree_attention:
+        logger.debug("Tree attention is not supported, draft a single branch.")
+        num_branches = 1
     stream = generate_config.get("stream", False)
     temperature = float(generate_config.get("temperature", 1.0))
     top_p = float(generate_config.get("top_p", 1.0))
@@ -278,21 +583,52 @@ def speculative_generate_stream(
 
     logits_processor = prepare_logits_processor(temperature, top_p, top_k)
     request_id = str(uuid.uuid1())
+    stop_matcher = StopMatcher(stop_str) if stop_str else None
+    rfind_start = len(prompt) if echo else 0
+    # The stop words have been searched in the text before this offset.
+    checked_length = rfind_start
 
-    if "qwen" in str(type(model)).lower():
-        # TODO: hacky.
-        input_ids = tokenizer(prompt, allowed_special="all").input_ids
-    else:
-        input_ids = tokenizer(prompt).input_ids
+    input_ids = tokenize(model, tokenizer, prompt)
 
     num_prompt_tokens = len(input_ids)
     output_ids = list(input_ids)
+    # The verified tokens only, the draft tokens are appended to `output_ids`
+    # before they are verified.
+    detokenized_ids = list(output_ids)
+    detokenizer = IncrementalDetokenizer(
+        tokenizer, detokenized_ids, 0 if echo else num_prompt_tokens
+    )
+    stop_pos = None
 
     # internal states.
-    draft_kv_cache = None
+    draft_kv_cache: Any = None
     draft_logits = None
-    kv_cache = None
+    kv_cache: Any = None
     logits = None
+    if static_kv_cache:
+        # The draft tokens may exceed max_tokens by the size of the tree.
+        max_length = (
+            num_prompt_tokens
+            + max_new_tokens
+            + num_branches * max(gamma, controller.max_gamma)
+            + 1
+        )
+        draft_kv_cache = StaticKVCache(max_length)
+        kv_cache = StaticKVCache(max_length)
+    tree = (
+        TreeSpeculation(
+            draft_model,
+            model,
+            num_branches,
+            logits_processor,
+            temperature,
+            top_p,
+            draft_kv_cache=draft_kv_cache,
+            kv_cache=kv_cache,
+        )
+        if num_branches > 1
+        else None
+    )
     next_token = (
         None  # the token generated by the original model at each full iteration.
     )
@@ -309,92 +645,133 @@ def speculative_generate_stream(
     while len(output_ids) < max_new_tokens + num_prompt_tokens:
         # allow the draft model to generate more than max_tokens since some of the generated
         # tokens could be rejected.
-        start = time.time()
-        num_draft_tokens, output_ids, draft_kv_cache, draft_logits = draft(
-            input_ids=output_ids,
-            kv_cache=draft_kv_cache,
-            logits=draft_logits,
-            draft_model=draft_model,
-            gamma=gamma,
-            logits_processor=logits_processor,
-            temperature=temperature
-            * 0.5,  # make the draft model outputs less random for better quality.
-            top_p=top_p,
-        )
-        total_seconds_on_drafting += time.time() - start
-        total_num_draft_tokens += num_draft_tokens
-
-        # eval stage.
-        start = time.time()
-        if kv_cache is None:
-            # prefill.
-            out = model(
-                torch.as_tensor([output_ids], device=model.device), use_cache=True
-            )
-            logits = normalize_logits(logits_processor, output_ids, out.logits)
+        round_start = start = time.time()
+        if tree is not None:
+            tokens, accepted, draft_seconds = tree.step(output_ids, gamma)
+            num_draft_tokens = gamma
+            start_eval = round_start + draft_seconds
+            stopped = False
+            for i, token in enumerate(tokens):
+                if token in stop_token_ids:
+                    tokens = tokens[: i + 1]
+                    stopped = True
+                    break
+            output_ids.extend(tokens)
+            total_seconds_on_drafting += draft_seconds
+            total_seconds_on_eval += time.time() - start_eval
+            total_num_draft_tokens += num_draft_tokens
+            total_num_accepted_tokens += accepted
         else:
-            out = model(
-                torch.as_tensor(
-                    [[next_token] + output_ids[-num_draft_tokens:]], device=model.device
-                ),
-                use_cache=True,
-                past_key_values=kv_cache,
+            num_draft_tokens, output_ids, draft_kv_cache, draft_logits = draft(
+                input_ids=output_ids,
+                kv_cache=draft_kv_cache,
+                logits=draft_logits,
+                draft_model=draft_model,
+                gamma=gamma,
+                logits_processor=logits_processor,
+                temperature=temperature
+                * 0.5,  # make the draft model outputs less random for better quality.
+                top_p=top_p,
             )
-            normalized = normalize_logits(logits_processor, output_ids, out.logits)
-            logits = torch.cat((logits, normalized), dim=1)
-        kv_cache = out.past_key_values
-        total_seconds_on_eval += time.time() - start
-
-        # accepting stage.
-        start = time.time()
-        assert draft_logits is not None
-        assert draft_kv_cache is not None
-        accepted = 0
-        stopped = False
-        for draft_token_idx in range(-num_draft_tokens, 0):
-            r = torch.rand(1, device=logits.device)
-            draft_token = output_ids[draft_token_idx]
-            token_logits = logits[:, draft_token_idx - 1, :]  # [1, n_vocab,]
-            draft_token_logits = draft_logits[:, draft_token_idx, :].to(
-                logits.device
-            )  # [1, n_vocab,]
-            if token_logits[0, draft_token] / draft_token_logits[0, draft_token] > r:
-                accepted += 1
-                total_num_accepted_tokens += 1
-                if draft_token in stop_token_ids:
-                    stopped = True
+            total_seconds_on_drafting += time.time() - start
+            total_num_draft_tokens += num_draft_tokens
+
+            # eval stage.
+            start_eval = start = time.time()
+            if logits is None:
+                # prefill.
+                out = model(
+                    torch.as_tensor([output_ids], device=model.device),
+                    use_cache=True,
+                    past_key_values=kv_cache,
+                )
+                logits = normalize_logits(logits_processor, output_ids, out.logits)
             else:
-                if logger.getEffectiveLevel() <= logging.DEBUG:
-                    logger.debug(
-                        f"Accepted ({accepted}/{num_draft_tokens}): '{tokenizer.decode(output_ids[-num_draft_tokens: draft_token_idx])}'"
+                out = model(
+                    torch.as_tensor(
+                        [[next_token] + output_ids[-num_draft_tokens:]],
+                        device=model.device,
+                    ),
+                    use_cache=True,
+                    past_key_values=kv_cache,
+                )
+                normalized = normalize_logits(logits_processor, output_ids, out.logits)
+                logits = torch.cat((logits, normalized), dim=1)
+            kv_cache = out.past_key_values
+            total_seconds_on_eval += time.time() - start
+
+            # accepting stage.
+            start = time.time()
+            assert draft_logits is not None
+            assert draft_kv_cache is not None
+            accepted = 0
+            stopped = False
+            for draft_token_idx in range(-num_draft_tokens, 0):
+                r = torch.rand(1, device=logits.device)
+                draft_token = output_ids[draft_token_idx]
+                token_logits = logits[:, draft_token_idx - 1, :]  # [1, n_vocab,]
+                draft_token_logits = draft_logits[:, draft_token_idx, :].to(
+                    logits.device
+                )  # [1, n_vocab,]
+                if (
+                    token_logits[0, draft_token] / draft_token_logits[0, draft_token]
+                    > r
+                ):
+                    accepted += 1
+                    total_num_accepted_tokens += 1
+                    if draft_token in stop_token_ids:
+                        stopped = True
+                else:
+                    if logger.getEffectiveLevel() <= logging.DEBUG:
+                        logger.debug(
+                            f"Accepted ({accepted}/{num_draft_tokens}): '{tokenizer.decode(output_ids[-num_draft_tokens: draft_token_idx])}'"
+                        )
+                        logger.debug(
+                            f"Rejected: '{tokenizer.decode(output_ids[draft_token_idx:])}'"
+                        )
+                    # rollback.
+                    output_ids = output_ids[:draft_token_idx]
+                    draft_kv_cache = rollback_kv_cache(
+                        draft_kv_cache, num_draft_tokens - accepted
                     )
-                    logger.debug(
-                        f"Rejected: '{tokenizer.decode(output_ids[draft_token_idx:])}'"
+                    kv_cache = rollback_kv_cache(kv_cache, num_draft_tokens - accepted)
+                    draft_logits = rollback_logits(
+                        draft_logits, num_draft_tokens - accepted
                     )
-                # rollback.
-                output_ids = output_ids[:draft_token_idx]
-                draft_kv_cache = rollback_kv_cache(
-                    draft_kv_cache, num_draft_tokens - accepted
-                )
-                kv_cache = rollback_kv_cache(kv_cache, num_draft_tokens - accepted)
-                draft_logits = rollback_logits(
-                    draft_logits, num_draft_tokens - accepted
-                )
-                logits = rollback_logits(logits, num_draft_tokens - accepted)
+                    logits = rollback_logits(logits, num_draft_tokens - accepted)
+
+                    # sample the next token according to the modified distribution of shape [1, n_vocab]
+                    modified_dist = token_logits - draft_token_logits
+                    modified_dist = torch.where(
+                        modified_dist > 0,
+                        modified_dist,
+                        torch.zeros_like(modified_dist),
+                    )
+                    normalized = normalize_logits(
+                        logits_processor,
+                        output_ids,
+                        modified_dist.unsqueeze(1),  # [1, 1, n_vocab]
+                    )
+                    next_token = sample(
+                        normalized[0, -1, :],
+                        0,  # must be 0, since the dist is quiet unified, higher temperature results in garbled text
+                        top_p,
+                    )
+                    output_ids.append(next_token)
+                    if logger.getEffectiveLevel() <= logging.DEBUG:
+                        logger.debug(f"Generated: '{tokenizer.decode([next_token])}'")
+                    if next_token in stop_token_ids:
+                        stopped = True
+                    break
 
-                # sample the next token according to the modified distribution of shape [1, n_vocab]
-                modified_dist = token_logits - draft_token_logits
-                modified_dist = torch.where(
-                    modified_dist > 0, modified_dist, torch.zeros_like(modified_dist)
-                )
-                normalized = normalize_logits(
-                    logits_processor,
-                    output_ids,
-                    modified_dist.unsqueeze(1),  # [1, 1, n_vocab]
-                )
+            if accepted == num_draft_tokens:
+                if logger.getEffectiveLevel() <= logging.DEBUG:
+                    logger.debug(
+                        f"Accepted ({accepted}/{num_draft_tokens}): '{tokenizer.decode(output_ids[-num_draft_tokens:])}'"
+                    )
                 next_token = sample(
-                    normalized[0, -1, :],
-                    0,  # must be 0, since the dist is quiet unified, higher temperature results in garbled text
+                    logits[0, -1, :],
+                    temperature,
                     top_p,
                 )
                 output_ids.append(next_token)
@@ -402,68 +779,44 @@ def speculative_generate_stream(
                     logger.debug(f"Generated: '{tokenizer.decode([next_token])}'")
                 if next_token in stop_token_ids:
                     stopped = True
-                break
 
-        if accepted == num_draft_tokens:
-            if logger.getEffectiveLevel() <= logging.DEBUG:
-                logger.debug(
-                    f"Accepted ({accepted}/{num_draft_tokens}): '{tokenizer.decode(output_ids[-num_draft_tokens:])}'"
-                )
-            next_token = sample(
-                logits[0, -1, :],
-                temperature,
-                top_p,
-            )
-            output_ids.append(next_token)
-            if logger.getEffectiveLevel() <= logging.DEBUG:
-                logger.debug(f"Generated: '{tokenizer.decode([next_token])}'")
-            if next_token in stop_token_ids:
-                stopped = True
-
-        total_seconds_on_accepting += time.time() - start
+            total_seconds_on_accepting += time.time() - start
+        gamma = controller.update(
+            num_draft_tokens,
+            accepted,
+            draft_seconds=start_eval - round_start,
+            target_seconds=time.time() - start_eval,
+        )
+        if fixed_gamma:
+            gamma = fixed_gamma
 
         if (
             accepted > 0  # more than 2 tokens has been generated, flush.
             or len(output_ids) >= max_new_tokens
             or stopped
         ):
-            output = tokenizer.decode(
-                output_ids if echo else output_ids[num_prompt_tokens:],
-                spaces_between_special_tokens=False,
-                clean_up_tokenization_spaces=True,
-            )
-            rfind_start = len(prompt) if echo else 0
+            detokenized_ids.extend(output_ids[len(detokenized_ids) :])
+            detokenizer.step()
+            output = detokenizer.text
 
             partially_stopped = False
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
-                    else:
-                        partially_stopped = is_partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            break
-                        else:
-                            partially_stopped = is_partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
+            if stop_matcher is not None:
+                pos = stop_matcher.feed(output[checked_length:])
+                checked_length = len(output)
+                if pos is not None:
+                    stop_pos = rfind_start + pos
+                    output = output[:stop_pos]
+                    stopped = True
                 else:
-                    raise ValueError(f"Invalid stop field type {type(stop_str)}")
+                    partially_stopped = stop_matcher.partially_stopped
 
-            if stream:
+            # prevent yielding partial stop sequence.
+            if stream and not partially_stopped:
                 # return the delta.
                 output_length = len(output)
                 output = output[last_output_length:]
                 last_output_length = output_length
 
-            # prevent yielding partial stop sequence.
             if not partially_stopped:
                 completion_choice = CompletionChoice(
                     text=output, index=0, logprobs=None, finish_reason=None
@@ -487,9 +840,12 @@ def speculative_generate_stream(
     else:
         finish_reason = "length"
 
+    if draft_length_controller is not None and not fixed_gamma:
+        draft_length_controller.merge(controller)
     logger.info(
         f"In total, {total_num_accepted_tokens}/{total_num_draft_tokens} draft tokens are "
-        f"accepted, acceptance rate: {total_num_accepted_tokens / total_num_draft_tokens:.2f}"
+        f"accepted, acceptance rate: {total_num_accepted_tokens / total_num_draft_tokens:.2f}, "
+        f"the next gamma: {controller.gamma}"
     )
     total_seconds = (
         total_seconds_on_drafting + total_seconds_on_eval + total_seconds_on_accepting
@@ -505,6 +861,11 @@ def speculative_generate_stream(
             text="", index=0, logprobs=None, finish_reason=finish_reason
         )
     else:
+        detokenized_ids.extend(output_ids[len(detokenized_ids) :])
+        detokenizer.step(flush=True)
+        output = detokenizer.text
+        if stop_pos is not None:
+            output = output[:stop_pos]
         completion_choice = CompletionChoice(
             text=output, index=0, logprobs=None, finish_reason=finish_reason
         )
@@ -523,9 +884,3 @@ def speculative_generate_stream(
     )
 
     yield completion_chunk, completion_usage
-
-    # clean up.
-    del kv_cache
-    del draft_kv_cache
-    gc.collect()
-    empty_cache()
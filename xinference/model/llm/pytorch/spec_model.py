@@ -13,20 +13,39 @@
 # limitations under the License.
 
 import logging
-from typing import Iterator, List, Optional, Union
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Union
 
 from ....device_utils import (
     get_device_preferred_dtype,
     gpu_count,
     is_hf_accelerate_supported,
 )
-from ....types import Completion, CompletionChunk, Embedding
+from ....types import (
+    Completion,
+    CompletionChunk,
+    CreateCompletionSpeculative,
+    Embedding,
+    SpeculativeGenerateConfig,
+)
 from ...utils import select_device
 from .. import LLMFamilyV1, LLMSpecV1
 from .core import PytorchChatModel, PytorchGenerateConfig, PytorchModelConfig
 
+if TYPE_CHECKING:
+    from .spec_decoding_utils import DraftLengthController
+
 logger = logging.getLogger(__name__)
 
+# The launch options of PytorchModel not applied to speculative decoding, with
+# their default values.
+UNSUPPORTED_MODEL_CONFIG = {
+    "batching": "none",
+    "enable_prefix_caching": False,
+    "prompt_lookup_num_tokens": 0,
+    "cpu_mode": None,
+    "compile": False,
+}
+
 
 class SpeculativeModel(PytorchChatModel):
     def __init__(
@@ -40,15 +59,22 @@ class SpeculativeModel(PytorchChatModel):
         draft_model_spec: "LLMSpecV1",
         draft_quantization: str,
         draft_model_path: str,
+        pytorch_model_config: Optional[PytorchModelConfig] = None,
     ):
-        super().__init__(model_uid, model_family, model_spec, quantization, model_path)
-        self._pytorch_model_config: PytorchModelConfig = self._sanitize_model_config(
-            PytorchModelConfig()
+        super().__init__(
+            model_uid,
+            model_family,
+            model_spec,
+            quantization,
+            model_path,
+            pytorch_model_config,
         )
         self._draft_model_family = draft_model_family
         self._draft_model_spec = draft_model_spec
         self._draft_quantization = draft_quantization
         self._draft_model_path = draft_model_path
+        self._draft_length_controller: Optional["DraftLengthController"] = None
+        self._tree_attention = False
 
     def _load_model(self, model_path, **kwargs):
         try:
@@ -83,6 +109,10 @@ class SpeculativeModel(PytorchChatModel):
                 f"Failed to import module 'torch'. Please make sure 'torch' is installed.\n\n"
             )
 
+        for name, default in UNSUPPORTED_MODEL_CONFIG.items():
+            if self._pytorch_model_config.get(name, default) != default:
+                raise ValueError(f"{name} is not supported by speculative decoding yet")
+
         num_gpus = gpu_count()
         device = self._pytorch_model_config.get("device", "auto")
         self._pytorch_model_config["device"] = select_device(device)
@@ -133,6 +163,59 @@ class SpeculativeModel(PytorchChatModel):
         logger.debug(
             f"Draft model {self.model_uid} memory footprint: {self._model.get_memory_footprint()}"
         )
+        self._init_static_kv_cache()
+
+        from .spec_decoding_utils import DraftLengthController, supports_tree_attention
+
+        self._draft_length_controller = DraftLengthController()
+        self._tree_attention = supports_tree_attention(
+            self._model, self._device
+        ) and supports_tree_attention(self._draft_model, self._device)
+        if not self._tree_attention:
+            logger.debug(
+                f"Tree attention is not supported by {self.model_uid}, "
+                f"the draft tokens are verified as a single branch."
+            )
+
+    @property
+    def spec_decoding_stats(self) -> Dict[str, float]:
+        """The rolling stats of the draft tokens, empty before any request."""
+        controller = self._draft_length_controller
+        if controller is None or controller.acceptance_rate is None:
+            return {}
+        assert controller.tokens_per_forward is not None
+        return {
+            "acceptance_rate": controller.acceptance_rate,
+            "tokens_per_forward": controller.tokens_per_forward,
+            "gamma": controller.gamma,
+        }
+
+    def _init_static_kv_cache(self):
+        super()._init_static_kv_cache()
+        if not self._static_kv_cache:
+            return
+
+        from .kv_cache import supports_static_kv_cache
+
+        if not supports_static_kv_cache(self._draft_model, self._device):
+            logger.warning(
+                f"Static KV cache is not supported by the draft model of {self.model_uid}, "
+                f"fallback to the dynamic KV cache."
+            )
+            self._static_kv_cache = False
+
+    def _sanitize_generate_config(
+        self,
+        generate_config: Optional[PytorchGenerateConfig],
+    ) -> SpeculativeGenerateConfig:
+        # The options of speculative decoding are not in CreateCompletionTorch.
+        options = CreateCompletionSpeculative(**(generate_config or {}))
+        sanitized = SpeculativeGenerateConfig(
+            **super()._sanitize_generate_config(generate_config)
+        )
+        sanitized["gamma"] = options.gamma
+        sanitized["num_branches"] = options.num_branches
+        return sanitized
 
     def generate(
         self, prompt: str, generate_config: Optional[PytorchGenerateConfig] = None
@@ -147,11 +230,15 @@ class SpeculativeModel(PytorchChatModel):
                 tokenizer=self._tokenizer,
                 prompt=_prompt,
                 generate_config=_generate_config,
+                static_kv_cache=self._static_kv_cache,
+                draft_length_controller=self._draft_length_controller,
+                tree_attention=self._tree_attention,
             ):
                 yield _completion_chunk
 
         from .spec_decoding_utils import speculative_generate_stream
 
+        self._check_single_sequence(generate_config)
         generate_config = self._sanitize_generate_config(generate_config)
 
         assert self._draft_model is not None
@@ -167,6 +254,9 @@ class SpeculativeModel(PytorchChatModel):
                 tokenizer=self._tokenizer,
                 prompt=prompt,
                 generate_config=generate_config,
+                static_kv_cache=self._static_kv_cache,
+                draft_length_controller=self._draft_length_controller,
+                tree_attention=self._tree_attention,
             ):
                 pass
 
@@ -182,5 +272,7 @@ class SpeculativeModel(PytorchChatModel):
         else:
             return generator_wrapper(prompt, generate_config)
 
-    def create_embedding(self, input: Union[str, List[str]]) -> Embedding:
+    def create_embedding(
+        self, input: Union[str, List[str]], encoding_format: str = "float"
+    ) -> Embedding:
         raise NotImplementedError
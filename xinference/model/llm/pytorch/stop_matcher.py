@@ -0,0 +1,98 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Dict, Iterable, List, Optional, Union
+
+
+class StopMatcher:
+    """
+    Match the stop strings in a stream of text with an Aho-Corasick automaton.
+
+    The text is fed incrementally and each character is scanned once, whatever
+    the number of stop strings. The state of the automaton is the longest
+    suffix of the text that is a prefix of a stop string, so a partial stop
+    string at the end of the text is known without scanning the text again.
+    """
+
+    def __init__(self, stop: Union[str, Iterable[str]]):
+        if isinstance(stop, str):
+            stop = [stop]
+        elif not isinstance(stop, Iterable):
+            raise ValueError("Invalid stop field type.")
+
+        # The trie, the state 0 is the root.
+        self._goto: List[Dict[str, int]] = [{}]
+        # The length of the longest stop string ending at the state, 0 if none.
+        self._match: List[int] = [0]
+        for s in stop:
+            if not isinstance(s, str):
+                raise ValueError("Invalid stop field type.")
+            if s:
+                self._add(s)
+        self._fail = self._build_fail()
+
+        self._state = 0
+        self._num_chars = 0
+
+    def _add(self, s: str):
+        state = 0
+        for ch in s:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._match.append(0)
+            state = next_state
+        self._match[state] = len(s)
+
+    def _build_fail(self) -> List[int]:
+        fail = [0] * len(self._goto)
+        # Breadth first, the fail state is always shallower.
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, next_state in self._goto[state].items():
+                f = fail[state]
+                while f and ch not in self._goto[f]:
+                    f = fail[f]
+                f = self._goto[f].get(ch, 0)
+                fail[next_state] = f
+                # Inherit the stop strings ending at the fail state.
+                self._match[next_state] = self._match[next_state] or self._match[f]
+                queue.append(next_state)
+        return fail
+
+    def feed(self, text: str) -> Optional[int]:
+        """
+        Feed the new text. Return the position, in all the text fed so far,
+        where the first completed stop string starts, or None.
+        """
+        goto, fail, match = self._goto, self._fail, self._match
+        state = self._state
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if match[state]:
+                self._state = 0
+                self._num_chars += i + 1
+                return self._num_chars - match[state]
+        self._state = state
+        self._num_chars += len(text)
+        return None
+
+    @property
+    def partially_stopped(self) -> bool:
+        """Whether the text ends with a prefix of a stop string."""
+        return self._state != 0
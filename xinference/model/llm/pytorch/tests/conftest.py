@@ -0,0 +1,117 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import string
+from typing import cast
+
+import pytest
+import torch
+
+
+@pytest.fixture(scope="module")
+def model_and_tokenizer():
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import OPTConfig, OPTForCausalLM, PreTrainedTokenizerFast
+
+    # One token per character.
+    vocab = {"<pad>": 0, "</s>": 1}
+    for ch in string.printable:
+        vocab.setdefault(ch, len(vocab))
+    tok = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<pad>"))
+    tok.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tok.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tok, eos_token="</s>", pad_token="<pad>"
+    )
+
+    torch.manual_seed(0)
+    config = OPTConfig(
+        vocab_size=len(vocab),
+        hidden_size=32,
+        ffn_dim=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        word_embed_proj_dim=32,
+        pad_token_id=0,
+        eos_token_id=1,
+    )
+    return OPTForCausalLM(config).eval(), tokenizer
+
+
+@pytest.fixture
+def tiny_pytorch_model(model_and_tokenizer, tmp_path):
+    """
+    Return a function to build a `PytorchModel` of the tiny model with the
+    launch options, it loads a copy of the model from memory.
+    """
+    from .....types import PytorchModelConfig
+    from ....llm import BUILTIN_LLM_FAMILIES
+    from ..core import PytorchModel
+
+    class TinyPytorchModel(PytorchModel):
+        def _load_model(self, **kwargs):
+            model, tokenizer = model_and_tokenizer
+            return copy.deepcopy(model).to(kwargs["torch_dtype"]), tokenizer
+
+    family = next(f for f in BUILTIN_LLM_FAMILIES if f.model_name == "opt")
+
+    def _build(quantization: str = "none", **kwargs) -> PytorchModel:
+        return TinyPytorchModel(
+            "tiny-1-0",
+            family,
+            family.model_specs[0],
+            quantization,
+            str(tmp_path),
+            cast(PytorchModelConfig, dict(device="cpu", **kwargs)),
+        )
+
+    return _build
+
+
+@pytest.fixture
+def tiny_speculative_model(model_and_tokenizer, tmp_path):
+    """
+    Return a function to build a `SpeculativeModel` of the tiny model drafting
+    for itself, or of the given model, with the launch options.
+    """
+    from .....types import PytorchModelConfig
+    from ....llm import BUILTIN_LLM_FAMILIES
+    from ..spec_model import SpeculativeModel
+
+    family = next(f for f in BUILTIN_LLM_FAMILIES if f.model_name == "opt")
+
+    def _build(model=None, **kwargs) -> SpeculativeModel:
+        model = model if model is not None else model_and_tokenizer[0]
+        tokenizer = model_and_tokenizer[1]
+
+        class TinySpeculativeModel(SpeculativeModel):
+            def _load_model(self, model_path, **load_kwargs):
+                dtype = load_kwargs["torch_dtype"]
+                return copy.deepcopy(model).to(dtype), tokenizer
+
+        return TinySpeculativeModel(
+            "tiny-spec-1-0",
+            family,
+            family.model_specs[0],
+            "none",
+            str(tmp_path),
+            draft_model_family=family,
+            draft_model_spec=family.model_specs[0],
+            draft_quantization="none",
+            draft_model_path=str(tmp_path),
+            pytorch_model_config=cast(PytorchModelConfig, dict(device="cpu", **kwargs)),
+        )
+
+    return _build
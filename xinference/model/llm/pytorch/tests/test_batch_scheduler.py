@@ -0,0 +1,199 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+from ..batch_scheduler import BatchScheduler
+from ..utils import generate_stream
+
+PROMPT = "hello world, this is"
+
+
+@pytest.fixture
+def scheduler(model_and_tokenizer):
+    model, tokenizer = model_and_tokenizer
+    scheduler = BatchScheduler("mock", model, tokenizer, "cpu", max_num_seqs=4)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+
+def test_is_supported(model_and_tokenizer):
+    model, _ = model_and_tokenizer
+    # OPT derives the positions from the attention mask.
+    assert BatchScheduler.is_supported(model, "cpu")
+
+    class _NoPositionIds(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.config = copy.deepcopy(model.config)
+            self.config.model_type = "mock"
+
+        def forward(self, input_ids, attention_mask=None, past_key_values=None):
+            return model(
+                input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+            )
+
+    assert not BatchScheduler.is_supported(_NoPositionIds(), "cpu")
+
+
+def test_parallel_sampling(model_and_tokenizer, scheduler):
+    model, tokenizer = model_and_tokenizer
+    generate_config = dict(max_tokens=10, temperature=0)
+    *_, (chunk, _) = generate_stream(
+        "mock", model, tokenizer, PROMPT, "cpu", dict(generate_config)
+    )
+    expected = chunk["choices"][0]["text"]
+
+    # The greedy sequences forked from the same prefill are the same.
+    (chunk, usage), *rest = scheduler.submit(PROMPT, dict(generate_config, n=3))
+    assert not rest
+    assert [c["index"] for c in chunk["choices"]] == [0, 1, 2]
+    assert [c["text"] for c in chunk["choices"]] == [expected] * 3
+    assert usage["completion_tokens"] == 30
+    assert "timings" in chunk
+
+    texts = ["", ""]
+    finished = []
+    for chunk, usage in scheduler.submit(
+        PROMPT, dict(generate_config, n=2, stream=True)
+    ):
+        choice = chunk["choices"][0]
+        texts[choice["index"]] += choice["text"]
+        if choice["finish_reason"] is not None:
+            finished.append(choice["index"])
+    assert texts == [expected] * 2
+    assert sorted(finished) == [0, 1]
+    # The timings come with the last chunk only.
+    assert "timings" in chunk
+    assert usage["completion_tokens"] == 20
+
+
+def test_best_of(scheduler):
+    *_, (chunk, usage) = scheduler.submit(
+        PROMPT, dict(max_tokens=10, temperature=1.0, n=2, best_of=4)
+    )
+    assert [c["index"] for c in chunk["choices"]] == [0, 1]
+    assert usage["completion_tokens"] <= 40
+
+    with pytest.raises(ValueError):
+        scheduler.submit(PROMPT, dict(n=2, best_of=1))
+    with pytest.raises(ValueError):
+        scheduler.submit(PROMPT, dict(n=2, best_of=3, stream=True))
+
+
+def test_run(model_and_tokenizer):
+    model, tokenizer = model_and_tokenizer
+    generate_config = dict(max_tokens=10, temperature=0)
+    *_, (chunk, _) = generate_stream(
+        "mock", model, tokenizer, PROMPT, "cpu", dict(generate_config)
+    )
+    expected = chunk["choices"][0]["text"]
+
+    # The scheduler is not started, the steps run in this thread.
+    scheduler = BatchScheduler("mock", model, tokenizer, "cpu", max_num_seqs=2)
+    num_threads = threading.active_count()
+    chunks = scheduler.run(PROMPT, dict(generate_config, n=2))
+    assert threading.active_count() == num_threads
+    (chunk, usage), *rest = chunks
+    assert not rest
+    assert [c["text"] for c in chunk["choices"]] == [expected] * 2
+    assert usage["completion_tokens"] == 20
+
+    # A stream left early cancels its sequences.
+    chunks = scheduler.run(PROMPT, dict(generate_config, n=2, stream=True))
+    next(chunks)
+    chunks.close()
+    scheduler._step()
+    assert not scheduler._running
+
+
+def test_max_num_seqs(model_and_tokenizer):
+    model, tokenizer = model_and_tokenizer
+    generate_config = dict(max_tokens=10, temperature=0)
+    *_, (chunk, _) = generate_stream(
+        "mock", model, tokenizer, PROMPT, "cpu", dict(generate_config)
+    )
+    expected = chunk["choices"][0]["text"]
+
+    # The steps run in this thread, the scheduler is not started.
+    scheduler = BatchScheduler("mock", model, tokenizer, "cpu", max_num_seqs=2)
+    with pytest.raises(ValueError, match="max_num_seqs"):
+        scheduler.submit(PROMPT, dict(generate_config, n=3))
+
+    single = scheduler.submit(PROMPT, dict(generate_config))
+    scheduler._step()
+    assert len(scheduler._running) == 1
+    # The group waits until both its sequences fit in the batch.
+    group = scheduler.submit(PROMPT, dict(generate_config, n=2))
+    num_running = []
+    while scheduler._running or scheduler._next_group or not scheduler._waiting.empty():
+        scheduler._step()
+        num_running.append(len(scheduler._running))
+    assert max(num_running) == 2
+    assert num_running.index(2) > 0
+
+    *_, (chunk, _) = single
+    assert chunk["choices"][0]["text"] == expected
+    (chunk, usage), *rest = group
+    assert not rest
+    assert [c["text"] for c in chunk["choices"]] == [expected] * 2
+
+
+def test_chunked_prefill(model_and_tokenizer):
+    model, tokenizer = model_and_tokenizer
+    generate_config = dict(max_tokens=10, temperature=0)
+    prompts = [PROMPT, PROMPT * 4]
+    expected = []
+    for prompt in prompts:
+        *_, (chunk, _) = generate_stream(
+            "mock", model, tokenizer, prompt, "cpu", dict(generate_config)
+        )
+        expected.append(chunk["choices"][0]["text"])
+        *_, (chunk, _) = generate_stream(
+            "mock",
+            model,
+            tokenizer,
+            prompt,
+            "cpu",
+            dict(generate_config),
+            prefill_chunk_size=7,
+        )
+        assert chunk["choices"][0]["text"] == expected[-1]
+
+    scheduler = BatchScheduler(
+        "mock", model, tokenizer, "cpu", max_num_seqs=4, prefill_chunk_size=7
+    )
+    scheduler.start()
+    try:
+        # The short request keeps decoding while the long one is prefilled.
+        streams = [
+            scheduler.submit(prompt, dict(generate_config, stream=True))
+            for prompt in prompts
+        ]
+        with ThreadPoolExecutor(len(streams)) as executor:
+            texts = [
+                "".join(chunk["choices"][0]["text"] for chunk, _ in chunks)
+                for chunks in executor.map(list, streams)
+            ]
+        assert texts == expected
+    finally:
+        scheduler.stop()
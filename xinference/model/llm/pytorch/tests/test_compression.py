@@ -0,0 +1,129 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import dataclasses
+import os
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from ..compression import (
+    CLinear,
+    DecompressedWeightCache,
+    _supports_int8_matmul,
+    compress,
+    compressed_checkpoint_path,
+    decompress,
+    default_compression_config,
+    load_compressed_checkpoint,
+    save_compressed_checkpoint,
+)
+
+
+def test_clinear():
+    torch.manual_seed(0)
+    # The input features are padded to the group size.
+    linear = nn.Linear(300, 64)
+    x = torch.randn(2, 3, 300)
+    with torch.inference_mode():
+        expected = linear(x)
+        clinear = CLinear(linear.weight, linear.bias, "cpu")
+        assert _supports_int8_matmul(clinear.weight)
+        out = clinear(x)
+    assert out.shape == expected.shape
+    assert (out - expected).norm() / expected.norm() < 0.02
+
+
+def test_clinear_int8_matmul_off():
+    torch.manual_seed(0)
+    linear = nn.Linear(300, 64)
+    x = torch.randn(4, 300)
+    with torch.inference_mode():
+        clinear = CLinear(linear.weight, linear.bias, "cpu", int8_matmul=False)
+        assert clinear._weight_groups is None
+        weight = decompress(clinear.weight, default_compression_config)
+        torch.testing.assert_close(clinear(x), F.linear(x, weight, linear.bias))
+
+
+def test_clinear_without_int_mm(monkeypatch):
+    from .. import compression
+
+    def _int_mm(a, b):
+        raise RuntimeError("_int_mm is not implemented for CPU")
+
+    # E.g. torch 2.1, which has the int8 matmul for CUDA only.
+    monkeypatch.setattr(compression, "_INT_MM_SUPPORTED", {})
+    monkeypatch.setattr(torch, "_int_mm", _int_mm, raising=False)
+    torch.manual_seed(0)
+    linear = nn.Linear(300, 64)
+    x = torch.randn(4, 300)
+    with torch.inference_mode():
+        clinear = CLinear(linear.weight, linear.bias, "cpu")
+        assert not _supports_int8_matmul(clinear.weight)
+        weight = decompress(clinear.weight, default_compression_config)
+        torch.testing.assert_close(clinear(x), F.linear(x, weight, linear.bias))
+    assert compression._INT_MM_SUPPORTED == {"cpu": False}
+
+
+def test_clinear_cache():
+    torch.manual_seed(0)
+    linear = nn.Linear(300, 64)
+    x = torch.randn(4, 300)
+    nbytes = 64 * 300 * 4
+    cache = DecompressedWeightCache(nbytes)
+    with torch.inference_mode():
+        cached = CLinear(linear.weight, linear.bias, "cpu", cache=cache)
+        weight = decompress(cached.weight, default_compression_config)
+        torch.testing.assert_close(cached(x), F.linear(x, weight, linear.bias))
+        assert cache.memory == nbytes
+
+        # Over the budget.
+        uncached = CLinear(linear.weight, linear.bias, "cpu", cache=cache)
+        uncached(x)
+        assert uncached._decompressed is None
+        assert cache.memory == nbytes
+
+
+def test_compressed_checkpoint(tmp_path):
+    torch.manual_seed(0)
+    embedding = torch.randn(10, 8)
+    asymmetric = dataclasses.replace(default_compression_config, symmetric=False)
+    state_dict = {
+        "embed.weight": embedding,
+        # Tied to the embedding.
+        "norm.weight": embedding[0],
+        "fc1.weight": compress(torch.randn(16, 300), default_compression_config),
+        "fc2.weight": compress(torch.randn(16, 8), asymmetric),
+    }
+    linear_weights = ["fc1.weight", "fc2.weight"]
+    path = compressed_checkpoint_path(str(tmp_path), "v1", torch.float32)
+    assert path != compressed_checkpoint_path(str(tmp_path), "v2", torch.float32)
+    assert load_compressed_checkpoint(path, "cpu", linear_weights) is None
+
+    save_compressed_checkpoint(path, state_dict, linear_weights)
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+    loaded = load_compressed_checkpoint(path, "cpu", linear_weights)
+    assert loaded is not None
+    assert loaded.keys() == state_dict.keys()
+    for name in ("embed.weight", "norm.weight"):
+        torch.testing.assert_close(loaded[name], state_dict[name])
+    for name in linear_weights:
+        assert len(loaded[name]) == len(state_dict[name])
+        assert loaded[name][-1] == state_dict[name][-1]
+        for got, expected in zip(loaded[name][:-1], state_dict[name][:-1]):
+            torch.testing.assert_close(got, expected)
+
+    # Stale if the linear layers of the model are different.
+    assert load_compressed_checkpoint(path, "cpu", ["fc1.weight"]) is None
@@ -0,0 +1,189 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import pytest_asyncio
+import torch
+import xoscar as xo
+from xoscar import create_actor_pool
+
+from .....core.model import ModelActor
+from ..utils import get_memory_footprint
+
+PROMPT = "hello world"
+GENERATE_CONFIG = {"max_tokens": 8, "temperature": 0, "stop_token_ids": []}
+
+
+@pytest_asyncio.fixture
+async def setup_pool():
+    pool = await create_actor_pool(
+        f"test://127.0.0.1:{xo.utils.get_next_port()}", n_process=0
+    )
+    async with pool:
+        yield pool
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cpu_mode", ["bf16", "int8"])
+async def test_cpu_mode(setup_pool, tiny_pytorch_model, cpu_mode):
+    expected = tiny_pytorch_model()
+    expected.load()
+    assert expected.cpu_mode_stats == {}
+    expected_completion = expected.generate(PROMPT, dict(GENERATE_CONFIG))
+
+    pool = setup_pool
+    model = tiny_pytorch_model(cpu_mode=cpu_mode)
+    model_ref = await xo.create_actor(
+        ModelActor,
+        address=pool.external_address,
+        uid=model.model_uid,
+        worker_address=pool.external_address,
+        model=model,
+    )
+    await model_ref.load()
+    stats = await model_ref.get_stats()
+    assert stats == model.cpu_mode_stats
+    assert stats["cpu_mode"] == cpu_mode
+    assert stats["tokens_per_second"] > 0
+    if cpu_mode == "int8":
+        assert isinstance(model._model.lm_head, torch.ao.nn.quantized.dynamic.Linear)
+        assert stats["dtype"] == "float32"
+    elif torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        assert stats["dtype"] == "bfloat16"
+    # The weights of the linear layers take 1 or 2 bytes instead of 4.
+    assert 0 < stats["memory_footprint"] < get_memory_footprint(expected._model)
+
+    completion = json.loads(await model_ref.generate(PROMPT, dict(GENERATE_CONFIG)))
+    assert completion["usage"] == expected_completion["usage"]
+    assert completion["choices"][0]["text"] == expected_completion["choices"][0]["text"]
+
+
+def test_cpu_mode_invalid(tiny_pytorch_model):
+    with pytest.raises(ValueError, match="not supported"):
+        tiny_pytorch_model(cpu_mode="fp16").load()
+    with pytest.raises(ValueError, match="quantization"):
+        tiny_pytorch_model(quantization="8-bit", cpu_mode="int8").load()
+
+
+def test_continuous_batching(tiny_pytorch_model):
+    prompt = "Once upon a time, there was a very old computer"
+    generate_config = {"max_tokens": 32, "temperature": 0, "stop_token_ids": []}
+    sequential = tiny_pytorch_model()
+    sequential.load()
+    expected = {
+        max_tokens: sequential.generate(
+            prompt, dict(generate_config, max_tokens=max_tokens)
+        )["choices"][0]["text"]
+        for max_tokens in (4, 16, 8, 32)
+    }
+
+    model = tiny_pytorch_model(batching="continuous", max_num_seqs=2)
+    model.load()
+    assert model._batch_scheduler is not None
+
+    # Requests with different lengths join and leave the running batch,
+    # the greedy results must be the same as the sequential ones.
+    def _generate(max_tokens):
+        completion = model.generate(
+            prompt, dict(generate_config, max_tokens=max_tokens)
+        )
+        assert completion["usage"]["completion_tokens"] == max_tokens
+        return completion["choices"][0]["text"]
+
+    def _generate_stream():
+        return "".join(
+            chunk["choices"][0]["text"]
+            for chunk in model.generate(prompt, dict(generate_config, stream=True))
+        )
+
+    try:
+        with ThreadPoolExecutor() as executor:
+            texts = executor.map(_generate, expected)
+            stream_text = executor.submit(_generate_stream)
+            assert dict(zip(expected, texts)) == expected
+            assert stream_text.result() == expected[32]
+    finally:
+        model.stop_batch_scheduler()
+
+
+def test_parallel_sampling(tiny_pytorch_model):
+    model = tiny_pytorch_model()
+    model.load()
+    expected = model.generate(PROMPT, dict(GENERATE_CONFIG))
+
+    # The sequences are decoded in the thread of the request.
+    num_threads = threading.active_count()
+    completion = model.generate(PROMPT, dict(GENERATE_CONFIG, n=2))
+    assert threading.active_count() == num_threads
+    assert [c["text"] for c in completion["choices"]] == [
+        expected["choices"][0]["text"]
+    ] * 2
+
+    # The models sampling a single sequence reject `n` and `best_of`.
+    model._check_single_sequence(dict(GENERATE_CONFIG, n=1))
+    with pytest.raises(ValueError, match="several sequences"):
+        model._check_single_sequence(dict(GENERATE_CONFIG, best_of=2))
+
+
+def test_compile(tiny_pytorch_model, monkeypatch):
+    expected_model = tiny_pytorch_model()
+    expected_model.load()
+    expected = expected_model.generate(PROMPT, dict(GENERATE_CONFIG))
+
+    compile = torch.compile
+    monkeypatch.setattr(torch, "compile", functools.partial(compile, backend="eager"))
+    model = tiny_pytorch_model(compile=True)
+    model.load()
+    assert model._decode_model is not None
+    assert set(model.compile_stats) == {
+        "compile_seconds",
+        "decode_step_ms",
+        "eager_decode_step_ms",
+    }
+    assert all(v > 0 for v in model.compile_stats.values())
+
+    # The decode steps run the compiled model.
+    decode_model = model._decode_model
+    num_steps = 0
+
+    def _decode_step(*args, **kwargs):
+        nonlocal num_steps
+        num_steps += 1
+        return decode_model(*args, **kwargs)
+
+    model._decode_model = _decode_step
+    completion = model.generate(PROMPT, dict(GENERATE_CONFIG))
+    assert num_steps == GENERATE_CONFIG["max_tokens"] - 1
+    assert completion["choices"][0]["text"] == expected["choices"][0]["text"]
+    assert completion["usage"] == expected["usage"]
+
+    # Falls back to the eager mode if compiling fails.
+    def _compile(model, **kwargs):
+        def _fail(*args, **kwargs):
+            raise RuntimeError("compile failed")
+
+        return _fail
+
+    monkeypatch.setattr(torch, "compile", _compile)
+    model = tiny_pytorch_model(compile=True)
+    model.load()
+    assert model._decode_model is None
+    assert model.compile_stats == {}
+    completion = model.generate(PROMPT, dict(GENERATE_CONFIG))
+    assert completion["choices"][0]["text"] == expected["choices"][0]["text"]
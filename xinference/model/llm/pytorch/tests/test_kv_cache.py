@@ -0,0 +1,86 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+
+from ..kv_cache import (
+    StaticKVCache,
+    rollback_kv_cache,
+    select_kv_cache,
+    supports_static_kv_cache,
+)
+
+
+def test_static_kv_cache():
+    cache = StaticKVCache(4)
+    k, v = torch.randn(2, 1, 2, 6, 8)
+    cache.update(k[:, :, :3], v[:, :, :3], 0)
+    assert cache.get_seq_length() == 3
+    # Grow the buffer once it is full.
+    ret_k, ret_v = cache.update(k[:, :, 3:], v[:, :, 3:], 0)
+    assert cache.get_seq_length() == 6
+    torch.testing.assert_close(ret_k, k)
+    torch.testing.assert_close(ret_v, v)
+
+    legacy = cache.to_legacy_cache()
+    cache.crop(2)
+    assert cache.get_seq_length() == 2
+    new_k, new_v = torch.randn(2, 1, 2, 1, 8)
+    ret_k, ret_v = cache.update(new_k, new_v, 0)
+    torch.testing.assert_close(ret_k, torch.cat([k[:, :, :2], new_k], dim=2))
+    torch.testing.assert_close(ret_v, torch.cat([v[:, :, :2], new_v], dim=2))
+    # The legacy cache is a copy.
+    torch.testing.assert_close(legacy[0][0], k)
+
+
+def test_select_kv_cache():
+    k, v = torch.randn(2, 1, 2, 6, 8)
+    cache = StaticKVCache(8)
+    cache.update(k, v, 0)
+    legacy = select_kv_cache(((k, v),), 2, [1, 3])
+    assert select_kv_cache(cache, 2, [1, 3]) is cache
+    assert cache.get_seq_length() == 4
+    for got, expected in zip(cache[0], legacy[0]):
+        torch.testing.assert_close(got, expected)
+    torch.testing.assert_close(legacy[0][0], k[:, :, [0, 1, 3, 5]])
+
+
+def test_static_kv_cache_rollback():
+    from transformers import MistralConfig, MistralForCausalLM
+
+    torch.manual_seed(0)
+    config = MistralConfig(
+        vocab_size=100,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    model = MistralForCausalLM(config).eval()
+    assert supports_static_kv_cache(model, "cpu")
+
+    input_ids = torch.randint(0, 100, (1, 8))
+    with torch.inference_mode():
+        expected = model(input_ids).logits
+        cache = StaticKVCache(8)
+        logits = [model(input_ids[:, :5], past_key_values=cache).logits]
+        # Reject a draft token.
+        model(torch.tensor([[7]]), past_key_values=cache)
+        assert rollback_kv_cache(cache, 1) is cache
+        for i in range(5, 8):
+            out = model(input_ids[:, i : i + 1], past_key_values=cache)
+            assert out.past_key_values is cache
+            logits.append(out.logits)
+    torch.testing.assert_close(torch.cat(logits, dim=1), expected)
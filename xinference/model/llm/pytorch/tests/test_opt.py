@@ -113,6 +113,60 @@ async def test_opt_pytorch_model(setup, quantization):
         assert [expected_revision] == actual_revision
 
 
+def test_opt_pytorch_model_continuous_batching(setup):
+    # The end to end run of a downloaded model, the correctness of continuous
+    # batching is tested offline by `test_core.test_continuous_batching`.
+    endpoint, _ = setup
+    client = Client(endpoint)
+    assert len(client.list_models()) == 0
+
+    model_uid = client.launch_model(
+        model_name="opt",
+        model_size_in_billions=1,
+        model_format="pytorch",
+        quantization="none",
+        device="cpu",
+        batching="continuous",
+        max_num_seqs=2,
+    )
+    model = client.get_model(model_uid=model_uid)
+    assert isinstance(model, RESTfulGenerateModelHandle)
+
+    prompt = "Once upon a time, there was a very old computer"
+    expected = model.generate(prompt, generate_config={"temperature": 0})
+    assert expected["choices"][0]["finish_reason"] in ("stop", "length")
+
+    # Requests with different lengths join and leave the running batch,
+    # the greedy results must be the same as the sequential ones.
+    def _check(max_tokens):
+        completion = model.generate(
+            prompt, generate_config={"temperature": 0, "max_tokens": max_tokens}
+        )
+        assert expected["choices"][0]["text"].startswith(
+            completion["choices"][0]["text"]
+        )
+        assert completion["usage"]["completion_tokens"] <= max_tokens
+
+    def _check_stream():
+        text = ""
+        for chunk in model.generate(
+            prompt, generate_config={"temperature": 0, "stream": True}
+        ):
+            text += chunk["choices"][0]["text"]
+        assert text == expected["choices"][0]["text"]
+
+    results = []
+    with ThreadPoolExecutor() as executor:
+        for max_tokens in (4, 16, 8, 32):
+            results.append(executor.submit(_check, max_tokens))
+        results.append(executor.submit(_check_stream))
+    for r in results:
+        r.result()
+
+    client.terminate_model(model_uid=model_uid)
+    assert len(client.list_models()) == 0
+
+
 @pytest.mark.asyncio
 async def test_concurrent_pytorch_model(setup):
     pool = await xoscar.create_actor_pool("127.0.0.1", n_process=1)
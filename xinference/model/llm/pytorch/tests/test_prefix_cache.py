@@ -0,0 +1,95 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+
+from ..prefix_cache import PrefixCache
+
+N_LAYER, N_HEAD, N_DIM = 2, 2, 4
+
+
+def _kv_cache(token_ids):
+    # Make the KV of a token depend on the token id only, so the KV caches of
+    # the same tokens are comparable across requests.
+    t = torch.as_tensor(token_ids, dtype=torch.float32)
+    k = t.view(1, 1, -1, 1).expand(1, N_HEAD, len(token_ids), N_DIM).contiguous()
+    return tuple((k + layer, -k - layer) for layer in range(N_LAYER))
+
+
+def _check_kv_cache(kv_cache, token_ids):
+    expected = _kv_cache(token_ids)
+    assert len(kv_cache) == N_LAYER
+    for (k, v), (expected_k, expected_v) in zip(kv_cache, expected):
+        assert torch.equal(k, expected_k)
+        assert torch.equal(v, expected_v)
+
+
+def test_prefix_cache_match():
+    cache = PrefixCache(max_memory=1 << 20)
+    assert cache.match([1, 2, 3]) == (0, None)
+
+    cache.insert([1, 2, 3, 4, 5], _kv_cache([1, 2, 3, 4, 5]))
+    # The last token is never matched.
+    n, kv_cache = cache.match([1, 2, 3, 4, 5])
+    assert n == 4
+    _check_kv_cache(kv_cache, [1, 2, 3, 4])
+
+    n, kv_cache = cache.match([1, 2, 3, 4, 5, 6, 7])
+    assert n == 5
+    _check_kv_cache(kv_cache, [1, 2, 3, 4, 5])
+
+    # Partial match inside an edge.
+    n, kv_cache = cache.match([1, 2, 9, 9])
+    assert n == 2
+    _check_kv_cache(kv_cache, [1, 2])
+
+    # Split the edge, the shared prefix is stored once.
+    memory_usage = cache.memory_usage
+    cache.insert([1, 2, 7, 8], _kv_cache([1, 2, 7, 8]))
+    assert cache.memory_usage == memory_usage * 7 // 5
+    n, kv_cache = cache.match([1, 2, 7, 8, 9])
+    assert n == 4
+    _check_kv_cache(kv_cache, [1, 2, 7, 8])
+    n, kv_cache = cache.match([1, 2, 3, 4, 5, 6])
+    assert n == 5
+    _check_kv_cache(kv_cache, [1, 2, 3, 4, 5])
+
+    assert cache.match([2, 1]) == (0, None)
+    assert 0 < cache.hit_rate < 1
+
+    # Mismatched KV caches are skipped.
+    memory_usage = cache.memory_usage
+    cache.insert([3, 4, 5], _kv_cache([3, 4]))
+    assert cache.memory_usage == memory_usage
+
+
+def test_prefix_cache_evict():
+    token_nbytes = N_LAYER * 2 * N_HEAD * N_DIM * 4
+    cache = PrefixCache(max_memory=token_nbytes * 8)
+
+    cache.insert([1, 2, 3, 4], _kv_cache([1, 2, 3, 4]))
+    cache.insert([1, 2, 5, 6], _kv_cache([1, 2, 5, 6]))
+    assert cache.memory_usage == token_nbytes * 6
+    # Access [1, 2, 3, 4], so [5, 6] is the least recently used leaf.
+    assert cache.match([1, 2, 3, 4, 0])[0] == 4
+
+    cache.insert([7, 8, 9, 10], _kv_cache([7, 8, 9, 10]))
+    assert cache.memory_usage <= token_nbytes * 8
+    assert cache.match([1, 2, 5, 6, 0])[0] == 2
+    assert cache.match([1, 2, 3, 4, 0])[0] == 4
+    assert cache.match([7, 8, 9, 10, 0])[0] == 4
+
+    # A sequence larger than the capacity is not kept.
+    cache.insert(list(range(100, 120)), _kv_cache(list(range(100, 120))))
+    assert cache.memory_usage <= token_nbytes * 8
@@ -0,0 +1,80 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+
+from ..prefix_cache import PrefixCache
+from ..prompt_lookup import PromptLookup, verify
+from ..sampler import Sampler
+from ..utils import generate_stream
+
+
+def test_prompt_lookup():
+    token_ids = [1, 2, 3, 4, 5, 2, 3, 9, 1, 2]
+    lookup = PromptLookup(token_ids, num_tokens=3, max_ngram_size=2)
+    assert lookup.propose() == [3, 4, 5]
+    # The latest occurrence of the longest n-gram.
+    token_ids.append(3)
+    assert lookup.propose() == [9, 1, 2]
+    token_ids.append(7)
+    assert lookup.propose() == []
+    token_ids.append(4)
+    assert lookup.propose() == [5, 2, 3]
+
+    with pytest.raises(ValueError):
+        PromptLookup(token_ids, num_tokens=0)
+
+
+def test_verify():
+    sampler = Sampler("cpu")
+    sampler.add([0], dict(temperature=0))
+    logits = torch.zeros(4, 8)
+    logits[torch.arange(4), torch.tensor([3, 5, 6, 7])] = 1.0
+    assert verify(sampler, logits, [3, 5, 1]) == [3, 5, 6]
+    assert verify(sampler, logits, [3, 5, 6]) == [3, 5, 6, 7]
+    assert verify(sampler, logits, [4, 5, 6]) == [3]
+
+
+def test_generate_stream_with_prompt_lookup(model_and_tokenizer):
+    model, tokenizer = model_and_tokenizer
+    prompt = "hello world, hello world, hello"
+    for generate_config in [
+        dict(max_tokens=30, temperature=0),
+        dict(max_tokens=30, temperature=0, stream=True),
+        dict(max_tokens=30, temperature=0, repetition_penalty=1.5),
+    ]:
+        chunks = list(
+            generate_stream(
+                "mock", model, tokenizer, prompt, "cpu", dict(generate_config)
+            )
+        )
+        prefix_cache = PrefixCache(1 << 24)
+        for _ in range(2):
+            lookup_chunks = list(
+                generate_stream(
+                    "mock",
+                    model,
+                    tokenizer,
+                    prompt,
+                    "cpu",
+                    dict(generate_config),
+                    prefix_cache=prefix_cache,
+                    prompt_lookup_num_tokens=4,
+                )
+            )
+            assert [c["choices"] for c, _ in lookup_chunks] == [
+                c["choices"] for c, _ in chunks
+            ]
+            assert lookup_chunks[-1][1] == chunks[-1][1]
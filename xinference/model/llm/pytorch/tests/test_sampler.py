@@ -0,0 +1,110 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from ..sampler import Sampler
+
+N_VOCAB = 50
+
+CONFIGS = [
+    dict(temperature=0.7, repetition_penalty=1.3, top_p=0.8, top_k=10),
+    dict(temperature=1.0),
+    dict(temperature=1.5, repetition_penalty=1.1, top_p=0.5),
+    dict(temperature=0.9, top_k=5),
+    dict(temperature=0.0, repetition_penalty=1.2),
+]
+
+
+def _hf_logits_processor(config) -> LogitsProcessorList:
+    processors = LogitsProcessorList()
+    temperature = config.get("temperature", 1.0)
+    if temperature >= 1e-5 and temperature != 1.0:
+        processors.append(TemperatureLogitsWarper(temperature))
+    if config.get("repetition_penalty", 1.0) > 1.0:
+        processors.append(
+            RepetitionPenaltyLogitsProcessor(config["repetition_penalty"])
+        )
+    if config.get("top_p", 1.0) < 1.0:
+        processors.append(TopPLogitsWarper(config["top_p"]))
+    if config.get("top_k", -1) > 0:
+        processors.append(TopKLogitsWarper(config["top_k"]))
+    return processors
+
+
+def test_sampler(monkeypatch):
+    probs = []
+    multinomial = torch.multinomial
+
+    def _multinomial(p, num_samples):
+        probs.append(p)
+        return multinomial(p, num_samples)
+
+    monkeypatch.setattr(torch, "multinomial", _multinomial)
+
+    torch.manual_seed(0)
+    sampler = Sampler("cpu")
+    histories = [torch.randint(0, N_VOCAB, (7,)).tolist() for _ in CONFIGS]
+    for history, config in zip(histories, CONFIGS):
+        sampler.add(history, config)
+
+    for _ in range(5):
+        logits = torch.randn(len(CONFIGS), N_VOCAB) * 3
+        probs.clear()
+        tokens = sampler.sample(logits)
+        for row, config in enumerate(CONFIGS):
+            expected = _hf_logits_processor(config)(
+                torch.tensor([histories[row]]), logits[row : row + 1]
+            )[0]
+            if config["temperature"] == 0:
+                assert tokens[row] == int(torch.argmax(expected))
+            else:
+                torch.testing.assert_close(
+                    probs[0][row], torch.softmax(expected, dim=-1)
+                )
+        sampler.update(tokens)
+        for history, token in zip(histories, tokens):
+            history.append(token)
+
+
+def test_sampler_rows():
+    sampler = Sampler("cpu")
+    sampler.add([1, 2], dict(temperature=0))
+    sampler.add([3], dict(temperature=0, repetition_penalty=100.0))
+    assert sampler.batch_size == 2
+
+    logits = torch.zeros(N_VOCAB)
+    logits[3] = 2.0
+    logits[4] = 1.0
+    # The token 3 is penalized for the second row only.
+    assert sampler.sample(torch.stack([logits, logits])) == [3, 4]
+    assert sampler.sample(logits.unsqueeze(0), index=[1]) == [4]
+    assert sampler.sample(logits.unsqueeze(0), index=[0], exclude=[3]) == [4]
+
+    # Both 3 and 4 are penalized for the second row now.
+    sampler.update([4], index=[1])
+    assert sampler.sample(torch.stack([logits, logits])) == [3, 3]
+    logits[5] = 0.025
+    assert sampler.sample(torch.stack([logits, logits])) == [3, 5]
+
+    sampler.select([1])
+    assert sampler.batch_size == 1
+    assert sampler.sample(logits.unsqueeze(0)) == [5]
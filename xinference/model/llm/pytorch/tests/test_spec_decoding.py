@@ -18,7 +18,12 @@ import pytest
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
-from ..spec_decoding_utils import speculative_generate_stream
+from ..spec_decoding_utils import (
+    DraftLengthController,
+    speculative_generate_stream,
+    supports_tree_attention,
+)
+from ..utils import generate_stream
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -55,3 +60,195 @@ def test_spec_decoding():
     assert completion.startswith(
         "The largest animal ever recorded is the Tyrannosaurus Rex"
     )
+
+
+def test_draft_length_controller():
+    controller = DraftLengthController(gamma=4, max_gamma=8)
+    request = controller.fork()
+    # Every draft token is accepted, the draft forwards are cheap.
+    for _ in range(5):
+        gamma = request.update(request.gamma, request.gamma, 0.01, 1.0)
+    assert gamma == 8
+    assert request.acceptance_rate == 1.0
+    assert request.tokens_per_forward > 5
+    # The model is updated once the request is done.
+    assert controller.gamma == 4
+    controller.merge(request)
+    assert controller.gamma == 8
+
+    # The draft tokens are rejected.
+    request = controller.fork()
+    for _ in range(20):
+        gamma = request.update(request.gamma, 0, 0.01, 1.0)
+    assert gamma == 1
+
+    # Half of the draft tokens are accepted, the draft forwards are expensive.
+    cheap, expensive = DraftLengthController(), DraftLengthController()
+    for _ in range(10):
+        cheap.update(4, 2, 0.04, 1.0)
+        expensive.update(4, 2, 2.0, 1.0)
+    assert cheap.gamma > expensive.gamma
+
+    with pytest.raises(ValueError):
+        DraftLengthController(gamma=0)
+
+
+@pytest.fixture(scope="module")
+def mistral_model(model_and_tokenizer):
+    from transformers import MistralConfig, MistralForCausalLM
+
+    _, tokenizer = model_and_tokenizer
+    torch.manual_seed(0)
+    config = MistralConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        eos_token_id=1,
+    )
+    return MistralForCausalLM(config).eval()
+
+
+def test_tree_speculation(model_and_tokenizer, mistral_model):
+    opt_model, tokenizer = model_and_tokenizer
+    # OPT does not take the position ids.
+    assert not supports_tree_attention(opt_model, "cpu")
+    model = mistral_model
+    assert supports_tree_attention(model, "cpu")
+
+    prompt = "hello world, this is"
+    generate_config = {"temperature": 0, "max_tokens": 20, "stop_token_ids": []}
+    *_, (expected, _) = generate_stream(
+        "test", model, tokenizer, prompt, "cpu", dict(generate_config)
+    )
+    for static_kv_cache in (False, True):
+        # The model drafting for itself, every draft token is accepted.
+        controller = DraftLengthController(gamma=3, max_gamma=3)
+        *_, (chunk, usage) = speculative_generate_stream(
+            "test",
+            model,
+            model,
+            tokenizer,
+            prompt,
+            dict(generate_config, num_branches=2),
+            static_kv_cache=static_kv_cache,
+            draft_length_controller=controller,
+            tree_attention=True,
+        )
+        assert chunk["choices"][0]["text"] == expected["choices"][0]["text"]
+        assert usage["completion_tokens"] == 20
+        assert controller.acceptance_rate == 1.0
+
+
+def test_speculative_model_gamma(tiny_speculative_model, monkeypatch):
+    from .. import spec_decoding_utils
+
+    gammas = []
+    draft = spec_decoding_utils.draft
+
+    def _draft(*args, gamma, **kwargs):
+        gammas.append(gamma)
+        return draft(*args, gamma=gamma, **kwargs)
+
+    monkeypatch.setattr(spec_decoding_utils, "draft", _draft)
+    model = tiny_speculative_model()
+    model.load()
+    generate_config = {
+        "temperature": 0,
+        "repetition_penalty": 1.0,
+        "max_tokens": 20,
+        "stop_token_ids": [],
+    }
+
+    # The gamma of the request is fixed, the model does not learn from it.
+    model.generate("hello world", dict(generate_config, gamma=2))
+    assert gammas and set(gammas) == {2}
+    assert model.spec_decoding_stats == {}
+
+    # Otherwise it starts from the gamma of the model.
+    gammas.clear()
+    model.generate("hello world", generate_config)
+    assert gammas[0] == DraftLengthController().gamma
+    assert "acceptance_rate" in model.spec_decoding_stats
+
+
+def test_speculative_model_num_branches(
+    tiny_speculative_model, mistral_model, monkeypatch
+):
+    from .. import spec_decoding_utils
+
+    trees = []
+    verify = spec_decoding_utils.TreeSpeculation._verify
+
+    def _verify(self, output_ids, nodes, gamma):
+        trees.append((self._num_branches, len(nodes)))
+        return verify(self, output_ids, nodes, gamma)
+
+    monkeypatch.setattr(spec_decoding_utils.TreeSpeculation, "_verify", _verify)
+    model = tiny_speculative_model(mistral_model)
+    model.load()
+    generate_config = {
+        "temperature": 0,
+        "repetition_penalty": 1.0,
+        "max_tokens": 20,
+        "stop_token_ids": [],
+    }
+    expected = model.generate("hello world, this is", generate_config)
+    assert not trees
+
+    completion = model.generate(
+        "hello world, this is", dict(generate_config, gamma=3, num_branches=2)
+    )
+    # Each round verifies the 2 branches of 3 draft tokens in one forward.
+    assert trees and set(trees) == {(2, 6)}
+    assert completion["choices"][0]["text"] == expected["choices"][0]["text"]
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        dict(batching="continuous"),
+        dict(enable_prefix_caching=True),
+        dict(prompt_lookup_num_tokens=4),
+        dict(cpu_mode="bf16"),
+        dict(compile=True),
+    ],
+)
+def test_speculative_model_unsupported_options(tiny_speculative_model, options):
+    model = tiny_speculative_model(**options)
+    with pytest.raises(ValueError, match="not supported by speculative decoding"):
+        model.load()
+
+
+def test_spec_decoding_stop(model_and_tokenizer):
+    model, tokenizer = model_and_tokenizer
+    prompt = "hello world"
+    generate_config = {"temperature": 0, "max_tokens": 30, "stop_token_ids": []}
+
+    def _generate(**kwargs):
+        torch.manual_seed(0)
+        return list(
+            speculative_generate_stream(
+                "test",
+                model,
+                model,
+                tokenizer,
+                prompt,
+                dict(generate_config, **kwargs),
+            )
+        )
+
+    *_, (chunk, _) = _generate()
+    text = chunk["choices"][0]["text"]
+    assert len(text) > 10
+    stop = text[6:9]
+    expected = text[: text.index(stop)]
+
+    *_, (chunk, _) = _generate(stop=[stop])
+    assert chunk["choices"][0]["text"] == expected
+    assert chunk["choices"][0]["finish_reason"] == "stop"
+    # The streamed deltas add up to the final text.
+    chunks = _generate(stop=[stop], stream=True)
+    assert "".join(c["choices"][0]["text"] for c, _ in chunks) == expected
@@ -0,0 +1,57 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from ..stop_matcher import StopMatcher
+
+
+def _feed(matcher, chunks):
+    for chunk in chunks:
+        pos = matcher.feed(chunk)
+        if pos is not None:
+            return pos
+    return None
+
+
+def test_stop_matcher():
+    text = "Thought: call a tool\nAction: search\nObservation: done"
+    stop = ["Observation:", "\nAct", "tool call"]
+    for size in (1, 3, len(text)):
+        chunks = [text[i : i + size] for i in range(0, len(text), size)]
+        assert _feed(StopMatcher(stop), chunks) == text.index("\nAct")
+        assert _feed(StopMatcher("Observation:"), chunks) == text.index("Obs")
+        assert _feed(StopMatcher(["nothing"]), chunks) is None
+
+    # A stop string which is the suffix of another one.
+    assert StopMatcher(["abcd", "bc"]).feed("xxabcd") == 3
+    assert StopMatcher(["ab", "b"]).feed("bab") == 0
+
+    matcher = StopMatcher(["Observation:", "<|end|>"])
+    assert matcher.feed("result: 42\nObserv") is None
+    assert matcher.partially_stopped
+    assert matcher.feed("ed") is None
+    assert not matcher.partially_stopped
+    assert matcher.feed(" <|e") is None
+    assert matcher.partially_stopped
+    assert matcher.feed("nd|>") == len("result: 42\nObserved ")
+
+
+def test_stop_matcher_invalid():
+    with pytest.raises(ValueError, match="Invalid stop field type"):
+        StopMatcher(1)
+    with pytest.raises(ValueError, match="Invalid stop field type"):
+        StopMatcher(["a", None])
+    # Empty stop strings are ignored.
+    assert StopMatcher(["", "b"]).feed("ab") == 1
@@ -0,0 +1,194 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from ..utils import (
+    IncrementalDetokenizer,
+    compile_decode_step,
+    embed,
+    get_memory_footprint,
+    measure_decode_speed,
+    tokenize,
+)
+
+TEXTS = [
+    "Hello world, this is a test.",
+    "你好，世界！这是一个测试。",
+    "Emoji 😀🎉 and café naïve",
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    # A small byte level BPE tokenizer, most of the CJK characters and emojis
+    # are split into several tokens.
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=300,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        special_tokens=["</s>"],
+    )
+    tok.train_from_iterator(TEXTS * 10, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tok, eos_token="</s>")
+
+
+@pytest.mark.parametrize("interval", [1, 3])
+def test_incremental_detokenizer(tokenizer, interval):
+    for text in TEXTS:
+        token_ids = tokenizer(text).input_ids
+        output_ids = []
+        detokenizer = IncrementalDetokenizer(tokenizer, output_ids)
+        deltas = []
+        for i, token_id in enumerate(token_ids):
+            output_ids.append(token_id)
+            if i % interval == 0:
+                deltas.append(detokenizer.step())
+        deltas.append(detokenizer.step(flush=True))
+        assert all("�" not in delta for delta in deltas)
+        assert "".join(deltas) == detokenizer.text == text
+
+
+def test_incremental_detokenizer_rollback(tokenizer):
+    output_ids = tokenizer("Hello world").input_ids
+    detokenizer = IncrementalDetokenizer(tokenizer, output_ids, 1)
+    detokenizer.step()
+    text = detokenizer.text
+    output_ids.append(tokenizer.eos_token_id)
+    detokenizer.step()
+    output_ids[-1] = tokenizer(",").input_ids[0]
+    detokenizer.rollback()
+    assert detokenizer.text == text
+    detokenizer.step()
+    assert detokenizer.text == text + ","
+
+
+def test_tokenize(tokenizer):
+    class QWenTokenizer:
+        def __call__(self, text, **kwargs):
+            assert kwargs == {"allowed_special": "all"}
+            return tokenizer(text)
+
+    QWenLMHeadModel = type(
+        "QWenLMHeadModel", (), {"__module__": "transformers_modules.modeling_qwen"}
+    )
+    expected = tokenizer(TEXTS[0]).input_ids
+    assert tokenize(object(), tokenizer, TEXTS[0]) == expected
+    assert tokenize(QWenLMHeadModel(), QWenTokenizer(), TEXTS[0]) == expected
+
+
+def test_generate_stream_falcon(tokenizer):
+    import torch
+    from transformers import FalconConfig, FalconForCausalLM
+
+    from ..utils import generate_stream
+
+    torch.manual_seed(0)
+    config = FalconConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    model = FalconForCausalLM(config).eval()
+    prompt = TEXTS[0]
+    input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+    expected_ids = model.generate(
+        input_ids,
+        max_new_tokens=8,
+        do_sample=False,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.eos_token_id,
+    )[0, input_ids.shape[1] :].tolist()
+
+    *_, (chunk, usage) = generate_stream(
+        "mock", model, tokenizer, prompt, "cpu", dict(max_tokens=8, temperature=0)
+    )
+    assert chunk["choices"][0]["text"] == tokenizer.decode(
+        expected_ids, skip_special_tokens=True
+    )
+    # The stop token is counted like the other sampled tokens.
+    assert usage["prompt_tokens"] == input_ids.shape[1]
+    assert usage["completion_tokens"] == len(expected_ids)
+
+
+def test_embed(model_and_tokenizer):
+    import torch
+
+    model, tokenizer = model_and_tokenizer
+    token_ids = [tokenizer.encode(text) for text in ["a", "hello world", "abc"] * 3]
+    expected = embed(model, token_ids, "cpu", batch_size=1)
+    embeddings = embed(model, token_ids, "cpu", batch_size=4)
+    assert len(embeddings) == len(token_ids)
+    for got, want in zip(embeddings, expected):
+        torch.testing.assert_close(got, want, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(embeddings[1].norm(), torch.tensor(1.0))
+    assert not torch.allclose(embeddings[0], embeddings[1])
+
+
+def test_cpu_int8_quantization(model_and_tokenizer):
+    import copy
+
+    import torch
+
+    model, tokenizer = model_and_tokenizer
+    # The tied embeddings and LM head are counted once.
+    footprint = get_memory_footprint(model)
+    assert footprint == sum(p.numel() * p.element_size() for p in model.parameters())
+
+    quantized = torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    quantized_footprint = get_memory_footprint(quantized)
+    assert 0 < quantized_footprint < footprint
+    assert measure_decode_speed(quantized, tokenizer.encode("hello"), "cpu", 4) > 0
+
+    input_ids = torch.as_tensor([tokenizer.encode("hello world")])
+    with torch.inference_mode():
+        expected = model(input_ids).logits
+        logits = quantized(input_ids).logits
+    torch.testing.assert_close(logits, expected, rtol=0.1, atol=0.1)
+
+
+def test_compile_decode_step(model_and_tokenizer, monkeypatch):
+    import functools
+
+    import torch
+
+    model, tokenizer = model_and_tokenizer
+    # Trace the model without generating the kernels, which is slow.
+    monkeypatch.setattr(
+        torch, "compile", functools.partial(torch.compile, backend="eager")
+    )
+    decode_step = compile_decode_step(model)
+    with torch.inference_mode():
+        for prompt in ["hello", "a longer prompt"]:
+            expected = out = model(
+                torch.as_tensor([tokenizer.encode(prompt)]), use_cache=True
+            )
+            for _ in range(4):
+                token = out.logits[:, -1].argmax(dim=-1, keepdim=True)
+                out = decode_step(
+                    input_ids=token, use_cache=True, past_key_values=out.past_key_values
+                )
+                expected = model(
+                    token, use_cache=True, past_key_values=expected.past_key_values
+                )
+                torch.testing.assert_close(out.logits, expected.logits)
@@ -12,33 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import gc
+import itertools
 import logging
 import time
 import uuid
-from threading import Thread
-from typing import Iterable, Iterator, Tuple
+from typing import TYPE_CHECKING, Any, Callable, Iterator, List, Optional, Tuple
 
 import torch
-from transformers import GenerationConfig, TextIteratorStreamer
-from transformers.generation.logits_process import (
-    LogitsProcessorList,
-    RepetitionPenaltyLogitsProcessor,
-    TemperatureLogitsWarper,
-    TopKLogitsWarper,
-    TopPLogitsWarper,
-)
 
-from ....device_utils import empty_cache
 from ....types import (
     CompletionChoice,
     CompletionChunk,
     CompletionUsage,
+    RequestTimings,
     max_tokens_field,
 )
+from .kv_cache import StaticKVCache, rollback_kv_cache
+from .prompt_lookup import PromptLookup, verify
+from .sampler import Sampler
+from .stop_matcher import StopMatcher
+
+if TYPE_CHECKING:
+    from .prefix_cache import PrefixCache
 
 logger = logging.getLogger(__name__)
 
+KVCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
 
 def is_sentence_complete(output: str):
     """Check whether the output is a complete sentence."""
@@ -46,12 +46,12 @@ def is_sentence_complete(output: str):
     return output.endswith(end_symbols)
 
 
-def is_partial_stop(output: str, stop_str: str):
-    """Check whether the output contains a partial stop str."""
-    for i in range(0, min(len(output), len(stop_str))):
-        if stop_str.startswith(output[-i:]):
-            return True
-    return False
+def tokenize(model, tokenizer, prompt: str) -> List[int]:
+    if ".modeling_qwen." in str(type(model)).lower():
+        # TODO: hacky, the tiktoken tokenizer of Qwen raises on the special
+        # tokens in the text unless they are allowed.
+        return tokenizer(prompt, allowed_special="all").input_ids
+    return tokenizer(prompt).input_ids
 
 
 def get_context_length(config):
@@ -77,20 +77,232 @@ def get_context_length(config):
     return max(max_sequence_length, seq_length, max_position_embeddings)
 
 
-def prepare_logits_processor(
-    temperature: float, repetition_penalty: float, top_p: float, top_k: int
-) -> LogitsProcessorList:
-    processor_list = LogitsProcessorList()
-    # TemperatureLogitsWarper doesn't accept 0.0, 1.0 makes it a no-op so we skip two cases.
-    if temperature >= 1e-5 and temperature != 1.0:
-        processor_list.append(TemperatureLogitsWarper(temperature))
-    if repetition_penalty > 1.0:
-        processor_list.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
-    if 1e-8 <= top_p < 1.0:
-        processor_list.append(TopPLogitsWarper(top_p))
-    if top_k > 0:
-        processor_list.append(TopKLogitsWarper(top_k))
-    return processor_list
+def to_legacy_cache(past_key_values) -> KVCache:
+    """Convert the `Cache` object of transformers >= 4.36 to the tuple format."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+@torch.inference_mode()
+def has_standard_kv_cache(model, device) -> bool:
+    """
+    Whether the model is a decoder-only model whose KV cache is a tuple of
+    `[n_batch, n_head, n_seq, n_dim]` tensors, which can be sliced, padded
+    and concatenated along the batch and the sequence dims.
+    """
+    if model.config.is_encoder_decoder:
+        return False
+    try:
+        out = model(
+            torch.zeros((1, 3), dtype=torch.long, device=device), use_cache=True
+        )
+        k_cache, v_cache = to_legacy_cache(out.past_key_values)[0]
+    except Exception:
+        logger.debug("Failed to probe the KV cache layout.", exc_info=True)
+        return False
+    return (
+        isinstance(k_cache, torch.Tensor)
+        and k_cache.dim() == 4
+        and k_cache.shape[0] == 1
+        and k_cache.shape[2] == 3
+        and v_cache.shape[2] == 3
+    )
+
+
+@torch.inference_mode()
+def prefill(model, input_ids: List[int], device, past_key_values=None, chunk_size=0):
+    """
+    Feed `input_ids` to the decoder-only model after the tokens cached in
+    `past_key_values`, `chunk_size` tokens at a time if it is positive, so
+    the activations of a long prompt are bounded by the chunk size. Return
+    the output of the last chunk, whose KV cache covers all the tokens.
+    """
+    if chunk_size <= 0:
+        chunk_size = len(input_ids)
+    out = None
+    for start in range(0, len(input_ids), chunk_size):
+        out = model(
+            torch.as_tensor([input_ids[start : start + chunk_size]], device=device),
+            use_cache=True,
+            past_key_values=past_key_values,
+        )
+        past_key_values = out.past_key_values
+    return out
+
+
+@torch.inference_mode()
+def embed(
+    model, token_ids: List[List[int]], device, batch_size: int = 32
+) -> List[torch.Tensor]:
+    """
+    Mean pool the last hidden states of each token sequence, and return the
+    L2 normalized embeddings in the order of `token_ids`.
+
+    The sequences are sorted by length, so each batch of `batch_size` is
+    padded to similar lengths. The padding is on the right, so a causal model
+    neither attends to it nor shifts the positions of the tokens, and the
+    attention mask excludes it from the pooling. The base model is run, the
+    logits over the vocabulary are not needed.
+    """
+    # The hidden states of ChatGLM are `[n_seq, n_batch, n_hidden]`.
+    seq_first = "chatglm" in str(type(model)).lower()
+    order = sorted(range(len(token_ids)), key=lambda i: -len(token_ids[i]))
+    embeddings: List[torch.Tensor] = [torch.empty(0)] * len(token_ids)
+    for start in range(0, len(order), batch_size):
+        batch = order[start : start + batch_size]
+        input_ids = torch.zeros(
+            (len(batch), len(token_ids[batch[0]])), dtype=torch.long, device=device
+        )
+        attention_mask = torch.zeros_like(input_ids)
+        for row, i in enumerate(batch):
+            input_ids[row, : len(token_ids[i])] = torch.as_tensor(token_ids[i])
+            attention_mask[row, : len(token_ids[i])] = 1
+        out = model.base_model(
+            input_ids,
+            # Without padding, the causal attention may take a faster kernel.
+            attention_mask=attention_mask if not attention_mask.all() else None,
+            use_cache=False,
+            output_hidden_states=True,
+        )
+        hidden_states = out.hidden_states[-1]
+        if seq_first:
+            hidden_states = hidden_states.transpose(0, 1)
+        mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+        pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1)
+        pooled = torch.nn.functional.normalize(pooled.float(), p=2, dim=1)
+        for row, i in enumerate(batch):
+            embeddings[i] = pooled[row]
+    return embeddings
+
+
+def get_memory_footprint(model) -> int:
+    """
+    The bytes of the parameters and the buffers of the model, counting the
+    shared tensors once. Unlike `PreTrainedModel.get_memory_footprint`, the
+    packed weights of the dynamically quantized linear layers are included.
+    """
+    tensors = {}
+    for tensor in itertools.chain(model.parameters(), model.buffers()):
+        tensors[tensor.data_ptr()] = tensor
+    for module in model.modules():
+        packed_params = getattr(module, "_packed_params", None)
+        if packed_params is not None and hasattr(packed_params, "_weight_bias"):
+            for tensor in packed_params._weight_bias():
+                if tensor is not None:
+                    tensors[tensor.data_ptr()] = tensor
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
+@torch.inference_mode()
+def measure_decode_speed(
+    model,
+    input_ids: List[int],
+    device,
+    num_tokens: int = 16,
+    decode_model=None,
+    static_kv_cache: bool = False,
+) -> float:
+    """
+    Prefill `input_ids`, then greedily decode `num_tokens` tokens one by one
+    with `decode_model`, e.g. the compiled model, and return the decoded
+    tokens per second. The prefill is not timed.
+    """
+    past_key_values = (
+        StaticKVCache(len(input_ids) + num_tokens) if static_kv_cache else None
+    )
+    out = prefill(model, input_ids, device, past_key_values)
+    if decode_model is None:
+        decode_model = model
+    start = time.perf_counter()
+    for _ in range(num_tokens):
+        token = out.logits[:, -1].argmax(dim=-1, keepdim=True)
+        out = decode_model(
+            input_ids=token, use_cache=True, past_key_values=out.past_key_values
+        )
+    # The logits are computed asynchronously on the GPUs.
+    out.logits.cpu()
+    return num_tokens / (time.perf_counter() - start)
+
+
+def compile_decode_step(model) -> Callable:
+    """
+    Compile the forward of a single decode step of the decoder-only model.
+
+    The sequence length is dynamic, so a single graph serves the steps of any
+    length instead of recompiling for each of them. An attention mask is
+    always passed, since some models can only be traced with it.
+    """
+    compiled_model = torch.compile(model, dynamic=True)
+
+    def decode_step(input_ids: torch.Tensor, past_key_values, **kwargs):
+        if hasattr(past_key_values, "get_seq_length"):
+            num_cached = past_key_values.get_seq_length()
+        else:
+            num_cached = past_key_values[0][0].shape[2]
+        attention_mask = torch.ones(
+            (input_ids.shape[0], num_cached + input_ids.shape[1]),
+            dtype=torch.long,
+            device=input_ids.device,
+        )
+        return compiled_model(
+            input_ids,
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            **kwargs,
+        )
+
+    return decode_step
+
+
+class IncrementalDetokenizer:
+    """
+    Decode the generated tokens incrementally.
+
+    Each step decodes only the tokens since the last read offset, plus the
+    tokens before it as the context of the merges and the leading spaces, and
+    takes the difference as the new text. The new text is held back while it
+    ends with an incomplete UTF-8 character, i.e. "�".
+    """
+
+    def __init__(self, tokenizer, token_ids: List[int], offset: int = 0):
+        self._tokenizer = tokenizer
+        # Appended by the caller.
+        self._token_ids = token_ids
+        self._prefix_offset = offset
+        self._read_offset = offset
+        self._last_state: Tuple[int, int, str] = (offset, offset, "")
+        self.text = ""
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self._tokenizer.decode(
+            token_ids,
+            skip_special_tokens=True,
+            spaces_between_special_tokens=False,
+            clean_up_tokenization_spaces=True,
+        )
+
+    def step(self, flush: bool = False) -> str:
+        """
+        Decode the new tokens and return the new text, which is also appended
+        to `text`. If `flush` is True, incomplete characters are not held back.
+        """
+        self._last_state = (self._prefix_offset, self._read_offset, self.text)
+        prefix_text = self._decode(
+            self._token_ids[self._prefix_offset : self._read_offset]
+        )
+        new_text = self._decode(self._token_ids[self._prefix_offset :])
+        if len(new_text) <= len(prefix_text) or (not flush and new_text.endswith("�")):
+            return ""
+        new_text = new_text[len(prefix_text) :]
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self._token_ids)
+        self.text += new_text
+        return new_text
+
+    def rollback(self):
+        """Undo the last step, e.g. the last token is replaced."""
+        self._prefix_offset, self._read_offset, self.text = self._last_state
 
 
 @torch.inference_mode()
@@ -102,6 +314,12 @@ def generate_stream(
     device,
     generate_config,
     judge_sent_end=False,
+    prefix_cache: Optional["PrefixCache"] = None,
+    static_kv_cache: bool = False,
+    prefill_chunk_size: int = 0,
+    prompt_lookup_num_tokens: int = 0,
+    prompt_lookup_max_ngram_size: int = 3,
+    decode_model=None,
 ) -> Iterator[Tuple[CompletionChunk, CompletionUsage]]:
     context_len = get_context_length(model.config)
     stream_interval = generate_config.get("stream_interval", 2)
@@ -109,25 +327,15 @@ def generate_stream(
 
     len_prompt = len(prompt)
 
-    temperature = float(generate_config.get("temperature", 1.0))
-    repetition_penalty = float(generate_config.get("repetition_penalty", 1.0))
-    top_p = float(generate_config.get("top_p", 1.0))
-    top_k = int(generate_config.get("top_k", -1))  # -1 means disable
     max_new_tokens = int(generate_config.get("max_tokens", max_tokens_field.default))
     echo = bool(generate_config.get("echo", False))
     stop_str = generate_config.get("stop", None)
     stop_token_ids = generate_config.get("stop_token_ids", None) or []
     stop_token_ids.append(tokenizer.eos_token_id)
 
-    logits_processor = prepare_logits_processor(
-        temperature, repetition_penalty, top_p, top_k
-    )
-
-    if ".modeling_qwen." in str(type(model)).lower():
-        # TODO: hacky
-        input_ids = tokenizer(prompt, allowed_special="all").input_ids
-    else:
-        input_ids = tokenizer(prompt).input_ids
+    tokenize_start = time.perf_counter()
+    input_ids = tokenize(model, tokenizer, prompt)
+    tokenize_time = time.perf_counter() - tokenize_start
     output_ids = list(input_ids)
 
     if model.config.is_encoder_decoder:
@@ -140,6 +348,7 @@ def generate_stream(
     input_ids = input_ids[-max_src_len:]
     input_echo_len = len(input_ids)
 
+    prefill_start = time.perf_counter()
     if model.config.is_encoder_decoder:
         encoder_output = model.encoder(
             input_ids=torch.as_tensor([input_ids], device=device)
@@ -150,13 +359,65 @@ def generate_stream(
             device=device,
         )
 
+    # Switch to CPU by avoiding some bugs in mps backend.
+    sampler = Sampler("cpu" if device == "mps" else device)
+    sampler.add(output_ids, generate_config)
+
     start = time.time()
     past_key_values = out = None
     sent_interrupt = False
-    token = None
+    token: Any = None
     last_output_length = 0
+    prefill_time = decode_time = detokenize_time = 0.0
+    if echo:
+        detokenizer = IncrementalDetokenizer(tokenizer, output_ids)
+        rfind_start = len_prompt
+    else:
+        detokenizer = IncrementalDetokenizer(tokenizer, output_ids, len(output_ids))
+        rfind_start = 0
+    # The non stream request only needs the final text, unless it has to be
+    # checked for the stop words.
+    check_text = stream or bool(stop_str) or judge_sent_end
+    stop_matcher = StopMatcher(stop_str) if stop_str else None
+    # The stop words have been searched in the text before this offset.
+    checked_length = rfind_start
+    stop_pos = None
+    # The draft tokens of prompt lookup decoding are verified by the next
+    # decode step, which may generate several tokens at once.
+    prompt_lookup = (
+        PromptLookup(output_ids, prompt_lookup_num_tokens, prompt_lookup_max_ngram_size)
+        if prompt_lookup_num_tokens > 0
+        and not judge_sent_end
+        and not model.config.is_encoder_decoder
+        else None
+    )
+    # The tokens generated ahead, they are counted by the sampler already.
+    pending_tokens: List[int] = []
     for i in range(max_new_tokens):
-        if i == 0:
+        step_start = prefill_start if i == 0 else time.perf_counter()
+        counted = False
+        if pending_tokens:
+            token = pending_tokens.pop(0)
+            output_ids.append(token)
+            counted = True
+        elif prompt_lookup is not None and i > 0:
+            candidates = prompt_lookup.propose()
+            out = model(
+                input_ids=torch.as_tensor([[token] + candidates], device=device),
+                use_cache=True,
+                past_key_values=past_key_values,
+            )
+            tokens = verify(sampler, out.logits[0], candidates)
+            past_key_values = out.past_key_values
+            if len(tokens) <= len(candidates):
+                past_key_values = rollback_kv_cache(
+                    past_key_values, len(candidates) + 1 - len(tokens)
+                )
+            token, pending_tokens = tokens[0], tokens[1:]
+            output_ids.append(token)
+            counted = True
+            decode_time += time.perf_counter() - step_start
+        elif i == 0:
             if model.config.is_encoder_decoder:
                 out = model.decoder(
                     input_ids=start_ids,
@@ -165,8 +426,31 @@ def generate_stream(
                 )
                 logits = model.lm_head(out[0])
             else:
-                out = model(torch.as_tensor([input_ids], device=device), use_cache=True)
+                num_cached_tokens, cached_kv = (
+                    prefix_cache.match(input_ids)
+                    if prefix_cache is not None
+                    else (0, None)
+                )
+                if num_cached_tokens:
+                    logger.debug(
+                        f"Prefix cache hit {num_cached_tokens}/{input_echo_len} tokens."
+                    )
+                if static_kv_cache:
+                    # Preallocated for the prompt and all the new tokens.
+                    cached_kv = StaticKVCache.from_legacy_cache(
+                        cached_kv or (),
+                        input_echo_len + max_new_tokens + prompt_lookup_num_tokens,
+                    )
+                out = prefill(
+                    model,
+                    input_ids[num_cached_tokens:],
+                    device,
+                    cached_kv,
+                    prefill_chunk_size,
+                )
                 logits = out.logits
+                if prefix_cache is not None:
+                    prefix_cache.insert(input_ids, out.past_key_values)
             past_key_values = out.past_key_values
         else:
             if model.config.is_encoder_decoder:
@@ -182,7 +466,12 @@ def generate_stream(
 
                 logits = model.lm_head(out[0])
             else:
-                out = model(
+                # The compiled model decodes a single token only.
+                out = (
+                    decode_model
+                    if decode_model is not None and not sent_interrupt
+                    else model
+                )(
                     input_ids=torch.as_tensor(
                         [[token] if not sent_interrupt else output_ids], device=device
                     ),
@@ -193,89 +482,57 @@ def generate_stream(
                 logits = out.logits
             past_key_values = out.past_key_values
 
-        if logits_processor:
-            if repetition_penalty > 1.0:
-                tmp_output_ids = torch.as_tensor([output_ids], device=logits.device)
+        if not counted:
+            last_token_logits = logits[:, -1, :]
+            token = sampler.sample(last_token_logits)[0]
+            output_ids.append(token)
+            # Sampling the token waits for the forward pass to finish on the device.
+            if i == 0:
+                prefill_time = time.perf_counter() - step_start
             else:
-                tmp_output_ids = None
-            last_token_logits = logits_processor(tmp_output_ids, logits[:, -1, :])[0]
-        else:
-            last_token_logits = logits[0, -1, :]
-
-        if device == "mps":
-            # Switch to CPU by avoiding some bugs in mps backend.
-            last_token_logits = last_token_logits.float().to("cpu")
-
-        if temperature < 1e-5 or top_p < 1e-8:  # greedy
-            _, indices = torch.topk(last_token_logits, 2)
-            tokens = [int(index) for index in indices.tolist()]
-        else:
-            probs = torch.softmax(last_token_logits, dim=-1)
-            indices = torch.multinomial(probs, num_samples=2)
-            tokens = [int(token) for token in indices.tolist()]
-        token = tokens[0]
-        output_ids.append(token)
+                decode_time += time.perf_counter() - step_start
 
         if token in stop_token_ids:
             stopped = True
         else:
             stopped = False
 
-        if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
-            if echo:
-                tmp_output_ids = output_ids
-                rfind_start = len_prompt
-            else:
-                tmp_output_ids = output_ids[input_echo_len:]
-                rfind_start = 0
-
-            output = tokenizer.decode(
-                tmp_output_ids,
-                skip_special_tokens=True,
-                spaces_between_special_tokens=False,
-                clean_up_tokenization_spaces=True,
-            )
+        if check_text and (
+            i % stream_interval == 0 or i == max_new_tokens - 1 or stopped
+        ):
+            detokenize_start = time.perf_counter()
+            detokenizer.step()
+            output = detokenizer.text
+            detokenize_time += time.perf_counter() - detokenize_start
 
             # TODO: For the issue of incomplete sentences interrupting output, apply a patch and others can also modify it to a more elegant way
             if judge_sent_end and stopped and not is_sentence_complete(output):
-                if len(tokens) > 1:
-                    token = tokens[1]
-                    output_ids[-1] = token
-                else:
-                    output_ids.pop()
+                # Replace the stop token by the next candidate.
+                token = sampler.sample(last_token_logits, exclude=[token])[0]
+                output_ids[-1] = token
+                detokenizer.rollback()
+                output = detokenizer.text
                 stopped = False
                 sent_interrupt = True
 
             partially_stopped = False
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
-                    else:
-                        partially_stopped = is_partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            break
-                        else:
-                            partially_stopped = is_partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
+            if stop_matcher is not None:
+                pos = stop_matcher.feed(output[checked_length:])
+                checked_length = len(output)
+                if pos is not None:
+                    stop_pos = rfind_start + pos
+                    output = output[:stop_pos]
+                    stopped = True
                 else:
-                    raise ValueError("Invalid stop field type.")
+                    partially_stopped = stop_matcher.partially_stopped
 
-            if stream:
+            # prevent yielding partial stop sequence
+            if stream and not partially_stopped:
                 output = output.strip("�")
                 tmp_output_length = len(output)
                 output = output[last_output_length:]
                 last_output_length = tmp_output_length
 
-            # prevent yielding partial stop sequence
             if not partially_stopped:
                 completion_choice = CompletionChoice(
                     text=output, index=0, logprobs=None, finish_reason=None
@@ -289,17 +546,19 @@ def generate_stream(
                 )
                 completion_usage = CompletionUsage(
                     prompt_tokens=input_echo_len,
-                    completion_tokens=i,
-                    total_tokens=(input_echo_len + i),
+                    completion_tokens=i + 1,
+                    total_tokens=(input_echo_len + i + 1),
                 )
 
                 yield completion_chunk, completion_usage
 
+        if not counted:
+            sampler.update([token])
         if stopped:
             break
 
     elapsed_time = time.time() - start
-    logger.info(f"Average generation speed: {i / elapsed_time:.2f} tokens/s.")
+    logger.info(f"Average generation speed: {(i + 1) / elapsed_time:.2f} tokens/s.")
 
     # finish stream event, which contains finish reason
     if stopped:
@@ -314,6 +573,12 @@ def generate_stream(
             text="", index=0, logprobs=None, finish_reason=finish_reason
         )
     else:
+        detokenize_start = time.perf_counter()
+        detokenizer.step(flush=True)
+        output = detokenizer.text
+        if stop_pos is not None:
+            output = output[:stop_pos]
+        detokenize_time += time.perf_counter() - detokenize_start
         completion_choice = CompletionChoice(
             text=output, index=0, logprobs=None, finish_reason=finish_reason
         )
@@ -325,169 +590,26 @@ def generate_stream(
         model=model_uid,
         choices=[completion_choice],
     )
-    completion_usage = CompletionUsage(
-        prompt_tokens=input_echo_len,
-        completion_tokens=i,
-        total_tokens=(input_echo_len + i),
-    )
-
-    yield completion_chunk, completion_usage
-
-    # clean
-    del past_key_values, out
-    gc.collect()
-    empty_cache()
-
-
-@torch.inference_mode()
-def generate_stream_falcon(
-    model_uid,
-    model,
-    tokenizer,
-    prompt,
-    device,
-    generate_config,
-    judge_sent_end=False,
-) -> Iterator[Tuple[CompletionChunk, CompletionUsage]]:
-    context_len = get_context_length(model.config)
-    stream_interval = generate_config.get("stream_interval", 2)
-    stream = generate_config.get("stream", False)
-
-    len_prompt = len(prompt)
-
-    temperature = float(generate_config.get("temperature", 1.0))
-    repetition_penalty = float(generate_config.get("repetition_penalty", 1.0))
-    top_p = float(generate_config.get("top_p", 1.0))
-    top_k = int(generate_config.get("top_k", 50))  # -1 means disable
-    max_new_tokens = int(generate_config.get("max_tokens", max_tokens_field.default))
-    echo = bool(generate_config.get("echo", False))
-    stop_str = generate_config.get("stop", None)
-    stop_token_ids = generate_config.get("stop_token_ids", None) or []
-    stop_token_ids.append(tokenizer.eos_token_id)
-
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-    input_ids = inputs["input_ids"]
-    attention_mask = inputs["attention_mask"]
-
-    max_src_len = context_len - max_new_tokens - 8
-
-    input_ids = input_ids[-max_src_len:]  # truncate from the left
-    attention_mask = attention_mask[-max_src_len:]  # truncate from the left
-    input_echo_len = len(input_ids)
-
-    decode_config = dict(skip_special_tokens=True, clean_up_tokenization_spaces=True)
-    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, **decode_config)
-
-    generation_config = GenerationConfig(
-        max_new_tokens=max_new_tokens,
-        do_sample=temperature >= 1e-5,
-        temperature=temperature,
-        repetition_penalty=repetition_penalty,
-        no_repeat_ngram_size=10,
-        top_p=top_p,
-        top_k=top_k,
-        eos_token_id=stop_token_ids,
-    )
-
-    generation_kwargs = dict(
-        inputs=input_ids,
-        attention_mask=attention_mask,
-        streamer=streamer,
-        generation_config=generation_config,
-    )
-
-    thread = Thread(target=model.generate, kwargs=generation_kwargs)
-    thread.start()
-
-    if echo:
-        # means keep the prompt
-        output = prompt
-    else:
-        output = ""
-
-    last_output_length = 0
-    for i, new_text in enumerate(streamer):
-        output += new_text
-        if i % stream_interval == 0:
-            if echo:
-                rfind_start = len_prompt
-            else:
-                rfind_start = 0
-
-            partially_stopped = False
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                    else:
-                        partially_stopped = is_partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            break
-                        else:
-                            partially_stopped = is_partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
-                else:
-                    raise ValueError("Invalid stop field type.")
-
-            if stream:
-                output = output.strip("�")
-                tmp_output_length = len(output)
-                output = output[last_output_length:]
-                last_output_length = tmp_output_length
-
-            # prevent yielding partial stop sequence
-            if not partially_stopped:
-                completion_choice = CompletionChoice(
-                    text=output, index=0, logprobs=None, finish_reason=None
-                )
-                completion_chunk = CompletionChunk(
-                    id=str(uuid.uuid1()),
-                    object="text_completion",
-                    created=int(time.time()),
-                    model=model_uid,
-                    choices=[completion_choice],
-                )
-                completion_usage = CompletionUsage(
-                    prompt_tokens=input_echo_len,
-                    completion_tokens=i,
-                    total_tokens=(input_echo_len + i),
-                )
-
-                yield completion_chunk, completion_usage
-    output = output.strip()
-
-    # finish stream event, which contains finish reason
-    if i == max_new_tokens - 1:
-        finish_reason = "length"
-    elif partially_stopped:
-        finish_reason = None
-    else:
-        finish_reason = "stop"
-
-    completion_choice = CompletionChoice(
-        text=output, index=0, logprobs=None, finish_reason=finish_reason
-    )
-    completion_chunk = CompletionChunk(
-        id=str(uuid.uuid1()),
-        object="text_completion",
-        created=int(time.time()),
-        model=model_uid,
-        choices=[completion_choice],
+    completion_chunk["timings"] = RequestTimings(
+        tokenize_ms=tokenize_time * 1000,
+        prefill_ms=prefill_time * 1000,
+        decode_ms=decode_time * 1000,
+        detokenize_ms=detokenize_time * 1000,
     )
     completion_usage = CompletionUsage(
         prompt_tokens=input_echo_len,
-        completion_tokens=i,
-        total_tokens=(input_echo_len + i),
+        completion_tokens=i + 1,
+        total_tokens=(input_echo_len + i + 1),
     )
 
     yield completion_chunk, completion_usage
 
-    # clean
-    gc.collect()
-    empty_cache()
+    if prefix_cache is not None and past_key_values is not None:
+        if pending_tokens:
+            # Drop the accepted draft tokens which are not in the output.
+            past_key_values = rollback_kv_cache(past_key_values, len(pending_tokens))
+        # The KV cache covers all the tokens but the last sampled one, cache the
+        # generated tokens as well, they are the history of the next chat turn.
+        past_key_values = to_legacy_cache(past_key_values)
+        num_kv_tokens = past_key_values[0][0].shape[2]
+        prefix_cache.insert(output_ids[-num_kv_tokens - 1 : -1], past_key_values)
@@ -165,6 +165,7 @@ class YiVLChatModel(PytorchChatModel):
             raise Exception(
                 f"Chat with model {self.model_family.model_name} does not support stream."
             )
+        self._check_single_sequence(generate_config)
         if not generate_config:
             generate_config = {}
         from ....thirdparty.llava.conversation import conv_templates
@@ -421,3 +421,37 @@ def test_is_valid_model_name():
     assert not is_valid_model_name("foo/bar")
     assert not is_valid_model_name("   ")
     assert not is_valid_model_name("")
+
+
+def test_to_chat_completion_chunks_of_several_choices():
+    def _chunk(index, text, finish_reason=None):
+        return {
+            "id": "cmpl-1",
+            "model": "mock",
+            "created": 0,
+            "object": "text_completion",
+            "choices": [
+                {
+                    "index": index,
+                    "text": text,
+                    "logprobs": None,
+                    "finish_reason": finish_reason,
+                }
+            ],
+        }
+
+    chunks = [_chunk(0, "a"), _chunk(1, "b"), _chunk(0, "c"), _chunk(1, "", "stop")]
+    chat_chunks = list(ChatModelMixin._to_chat_completion_chunks(iter(chunks)))
+    deltas = [
+        (chunk["choices"][0]["index"], chunk["choices"][0]["delta"])
+        for chunk in chat_chunks
+    ]
+    assert deltas == [
+        (0, {"role": "assistant"}),
+        (0, {"content": "a"}),
+        (1, {"role": "assistant"}),
+        (1, {"content": "b"}),
+        (0, {"content": "c"}),
+        (1, {"content": ""}),
+    ]
+    assert chat_chunks[-1]["choices"][0]["finish_reason"] == "stop"
@@ -17,7 +17,7 @@ import logging
 import os
 import time
 import uuid
-from typing import AsyncGenerator, Dict, Iterator, List, Optional, Tuple, cast
+from typing import AsyncGenerator, Dict, Iterator, List, Optional, Set, Tuple, cast
 
 from ...types import (
     SPECIAL_TOOL_PROMPT,
@@ -423,18 +423,21 @@ Begin!"""
             "object": "chat.completion.chunk",
             "choices": [
                 {
-                    "index": i,
+                    "index": choice["index"],
                     "delta": {
                         "content": choice["text"],
                     },
                     "finish_reason": choice["finish_reason"],
                 }
-                for i, choice in enumerate(chunk["choices"])
+                for choice in chunk["choices"]
             ],
         }
         usage = chunk.get("usage")
         if usage is not None:
             chat_chunk["usage"] = usage
+        timings = chunk.get("timings")
+        if timings is not None:
+            chat_chunk["timings"] = timings
         return cast(ChatCompletionChunk, chat_chunk)
 
     @classmethod
@@ -448,13 +451,13 @@ Begin!"""
             "object": "chat.completion.chunk",
             "choices": [
                 {
-                    "index": i,
+                    "index": choice["index"],
                     "delta": {
                         "role": "assistant",
                     },
                     "finish_reason": None,
                 }
-                for i, choice in enumerate(chunk["choices"])
+                for choice in chunk["choices"]
             ],
         }
         usage = chunk.get("usage")
@@ -467,8 +470,11 @@ Begin!"""
         cls,
         chunks: Iterator[CompletionChunk],
     ) -> Iterator[ChatCompletionChunk]:
-        for i, chunk in enumerate(chunks):
-            if i == 0:
+        # The role is sent before the first chunk of each choice.
+        indexes: Set[int] = set()
+        for chunk in chunks:
+            if not indexes.issuperset(choice["index"] for choice in chunk["choices"]):
+                indexes.update(choice["index"] for choice in chunk["choices"])
                 yield cls._get_first_chat_completion_chunk(chunk)
             yield cls._to_chat_completion_chunk(chunk)
 
@@ -477,16 +483,23 @@ Begin!"""
         cls,
         chunks: AsyncGenerator[CompletionChunk, None],
     ) -> AsyncGenerator[ChatCompletionChunk, None]:
-        i = 0
-        async for chunk in chunks:
-            if i == 0:
-                yield cls._get_first_chat_completion_chunk(chunk)
-            yield cls._to_chat_completion_chunk(chunk)
-            i += 1
+        # The role is sent before the first chunk of each choice.
+        indexes: Set[int] = set()
+        try:
+            async for chunk in chunks:
+                if not indexes.issuperset(
+                    choice["index"] for choice in chunk["choices"]
+                ):
+                    indexes.update(choice["index"] for choice in chunk["choices"])
+                    yield cls._get_first_chat_completion_chunk(chunk)
+                yield cls._to_chat_completion_chunk(chunk)
+        finally:
+            # Close the chunks at once if the stream is closed early.
+            await chunks.aclose()
 
     @staticmethod
     def _to_chat_completion(completion: Completion) -> ChatCompletion:
-        return {
+        chat_completion: ChatCompletion = {
             "id": "chat" + completion["id"],
             "object": "chat.completion",
             "created": completion["created"],
@@ -504,6 +517,9 @@ Begin!"""
             ],
             "usage": completion["usage"],
         }
+        if "timings" in completion:
+            chat_completion["timings"] = completion["timings"]
+        return chat_completion
 
     @staticmethod
     def _eval_gorilla_openfunctions_arguments(c, tools):
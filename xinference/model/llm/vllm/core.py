@@ -299,27 +299,35 @@ class VLLMModel(LLM):
 
         async def stream_results() -> AsyncGenerator[CompletionChunk, None]:
             previous_texts = [""] * sanitized_generate_config["n"]
-            async for _request_output in results_generator:
-                chunk = self._convert_request_output_to_completion_chunk(
-                    request_id=request_id,
-                    model=self.model_uid,
-                    request_output=_request_output,
-                )
-                for i, choice in enumerate(chunk["choices"]):
-                    delta = choice["text"][len(previous_texts[i]) :]
-                    previous_texts[i] = choice["text"]
-                    choice["text"] = delta
-                prompt_tokens = len(_request_output.prompt_token_ids)
-                completion_tokens = sum(
-                    len(output.token_ids) for output in _request_output.outputs
-                )
-                total_tokens = prompt_tokens + completion_tokens
-                chunk["usage"] = CompletionUsage(
-                    prompt_tokens=prompt_tokens,
-                    completion_tokens=completion_tokens,
-                    total_tokens=total_tokens,
-                )
-                yield chunk
+            finished = False
+            try:
+                async for _request_output in results_generator:
+                    chunk = self._convert_request_output_to_completion_chunk(
+                        request_id=request_id,
+                        model=self.model_uid,
+                        request_output=_request_output,
+                    )
+                    for i, choice in enumerate(chunk["choices"]):
+                        delta = choice["text"][len(previous_texts[i]) :]
+                        previous_texts[i] = choice["text"]
+                        choice["text"] = delta
+                    prompt_tokens = len(_request_output.prompt_token_ids)
+                    completion_tokens = sum(
+                        len(output.token_ids) for output in _request_output.outputs
+                    )
+                    total_tokens = prompt_tokens + completion_tokens
+                    chunk["usage"] = CompletionUsage(
+                        prompt_tokens=prompt_tokens,
+                        completion_tokens=completion_tokens,
+                        total_tokens=total_tokens,
+                    )
+                    yield chunk
+                finished = True
+            finally:
+                if not finished:
+                    # The stream is closed before the end, free the sequences.
+                    assert self._engine is not None
+                    await self._engine.abort(request_id)
 
         if stream:
             return stream_results()
@@ -135,33 +135,69 @@ class RerankModel:
         max_chunks_per_doc: Optional[int],
         return_documents: Optional[bool],
     ) -> Rerank:
+        return self.rerank_batch(
+            [(documents, query, top_n, max_chunks_per_doc, return_documents)]
+        )[0]
+
+    def rerank_batch(
+        self,
+        requests: List[
+            Tuple[List[str], str, Optional[int], Optional[int], Optional[bool]]
+        ],
+    ) -> List[Rerank]:
+        """
+        Rerank many requests together, each request is a tuple of
+        `(documents, query, top_n, max_chunks_per_doc, return_documents)`.
+        The query/document pairs of all the requests are sorted by length,
+        so pairs of similar length are scored in the same batch.
+        """
         assert self._model is not None
-        if max_chunks_per_doc is not None:
-            raise ValueError("rerank hasn't support `max_chunks_per_doc` parameter.")
-        sentence_combinations = [[query, doc] for doc in documents]
-        similarity_scores = self._model.predict(sentence_combinations)
-        sim_scores_argsort = list(reversed(np.argsort(similarity_scores)))
-        if top_n is not None:
-            sim_scores_argsort = sim_scores_argsort[:top_n]
-        if return_documents:
-            docs = [
-                DocumentObj(
-                    index=int(arg),
-                    relevance_score=float(similarity_scores[arg]),
-                    document=Document(text=documents[arg]),
-                )
-                for arg in sim_scores_argsort
-            ]
-        else:
-            docs = [
-                DocumentObj(
-                    index=int(arg),
-                    relevance_score=float(similarity_scores[arg]),
-                    document=None,
+        sentence_combinations = []
+        for documents, query, _, max_chunks_per_doc, _ in requests:
+            if max_chunks_per_doc is not None:
+                raise ValueError(
+                    "rerank hasn't support `max_chunks_per_doc` parameter."
                 )
-                for arg in sim_scores_argsort
-            ]
-        return Rerank(id=str(uuid.uuid1()), results=docs)
+            sentence_combinations.extend([[query, doc] for doc in documents])
+        length_sorted_idx = np.argsort(
+            [-len(query) - len(doc) for query, doc in sentence_combinations],
+            kind="stable",
+        )
+        sorted_scores = self._model.predict(
+            [sentence_combinations[idx] for idx in length_sorted_idx]
+        )
+        all_similarity_scores = np.empty(len(sentence_combinations), dtype=np.float32)
+        all_similarity_scores[length_sorted_idx] = sorted_scores
+
+        results = []
+        start = 0
+        for documents, _, top_n, _, return_documents in requests:
+            end = start + len(documents)
+            similarity_scores = all_similarity_scores[start:end]
+            start = end
+            sim_scores_argsort = list(reversed(np.argsort(similarity_scores)))
+            if top_n is not None:
+                sim_scores_argsort = sim_scores_argsort[:top_n]
+            if return_documents:
+                docs = [
+                    DocumentObj(
+                        index=int(arg),
+                        relevance_score=float(similarity_scores[arg]),
+                        document=Document(text=documents[arg]),
+                    )
+                    for arg in sim_scores_argsort
+                ]
+            else:
+                docs = [
+                    DocumentObj(
+                        index=int(arg),
+                        relevance_score=float(similarity_scores[arg]),
+                        document=None,
+                    )
+                    for arg in sim_scores_argsort
+                ]
+            results.append(Rerank(id=str(uuid.uuid1()), results=docs))
+        return results
 
 
 def get_cache_dir(model_spec: RerankModelSpec):
@@ -14,6 +14,7 @@
 import os
 import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
@@ -53,6 +54,47 @@ def test_restful_api(setup):
     assert scores["results"][0]["document"] == corpus[0]
 
 
+def test_restful_api_batching(setup):
+    endpoint, _ = setup
+    client = Client(endpoint)
+
+    model_uid = client.launch_model(
+        model_name="bge-reranker-base",
+        model_type="rerank",
+        batch_wait_ms=50,
+        max_batch_size=16,
+    )
+    model = client.get_model(model_uid)
+    requests = [
+        ("A man is eating pasta.", ["A man is eating food.", "A monkey is playing."]),
+        (
+            "A man is riding a horse.",
+            [
+                "The girl is carrying a baby.",
+                "A man is riding a white horse on an enclosed ground.",
+                "Two men pushed carts through the woods.",
+            ],
+        ),
+        ("Someone plays music.", ["A woman is playing violin."]),
+    ]
+    expected = [model.rerank(corpus, query) for query, corpus in requests]
+
+    with ThreadPoolExecutor(len(requests)) as executor:
+        futures = [
+            executor.submit(model.rerank, corpus, query, top_n=2)
+            for query, corpus in requests
+        ]
+        results = [f.result() for f in futures]
+
+    for r, e in zip(results, expected):
+        assert len(r["results"]) == min(2, len(e["results"]))
+        for doc, expected_doc in zip(r["results"], e["results"]):
+            assert doc["index"] == expected_doc["index"]
+            assert doc["relevance_score"] == pytest.approx(
+                expected_doc["relevance_score"], abs=1e-4
+            )
+
+
 def test_from_local_uri():
     from ...utils import cache_from_uri
     from ..custom import CustomRerankModelSpec
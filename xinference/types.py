@@ -23,11 +23,15 @@ from ._compat import (
     validate_arguments,
 )
 from .fields import (
+    best_of_field,
     echo_field,
     frequency_penalty_field,
+    gamma_field,
     logprobs_field,
     max_tokens_field,
+    n_field,
     none_field,
+    num_branches_field,
     presence_penalty_field,
     repeat_penalty_field,
     stop_field,
@@ -59,7 +63,8 @@ class EmbeddingUsage(TypedDict):
 class EmbeddingData(TypedDict):
     index: int
     object: str
-    embedding: List[float]
+    # A list of floats, or a base64 string if encoding_format is base64.
+    embedding: Union[List[float], str]
 
 
 class Embedding(TypedDict):
@@ -104,6 +109,16 @@ class CompletionUsage(TypedDict):
     total_tokens: int
 
 
+class RequestTimings(TypedDict, total=False):
+    queue_ms: float
+    tokenize_ms: float
+    prefill_ms: float
+    decode_ms: float
+    detokenize_ms: float
+    compute_ms: float
+    serialize_ms: float
+
+
 class CompletionChunk(TypedDict):
     id: str
     object: Literal["text_completion"]
@@ -111,6 +126,7 @@ class CompletionChunk(TypedDict):
     model: str
     choices: List[CompletionChoice]
     usage: NotRequired[CompletionUsage]
+    timings: NotRequired[RequestTimings]
 
 
 class Completion(TypedDict):
@@ -120,6 +136,7 @@ class Completion(TypedDict):
     model: str
     choices: List[CompletionChoice]
     usage: CompletionUsage
+    timings: NotRequired[RequestTimings]
 
 
 class ChatCompletionMessage(TypedDict):
@@ -142,6 +159,7 @@ class ChatCompletion(TypedDict):
     model: str
     choices: List[ChatCompletionChoice]
     usage: CompletionUsage
+    timings: NotRequired[RequestTimings]
 
 
 class ChatCompletionChunkDelta(TypedDict):
@@ -162,6 +180,7 @@ class ChatCompletionChunk(TypedDict):
     created: int
     choices: List[ChatCompletionChunkChoice]
     usage: NotRequired[CompletionUsage]
+    timings: NotRequired[RequestTimings]
 
 
 class ChatglmCppModelConfig(TypedDict, total=False):
@@ -263,6 +282,13 @@ class PytorchGenerateConfig(TypedDict, total=False):
     stream_interval: int
     model: Optional[str]
     tools: Optional[List[Dict]]
+    n: int
+    best_of: Optional[int]
+
+
+class SpeculativeGenerateConfig(PytorchGenerateConfig, total=False):
+    gamma: Optional[int]
+    num_branches: int
 
 
 class PytorchModelConfig(TypedDict, total=False):
@@ -276,6 +302,19 @@ class PytorchModelConfig(TypedDict, total=False):
     gptq_groupsize: int
     gptq_act_order: bool
     trust_remote_code: bool
+    batching: str
+    max_num_seqs: int
+    enable_prefix_caching: bool
+    prefix_cache_max_memory: int
+    static_kv_cache: bool
+    prefill_chunk_size: int
+    prompt_lookup_num_tokens: int
+    prompt_lookup_max_ngram_size: int
+    embedding_batch_size: int
+    compression_cache_max_memory: int
+    compression_int8_matmul: bool
+    cpu_mode: Optional[str]
+    compile: bool
 
 
 def get_pydantic_model_from_method(
@@ -338,6 +377,13 @@ class CreateCompletionTorch(BaseModel):
     temperature: float = temperature_field
     top_p: float = top_p_field
     top_k: int = top_k_field
+    n: int = n_field
+    best_of: Optional[int] = best_of_field
+
+
+class CreateCompletionSpeculative(CreateCompletionTorch):
+    gamma: Optional[int] = gamma_field
+    num_branches: int = num_branches_field
 
 
 CreateCompletionLlamaCpp: BaseModel
@@ -410,7 +456,7 @@ except ImportError:
 
 class CreateCompletion(
     ModelAndPrompt,
-    CreateCompletionTorch,
+    CreateCompletionSpeculative,
     CreateCompletionLlamaCpp,
     CreateCompletionCTransformers,
     CreateCompletionOpenAI,
@@ -424,6 +470,7 @@ class CreateChatModel(BaseModel):
 
 # Currently, chat calls generates, so the params share the same one.
 CreateChatCompletionTorch = CreateCompletionTorch
+CreateChatCompletionSpeculative = CreateCompletionSpeculative
 CreateChatCompletionLlamaCpp: BaseModel = CreateCompletionLlamaCpp
 CreateChatCompletionCTransformers: BaseModel = CreateCompletionCTransformers
 
@@ -445,7 +492,7 @@ CreateChatCompletionOpenAI = fix_forward_ref(CreateChatCompletionOpenAI)
 
 class CreateChatCompletion(
     CreateChatModel,
-    CreateChatCompletionTorch,
+    CreateChatCompletionSpeculative,
     CreateChatCompletionLlamaCpp,
     CreateChatCompletionCTransformers,
     CreateChatCompletionOpenAI,